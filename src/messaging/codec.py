@@ -0,0 +1,125 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json, zlib
+from typing import Any, List
+
+# optional binary serialization formats
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Wire format of the MQTT payloads. Plain JSON is sent as it is (backward compatible), the other encodings are
+# framed with a 2 bytes header: FRAME_MARKER followed by the encoding id. JSON text never starts with a 0 byte.
+FRAME_MARKER = 0x00
+
+ENCODING_IDS = {
+    "json": 0,
+    "json+zlib": 1,
+    "msgpack": 2,
+    "msgpack+zlib": 3,
+    "cbor": 4,
+    "cbor+zlib": 5,
+}
+ENCODING_NAMES = {encoding_id: name for name, encoding_id in ENCODING_IDS.items()}
+
+# payloads smaller than this are not compressed, the zlib overhead is not worth it
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+class CodecError(Exception):
+    pass
+
+def _serializer_available(serializer: str) -> bool:
+    if serializer == "msgpack":
+        return msgpack is not None
+    if serializer == "cbor":
+        return cbor2 is not None
+    return serializer == "json"
+
+# This function gets the encodings supported by this device, depends on the installed optional packages
+def available_encodings() -> List[str]:
+    return [encoding for encoding in ENCODING_IDS if _serializer_available(encoding.split("+")[0])]
+
+# This function picks the first encoding of the preferred list which is accepted by the peer and available
+def negotiate_encoding(accepted: List[str], preferred: List[str]) -> str:
+    available = available_encodings()
+    for encoding in preferred:
+        if encoding in accepted and encoding in available:
+            return encoding
+    return "json"
+
+def _serialize(serializer: str, data: Any) -> bytes:
+    if serializer == "msgpack":
+        return msgpack.packb(data, use_bin_type=True)
+    if serializer == "cbor":
+        return cbor2.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def _deserialize(serializer: str, body: bytes) -> Any:
+    if serializer == "msgpack":
+        return msgpack.unpackb(body, raw=False)
+    if serializer == "cbor":
+        return cbor2.loads(body)
+    return json.loads(body)
+
+# This function encodes the data with the given encoding, the compression is skipped when the serialized data is
+# smaller than compress_threshold
+def encode(data: Any, encoding: str = "json", compress_threshold: int = DEFAULT_COMPRESS_THRESHOLD, compress_level: int = 6) -> bytes:
+    if encoding not in ENCODING_IDS:
+        raise CodecError(f"unsupported encoding: {encoding}")
+    serializer, _, compression = encoding.partition("+")
+    if not _serializer_available(serializer):
+        raise CodecError(f"encoding {encoding} is not available")
+    body = _serialize(serializer, data)
+    if compression == "zlib" and len(body) >= compress_threshold:
+        body = zlib.compress(body, compress_level)
+    else:
+        encoding = serializer
+    if encoding == "json":
+        return body
+    return bytes([FRAME_MARKER, ENCODING_IDS[encoding]]) + body
+
+# This function gets the encoding of the payload, from the frame header
+def payload_encoding(payload: bytes) -> str:
+    if len(payload) >= 2 and payload[0] == FRAME_MARKER:
+        encoding = ENCODING_NAMES.get(payload[1])
+        if encoding is None:
+            raise CodecError(f"unknown encoding id: {payload[1]}")
+        return encoding
+    return "json"
+
+def decode(payload: bytes) -> Any:
+    encoding = payload_encoding(payload)
+    if encoding == "json":
+        return json.loads(payload.decode() if isinstance(payload, (bytes, bytearray)) else payload)
+    serializer, _, compression = encoding.partition("+")
+    if not _serializer_available(serializer):
+        raise CodecError(f"encoding {encoding} is not available")
+    body = payload[2:]
+    if compression == "zlib":
+        body = zlib.decompress(body)
+    return _deserialize(serializer, body)
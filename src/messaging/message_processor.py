@@ -20,22 +20,202 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os, threading, queue
+import os, threading, queue, time, json
+from collections import OrderedDict, Counter
 from utils.logger import get_logger
-from typing import Callable
+from typing import Callable, Optional, Dict, Any, Tuple
 
 current_file = os.path.basename(__file__)
 logger = get_logger(current_file)
 
+# requests handled as soon as they are received, without waiting in the queue behind the running request ('profile'
+# runs on its own thread, to sample the request being processed)
+IMMEDIATE_REQUESTS = frozenset(["cancel_request", "profile"])
+
+# idempotent read requests, these can be dropped or coalesced under the load, the cloud asks them again
+IDEMPOTENT_REQUESTS = frozenset(["get_imported_images", "get_app_status", "get_apps_and_resources_status",
+                                 "get_app_status_and_logs", "get_task_status", "list_tasks", "get_ssh_public_key"])
+
+# shedding policies of the intake queue when it is full or the quota of the request type is used up
+SHED_REJECT_NEWEST = "reject_newest"
+SHED_DROP_OLDEST_READ = "drop_oldest_read"
+SHED_COALESCE = "coalesce"
+SHED_POLICIES = frozenset([SHED_REJECT_NEWEST, SHED_DROP_OLDEST_READ, SHED_COALESCE])
+
+DEFAULT_MAX_QUEUE_SIZE = 100
+DEFAULT_READ_QUOTA = 10
+
+# This function gets the identity of the request used to find its duplicates, the request fields except the
+# request_id, the deadline and the internal fields
+def request_signature(payload: Dict[str, Any]) -> str:
+    fields = {key: value for key, value in payload.items()
+              if key not in ("request_id", "deadline", "ttl") and not key.startswith("_")}
+    return json.dumps(fields, sort_keys=True, default=str)
+
+# This class is the bounded intake queue of the requests with the per request type quotas. When the queue is full
+# or the quota of the request type is used up the request is shed according to the policy, 'reject_newest' rejects
+# the incoming request, 'drop_oldest_read' drops the oldest queued idempotent read to make room, 'coalesce'
+# replaces a queued duplicate of the read with the incoming one (and then rejects the newest). The shed requests
+# are returned to the caller to be answered.
+class IntakeQueue:
+    def __init__(self, max_size: int = DEFAULT_MAX_QUEUE_SIZE, policy: str = SHED_REJECT_NEWEST,
+                 quotas: Optional[Dict[str, int]] = None, read_quota: int = DEFAULT_READ_QUOTA):
+        if policy not in SHED_POLICIES:
+            raise ValueError(f"Unsupported shedding policy: {policy}")
+        self._max_size = max(max_size, 1)
+        self._policy = policy
+        self._quotas = dict(quotas or {})
+        self._read_quota = read_quota
+        self._condition = threading.Condition()
+        # seq -> payload, in the order of arrival
+        self._items: "OrderedDict[int, Any]" = OrderedDict()
+        self._seq = 0
+        # number of the queued requests per request type
+        self._counts = Counter()
+        # number of the shed requests per action and per request type
+        self._shed = Counter()
+        self._shed_by_request = Counter()
+
+    # This function changes the limits and the shedding policy, the queued requests beyond the new limits are kept
+    def configure(self, max_size: int, policy: str, quotas: Optional[Dict[str, int]], read_quota: int):
+        if policy not in SHED_POLICIES:
+            raise ValueError(f"Unsupported shedding policy: {policy}")
+        with self._condition:
+            self._max_size = max(max_size, 1)
+            self._policy = policy
+            self._quotas = dict(quotas or {})
+            self._read_quota = read_quota
+
+    def _quota(self, request: Optional[str]) -> int:
+        if request in self._quotas:
+            return self._quotas[request]
+        return self._read_quota if request in IDEMPOTENT_REQUESTS else self._max_size
+
+    def _remove(self, seq: int):
+        payload = self._items.pop(seq)
+        request = payload.get("request") if isinstance(payload, dict) else None
+        self._counts[request] -= 1
+        if self._counts[request] <= 0:
+            del self._counts[request]
+        return payload
+
+    def _count_shed(self, action: str, payload: Any):
+        self._shed[action] += 1
+        self._shed_by_request[payload.get("request") if isinstance(payload, dict) else None] += 1
+
+    # This function queues the request, returns the list of the shed requests (the incoming one or the dropped
+    # queued ones) to be answered with the 'Rejected: overloaded' response
+    def put(self, payload: Any) -> list:
+        shed = []
+        request = payload.get("request") if isinstance(payload, dict) else None
+        with self._condition:
+            overloaded = len(self._items) >= self._max_size or self._counts[request] >= self._quota(request)
+            if self._policy == SHED_COALESCE and request in IDEMPOTENT_REQUESTS and overloaded:
+                signature = request_signature(payload)
+                for seq, queued in self._items.items():
+                    if isinstance(queued, dict) and queued.get("request") == request and request_signature(queued) == signature:
+                        # the incoming duplicate takes the place of the queued one in the queue
+                        self._items[seq] = payload
+                        self._count_shed("coalesced", queued)
+                        return [queued]
+            if self._policy == SHED_DROP_OLDEST_READ and request in IDEMPOTENT_REQUESTS \
+                    and self._counts[request] >= self._quota(request):
+                seq = next((seq for seq, queued in self._items.items()
+                            if isinstance(queued, dict) and queued.get("request") == request), None)
+                # with a zero quota there is no queued read to drop, the incoming one is rejected below
+                if seq is not None:
+                    shed.append(self._remove(seq))
+                    self._count_shed("dropped", shed[-1])
+            if self._policy == SHED_DROP_OLDEST_READ and len(self._items) >= self._max_size:
+                seq = next((seq for seq, queued in self._items.items()
+                            if isinstance(queued, dict) and queued.get("request") in IDEMPOTENT_REQUESTS), None)
+                if seq is not None:
+                    shed.append(self._remove(seq))
+                    self._count_shed("dropped", shed[-1])
+            if len(self._items) >= self._max_size or self._counts[request] >= self._quota(request):
+                self._count_shed("rejected", payload)
+                shed.append(payload)
+                return shed
+            self._seq += 1
+            self._items[self._seq] = payload
+            self._counts[request] += 1
+            self._condition.notify()
+        return shed
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        with self._condition:
+            if not self._items and not self._condition.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            return self._remove(next(iter(self._items)))
+
+    # This function gets the request at the head of the queue without removing it, None when the queue is empty
+    def peek(self) -> Any:
+        with self._condition:
+            return next(iter(self._items.values()), None)
+
+    # This function removes and returns the request at the head of the queue if it matches the predicate, None
+    # otherwise
+    def get_if(self, predicate: Callable[[Any], bool]) -> Any:
+        with self._condition:
+            if not self._items or not predicate(next(iter(self._items.values()))):
+                return None
+            return self._remove(next(iter(self._items)))
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._items)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "queued": len(self._items),
+                "max_size": self._max_size,
+                "policy": self._policy,
+                "queued_by_request": dict(self._counts),
+                "shed": {action: self._shed[action] for action in ("rejected", "dropped", "coalesced")},
+                "shed_by_request": dict(self._shed_by_request)
+            }
+
 class MessageProcessor:
-    def __init__(self, on_message_callback: Callable):
-        self.message_queue = queue.Queue()
+    # on_shed_callback: called with the requests shed by the intake queue, to answer them as rejected
+    def __init__(self, on_message_callback: Callable, on_shed_callback: Optional[Callable] = None,
+                 intake_queue: Optional[IntakeQueue] = None):
+        self.message_queue = intake_queue if intake_queue is not None else IntakeQueue()
         self.on_message_callback = on_message_callback
+        self.on_shed_callback = on_shed_callback
         self._running = False
         self._worker_thread = None
+        # called after a request is queued, e.g. to wake up the consumer of the asyncio runtime
+        self._enqueue_listener = None
+
+    def set_enqueue_listener(self, listener: Optional[Callable[[], None]]):
+        self._enqueue_listener = listener
 
     def add_message(self, payload):
-        self.message_queue.put(payload)
+        if isinstance(payload, dict):
+            # the receive time of the request, its 'ttl' is counted from this time
+            payload["_received_time"] = time.time()
+            if payload.get("request") in IMMEDIATE_REQUESTS:
+                try:
+                    self.on_message_callback(payload)
+                except Exception as ex:
+                    logger.error(f"Error processing message: {ex}")
+                return
+        shed = self.message_queue.put(payload)
+        if self._enqueue_listener is not None:
+            self._enqueue_listener()
+        for shed_payload in shed:
+            if not isinstance(shed_payload, dict):
+                continue
+            logger.warning(f"intake queue is overloaded, shedding the request: {shed_payload.get('request')}")
+            if self.on_shed_callback is not None:
+                try:
+                    self.on_shed_callback(shed_payload)
+                except Exception as ex:
+                    logger.error(f"Error rejecting message: {ex}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return self.message_queue.get_stats()
 
     def start(self):
         if not self._running:
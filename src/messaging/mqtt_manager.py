@@ -22,14 +22,41 @@
 
 import os, json, ssl
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 from utils.logger import get_logger
 from messaging.message_processor import MessageProcessor
+from messaging import codec
+from messaging.request_recorder import RequestRecorder
 from utils.config import AppConfig
-from typing import Callable
+from typing import Callable, Optional
 
 current_file = os.path.basename(__file__)
 logger = get_logger(current_file)
 
+PROTOCOL_VERSIONS = {
+    "3.1": mqtt.MQTTv31,
+    "3.1.1": mqtt.MQTTv311,
+    "5": mqtt.MQTTv5
+}
+
+# CONNACK reason code of the brokers which do not support MQTT v5
+UNSUPPORTED_PROTOCOL_VERSION = 132
+# MQTT v3.1.1 CONNACK return code (unacceptable protocol version) of the brokers which do not support MQTT v5, if it is
+# not mapped to the MQTT v5 reason code
+REFUSED_PROTOCOL_VERSION = mqtt.CONNACK_REFUSED_PROTOCOL_VERSION
+
+# fall back to MQTT v3.1.1 if the broker closes this many established MQTT v5 connections without CONNACK
+MAX_V5_CONNECT_ATTEMPTS = 3
+
+# reason of the disconnects on which the broker did not answer at all, not counted as a refused MQTT v5
+KEEP_ALIVE_TIMEOUT = "Keep alive timeout"
+
+# This class is raised to stop the reconnection of paho's network loop when the connection falls back to MQTT v3.1.1
+# after it was closed by the broker, the disconnect of the closed connection does not stop the loop
+class ProtocolFallback(Exception):
+    pass
+
 class MQTTManager:
     def __init__(self, config: AppConfig, message_processor: MessageProcessor, on_connect_callback: Callable):
         self.config = config
@@ -37,51 +64,166 @@ class MQTTManager:
         self.on_connect_callback = on_connect_callback
         self.client = None
         self._connected = False
+        # max number of the topic aliases allowed by the broker, MQTT v5 only
+        self.topic_alias_maximum = 0
+        self._protocol_fallback = False
+        self._v5_connect_attempts = 0
+        # set when the CONNECT is sent on an established connection and when the socket fails afterwards, the connection
+        # attempts closed by the broker are counted for the MQTT v5 fallback only
+        self._v5_connect_sent = False
+        self._v5_link_error = False
+        # set when the broker address or the credentials are changed, the client is replaced on the reconnection
+        self._endpoint_changed = False
+        # called with the new client before connecting, e.g. to hook its sockets into an external network loop
+        self._client_setup = None
+        # opt-in recording of the received requests for the replay
+        self.recorder = RequestRecorder()
+        self.configure_recorder(config)
+
+    # This function applies the recorder settings of the configuration (or a snapshot of it)
+    def configure_recorder(self, config):
+        file_path = os.path.join(config.home_dir, config.recorder_file) if config.recorder_file else None
+        self.recorder.configure(file_path, config.recorder_max_bytes, config.recorder_redact)
+
+    def set_client_setup(self, client_setup: Optional[Callable[[mqtt.Client], None]]):
+        self._client_setup = client_setup
     
     def _on_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code.is_failure:
             logger.error(f"Connection failed: {reason_code}")
             self._connected = False
+            if client.protocol == mqtt.MQTTv5 and reason_code.value in (UNSUPPORTED_PROTOCOL_VERSION,
+                                                                         REFUSED_PROTOCOL_VERSION):
+                self._fall_back_to_v311(client)
         else:
             logger.info(f"Connected to {client._host}:{client._port}")
             self._connected = True
+            self._v5_connect_attempts = 0
+            client.on_log = None
+            self.topic_alias_maximum = getattr(properties, "TopicAliasMaximum", 0) if properties is not None else 0
             client.subscribe(self.config.downstream_topic)
             #AppManager.set_mqtt_client(client)
             self.on_connect_callback(client)
     
     def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
         logger.info(f"Disconnected (Code: {reason_code})")
+        if client.protocol == mqtt.MQTTv5 and not self._connected and not self._protocol_fallback:
+            # the broker closes the connection without CONNACK, if it does not understand MQTT v5. The attempts which
+            # failed before the CONNECT, on a socket error or without any answer of the broker are not counted
+            closed_by_broker = self._v5_connect_sent and not self._v5_link_error and \
+                reason_code.getName() != KEEP_ALIVE_TIMEOUT
+            self._v5_connect_sent = False
+            if closed_by_broker:
+                self._v5_connect_attempts += 1
+                if self._v5_connect_attempts >= MAX_V5_CONNECT_ATTEMPTS:
+                    self._fall_back_to_v311(client)
+                    return
         self._connected = False
         if reason_code != 0:
             logger.warning("Unexpected disconnect! Attempting reconnect...")
+
+    # This function moves the connection to the changed broker address/credentials of the configuration, the network
+    # loop is stopped and a new client is connected, the queued messages are kept
+    def apply_endpoint_change(self):
+        logger.info("MQTT endpoint is changed in the configuration, reconnecting")
+        self._endpoint_changed = True
+        client = self.client
+        if client is not None:
+            client.disconnect()
+
+    # This function gets the protocol of the next client, MQTT v3.1.1 after a fallback else the configured one
+    def _next_protocol(self) -> int:
+        if self._protocol_fallback and not self._endpoint_changed:
+            return mqtt.MQTTv311
+        return PROTOCOL_VERSIONS[self.config.mqtt_protocol_version]
+
+    def _fall_back_to_v311(self, client):
+        logger.warning("MQTT v5 is refused by the broker, falling back to MQTT v3.1.1")
+        self._protocol_fallback = True
+        client.on_log = None
+        # stops the network loop, loop_forever reconnects with MQTT v3.1.1
+        client.disconnect()
+
+    # This function is called by paho before it reconnects the client, the MQTT v5 connection is not retried after
+    # a fallback
+    def _on_v5_pre_connect(self, client, userdata):
+        if self._protocol_fallback:
+            raise ProtocolFallback("MQTT v5 is refused by the broker")
+
+    # This function tracks the MQTT v5 connection attempts through the paho log, the CONNECT is logged once the TCP
+    # connection is established and the socket errors are logged at the error level
+    def _on_v5_connect_log(self, client, userdata, level, buf):
+        if buf.startswith("Sending CONNECT"):
+            self._v5_connect_sent = True
+            self._v5_link_error = False
+        elif level == mqtt.MQTT_LOG_ERR and "on socket" in buf:
+            self._v5_link_error = True
+
+    # This function handles an exception of the network loop, a CONNACK of an MQTT v3.1.1 broker with a return code
+    # which paho cannot parse as an MQTT v5 reason code falls back to MQTT v3.1.1. Returns False if not handled
+    def handle_loop_error(self, client, ex: Exception) -> bool:
+        if client.protocol != mqtt.MQTTv5 or self._connected or self._protocol_fallback or not self._v5_connect_sent:
+            return False
+        logger.error(f"Invalid CONNACK to MQTT v5: {ex}")
+        self._fall_back_to_v311(client)
+        # sends the DISCONNECT and closes the socket, the network loop is not running after the exception
+        client.loop_write()
+        return True
     
     def _on_message(self, client, userdata, msg):
         try:
-            payload = json.loads(msg.payload.decode())
+            payload = codec.decode(msg.payload)
+            # MQTT v5 requests may carry the response topic and correlation data for the responses
+            response_topic = getattr(msg.properties, "ResponseTopic", None) if msg.properties is not None else None
+            if self.recorder.enabled:
+                self.recorder.record(msg.topic, payload, codec.payload_encoding(msg.payload), response_topic,
+                                     getattr(msg.properties, "CorrelationData", None) if response_topic else None)
+            if response_topic and isinstance(payload, dict):
+                payload["_reply_route"] = (response_topic, getattr(msg.properties, "CorrelationData", None))
             self.message_processor.add_message(payload)
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to decode JSON message: {e}")
+        except (json.JSONDecodeError, codec.CodecError) as e:
+            logger.error(f"Failed to decode the message: {e}")
         except Exception as ex:
             logger.error(f"Error handling message: {ex}")
     
+    def _connect(self, protocol: int):
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=protocol)
+        self.client.username_pw_set(self.config.mqtt_user, self.config.mqtt_pwd)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.on_disconnect = self._on_disconnect
+        # paho accepts the in-flight limit only before the connection is established
+        self.client.max_inflight_messages_set(self.config.mqtt_inflight_window)
+        if self._client_setup is not None:
+            self._client_setup(self.client)
+
+        properties = None
+        if protocol == mqtt.MQTTv5:
+            # flow control, max number of the QoS 1/2 messages the broker sends before the acknowledgements
+            properties = Properties(PacketTypes.CONNECT)
+            properties.ReceiveMaximum = self.config.mqtt_receive_maximum
+            self._v5_connect_sent = False
+            self._v5_link_error = False
+            self.client.on_log = self._on_v5_connect_log
+            self.client.on_pre_connect = self._on_v5_pre_connect
+
+        if self.config.mqtt_protocol == "mqtt":
+            self.client.connect(self.config.mqtt_host, self.config.mqtt_port, 120, properties=properties)
+        elif self.config.mqtt_protocol == "mqtts":
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+            self.client.tls_set_context(context)
+            self.client.connect(self.config.mqtt_host, self.config.mqtt_port, 120, properties=properties)
+        else:
+            raise ValueError(f"Unsupported MQTT protocol: {self.config.mqtt_protocol}")
+        
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+
     def connect(self):
         try:
-            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv31)
-            self.client.username_pw_set(self.config.mqtt_user, self.config.mqtt_pwd)
-            self.client.on_connect = self._on_connect
-            self.client.on_message = self._on_message
-            self.client.on_disconnect = self._on_disconnect
-            
-            if self.config.mqtt_protocol == "mqtt":
-                self.client.connect(self.config.mqtt_host, self.config.mqtt_port, 120)
-            elif self.config.mqtt_protocol == "mqtts":
-                context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-                self.client.tls_set_context(context)
-                self.client.connect(self.config.mqtt_host, self.config.mqtt_port, 120)
-            else:
-                raise ValueError(f"Unsupported MQTT protocol: {self.config.mqtt_protocol}")
-            
-            self.client.reconnect_delay_set(min_delay=1, max_delay=120)
+            protocol_version = self.config.mqtt_protocol_version
+            if protocol_version not in PROTOCOL_VERSIONS:
+                raise ValueError(f"Unsupported MQTT protocol version: {protocol_version}")
+            self._connect(PROTOCOL_VERSIONS[protocol_version])
             return True
             
         except Exception as e:
@@ -93,9 +235,39 @@ class MQTTManager:
             self.client.disconnect()
     
     def loop_forever(self):
-        if self.client:
-            self.client.loop_forever()
+        while self.client:
+            try:
+                self.client.loop_forever()
+            except ProtocolFallback:
+                pass
+            except Exception as ex:
+                if not self.handle_loop_error(self.client, ex):
+                    raise
+            if not self._protocol_fallback and not self._endpoint_changed:
+                break
+            # the network loop is stopped to fall back to MQTT v3.1.1 or to connect to the changed endpoint
+            protocol = self._next_protocol()
+            self._protocol_fallback = False
+            self._endpoint_changed = False
+            self._connected = False
+            try:
+                self._connect(protocol)
+            except Exception as ex:
+                logger.error(f"Failed to connect to MQTT broker: {ex}")
+                break
     
+    # This function reconnects the client when the network loop is driven externally, a new client is connected if
+    # the broker refused MQTT v5 (MQTT v3.1.1) or the endpoint has changed
+    def reconnect(self):
+        if self._protocol_fallback or self._endpoint_changed:
+            protocol = self._next_protocol()
+            self._protocol_fallback = False
+            self._endpoint_changed = False
+            self._connected = False
+            self._connect(protocol)
+        else:
+            self.client.reconnect()
+
     @property
     def is_connected(self):
         return self._connected
\ No newline at end of file
@@ -20,25 +20,359 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os, json
-from typing import Dict, Any
+import os, json, threading, time
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, Callable, Optional, List
+from paho.mqtt.client import MQTTv5, MQTT_ERR_SUCCESS
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 from utils.logger import get_logger
+from messaging import codec
+from messaging.outbox import Outbox
+from utils.stats import Histogram
+from utils.metrics import metrics, SIZE_BUCKETS
 
 current_file = os.path.basename(__file__)
 logger = get_logger(current_file)
 
+# default upper limit of the upstream message size, the chunks are closed before reaching it
+DEFAULT_MAX_MESSAGE_SIZE = 256 * 1024
+
+# statuses of the requests' final results
+TERMINAL_STATUSES = frozenset(["Completed", "Failed", "Cancelled", "Rejected", "Expired"])
+
+# max number of the pending MQTT v5 response routes (response topic/correlation data of the requests)
+MAX_REPLY_ROUTES = 1000
+
+# This function classifies the upstream message: 'heartbeat' (periodic status update), 'result' (final result of
+# a request) or 'progress' (intermediate status of a request)
+def message_class(data: Dict[str, Any]) -> str:
+    if "status_update" in data:
+        # the batched status of the running tasks is a progress message
+        return "progress" if data["status_update"] == "task_status" else "heartbeat"
+    # all the chunks of a chunked result are results, to keep their order
+    if data.get("status") in TERMINAL_STATUSES or "chunk" in data:
+        return "result"
+    return "progress"
+
+# in-flight (unacknowledged) messages older than this are dropped from the in-flight window
+INFLIGHT_TIMEOUT_SECONDS = 120
+
+# outbox priority of the message classes, the request results are sent first after the reconnection
+OUTBOX_PRIORITIES = {"result": 0, "progress": 1, "heartbeat": 2}
+
+# This function gets the outbox key of the message, a queued message is superseded by a newer one of the same key
+def outbox_key(data: Dict[str, Any], message_cls: str) -> Optional[str]:
+    if message_cls == "heartbeat":
+        return f"heartbeat:{data.get('status_update')}"
+    if message_cls == "progress" and data.get("request_id") is not None:
+        return f"progress:{data.get('request_id')}"
+    if message_cls == "progress" and "status_update" in data:
+        return f"progress:{data.get('status_update')}"
+    return None
+
+PUBLISHED_MESSAGES = metrics.counter("mqtt_published_messages", "Upstream messages published", ("message_class",))
+PUBLISHED_BYTES = metrics.counter("mqtt_published_bytes", "Bytes of the upstream messages published", ("message_class",))
+PUBLISH_FAILURES = metrics.counter("mqtt_publish_failures", "Upstream messages the client failed to publish", ("message_class",))
+RESULT_BYTES = metrics.histogram("request_result_bytes", "Size of the encoded final messages of the requests in bytes",
+                                 ("request",), SIZE_BUCKETS)
+
 class MQTTProxy:
-  def __init__(self, upstream_topic: str):
+  def __init__(self, upstream_topic: str, max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE,
+               encodings: Optional[List[str]] = None, compress_threshold: int = codec.DEFAULT_COMPRESS_THRESHOLD):
     self._upstream_topic = upstream_topic
+    self._max_message_size = max_message_size
     self._mqtt_client = None
+    # encodings in the order of preference, plain JSON is used until the cloud advertises the accepted encodings
+    self._preferred_encodings = encodings or ["json"]
+    self._compress_threshold = compress_threshold
+    self._encoding = "json"
+    # MQTT v5 options, message expiry interval (seconds) per message class, topic aliases of the connection
+    self._message_expiry: Dict[str, int] = {}
+    self._mqtt_v5 = False
+    self._topic_alias_maximum = 0
+    self._topic_aliases: Dict[str, int] = {}
+    self._reply_routes: "OrderedDict[str, tuple]" = OrderedDict()
+    self._lock = threading.Lock()
+    # messages are queued in the outbox while the MQTT link is down, drained at drain_rate messages/sec on reconnect
+    self._outbox: Optional[Outbox] = None
+    self._drain_rate = 10
+    self._drain_thread = None
+    # callbacks called with every upstream message before it is sent or queued
+    self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+    # QoS per message class, in-flight window of the QoS 1/2 messages and the PUBACK latency per message class
+    self._qos: Dict[str, int] = {"result": 1, "progress": 0, "heartbeat": 0}
+    self._inflight_window = 20
+    self._inflight_lock = threading.Lock()
+    # mid -> (message_class, qos, publish time) of the unacknowledged QoS 1/2 messages
+    self._inflight: Dict[int, tuple] = {}
+    # mid -> ack time, of the acks received before the publish call returned
+    self._early_acks: Dict[int, float] = {}
+    self._ack_latency: Dict[str, Histogram] = {message_cls: Histogram() for message_cls in OUTBOX_PRIORITIES}
+    self._inflight_timeouts = 0
     
-  def set_client(self, mqtt_client):
-    self._mqtt_client = mqtt_client
+  # topic_alias_maximum is the max number of the topic aliases allowed by the broker (MQTT v5)
+  def set_client(self, mqtt_client, topic_alias_maximum: int = 0):
+    with self._lock:
+        self._mqtt_client = mqtt_client
+        self._mqtt_v5 = mqtt_client is not None and mqtt_client.protocol == MQTTv5
+        # topic aliases are valid only within a connection
+        self._topic_alias_maximum = topic_alias_maximum if self._mqtt_v5 else 0
+        self._topic_aliases = {}
+    if mqtt_client is not None:
+        mqtt_client.on_publish = self._on_publish
+    self._start_draining()
+
+  # qos: {message_class: qos}, inflight_window: max number of the unacknowledged QoS 1/2 messages (paho's in-flight
+  # limit is set to the same value by MQTTManager before connecting)
+  def set_publish_options(self, qos: Dict[str, int], inflight_window: int):
+    self._qos.update(qos)
+    self._inflight_window = max(inflight_window, 1)
+
+  def add_listener(self, listener: Callable[[Dict[str, Any]], None]):
+    self._listeners.append(listener)
+
+  def set_outbox(self, outbox: Outbox, drain_rate: int = 10):
+    self._outbox = outbox
+    self._drain_rate = max(drain_rate, 1)
+
+  def set_drain_rate(self, drain_rate: int):
+    self._drain_rate = max(drain_rate, 1)
+
+  # This function changes the upstream topic, e.g. when the device key is changed in the configuration
+  def set_upstream_topic(self, upstream_topic: str):
+    with self._lock:
+        self._upstream_topic = upstream_topic
+
+  # This function changes the preferred encodings, the negotiated encoding is kept if it is still preferred
+  def set_encodings(self, encodings: List[str], compress_threshold: int):
+    self._preferred_encodings = encodings or ["json"]
+    self._compress_threshold = compress_threshold
+    if self._encoding not in self._preferred_encodings and self._encoding != "json":
+        logger.info(f"upstream encoding is changed from {self._encoding} to json")
+        self._encoding = "json"
+
+  # message_expiry: {message_class: seconds}, the broker drops the messages which are not delivered in time (MQTT v5)
+  def set_message_expiry(self, message_expiry: Dict[str, int]):
+    self._message_expiry = {key: value for key, value in message_expiry.items() if value}
+
+  # This function registers the MQTT v5 response topic and correlation data of a request, the messages of the
+  # request are sent to the response topic with the correlation data instead of the upstream topic
+  def register_reply_route(self, request_id: str, response_topic: str, correlation_data: Optional[bytes]):
+    with self._lock:
+        self._reply_routes[request_id] = (response_topic, correlation_data)
+        self._reply_routes.move_to_end(request_id)
+        while len(self._reply_routes) > MAX_REPLY_ROUTES:
+            self._reply_routes.popitem(last=False)
+
+  @property
+  def encoding(self) -> str:
+    return self._encoding
+
+  # This function negotiates the encoding of the upstream messages with the encodings accepted by the cloud
+  def set_accepted_encodings(self, accepted: List[str]):
+    encoding = codec.negotiate_encoding(accepted, self._preferred_encodings)
+    if encoding != self._encoding:
+        logger.info(f"upstream encoding is changed from {self._encoding} to {encoding}")
+        self._encoding = encoding
     
+  def _is_connected(self) -> bool:
+    mqtt_client = self._mqtt_client
+    return mqtt_client is not None and mqtt_client.is_connected()
+
+  def _inflight_count(self) -> int:
+    now = time.monotonic()
+    with self._inflight_lock:
+        expired = [mid for mid, (_, _, publish_time) in self._inflight.items() if now - publish_time > INFLIGHT_TIMEOUT_SECONDS]
+        for mid in expired:
+            del self._inflight[mid]
+            self._inflight_timeouts += 1
+        for mid in [mid for mid, ack_time in self._early_acks.items() if now - ack_time > INFLIGHT_TIMEOUT_SECONDS]:
+            del self._early_acks[mid]
+        return len(self._inflight)
+
+  # This function tells whether the in-flight window is full, the producers should coalesce their messages
+  # (e.g. skip a progress tick or a heartbeat) instead of piling them up
+  def is_backpressured(self) -> bool:
+    return self._inflight_count() >= self._inflight_window
+
+  def get_publish_stats(self) -> Dict[str, Any]:
+    inflight = self._inflight_count()
+    return {
+        "inflight": inflight,
+        "inflight_window": self._inflight_window,
+        "inflight_timeouts": self._inflight_timeouts,
+        "ack_latency_ms": {message_cls: histogram.snapshot() for message_cls, histogram in self._ack_latency.items()
+                           if self._qos.get(message_cls, 0) > 0}
+    }
+
   def notify_message(self, data: Dict[str, Any]):
     try:
-        if self._mqtt_client is not None:
-            self._mqtt_client.publish(self._upstream_topic, json.dumps(data))
+        for listener in self._listeners:
+            listener(data)
+        if self._outbox is not None and (not self._is_connected() or len(self._outbox) > 0 or self.is_backpressured()):
+            # the link is down/congested or older messages are pending, queue it to keep the order, the queued
+            # progress messages and heartbeats are coalesced by the outbox
+            self._queue_message(data)
+            self._start_draining()
+        elif self._mqtt_client is not None:
+            self._send(data)
     except Exception as ex:
         logger.error(ex)
-        pass
\ No newline at end of file
+        pass
+
+  def _send(self, data: Dict[str, Any]) -> bool:
+    payload = codec.encode(data, self._encoding, self._compress_threshold)
+    message_cls = message_class(data)
+    qos = self._qos.get(message_cls, 0)
+    publish_time = time.monotonic()
+    message_info = self._publish(data, payload, qos)
+    if message_info.rc != MQTT_ERR_SUCCESS:
+        PUBLISH_FAILURES.inc(message_class=message_cls)
+        return False
+    PUBLISHED_MESSAGES.inc(message_class=message_cls)
+    PUBLISHED_BYTES.inc(len(payload), message_class=message_cls)
+    if data.get("status") in TERMINAL_STATUSES and data.get("request") is not None:
+        RESULT_BYTES.observe(len(payload), request=data.get("request"))
+    with self._inflight_lock:
+        ack_time = self._early_acks.pop(message_info.mid, None)
+        if qos == 0:
+            pass
+        elif ack_time is None:
+            self._inflight[message_info.mid] = (message_cls, qos, publish_time)
+        else:
+            self._ack_latency[message_cls].observe((ack_time - publish_time) * 1000)
+    return True
+
+  # paho callback, called when the QoS 1/2 message is acknowledged by the broker (or the QoS 0 message is sent)
+  def _on_publish(self, client, userdata, mid, reason_code, properties):
+    ack_time = time.monotonic()
+    with self._inflight_lock:
+        inflight = self._inflight.pop(mid, None)
+        if inflight is None:
+            # the publish call has not returned yet
+            self._early_acks[mid] = ack_time
+            return
+        message_cls, _, publish_time = inflight
+        self._ack_latency[message_cls].observe((ack_time - publish_time) * 1000)
+
+  def _queue_message(self, data: Dict[str, Any]):
+    message_cls = message_class(data)
+    if data.get("status") in TERMINAL_STATUSES and data.get("request_id") is not None:
+        # the queued progress of the request would be sent after its result (results are sent first)
+        self._outbox.discard(f"progress:{data.get('request_id')}")
+    self._outbox.put(data, OUTBOX_PRIORITIES[message_cls], outbox_key(data, message_cls))
+
+  def _start_draining(self):
+    if self._outbox is None or len(self._outbox) == 0 or not self._is_connected():
+        return
+    with self._lock:
+        if self._drain_thread is not None and self._drain_thread.is_alive():
+            return
+        self._drain_thread = threading.Thread(target=self._drain_outbox, daemon=True)
+        self._drain_thread.start()
+
+  # This function sends the queued messages at the drain rate while the link is up
+  def _drain_outbox(self):
+    interval = 1 / self._drain_rate
+    count = 0
+    while self._is_connected():
+        if self.is_backpressured():
+            time.sleep(interval)
+            continue
+        messages = self._outbox.peek(1)
+        if not messages:
+            break
+        seq, data = messages[0]
+        try:
+            sent = self._send(data)
+        except Exception as ex:
+            logger.error(f"failed to send the queued message: {ex}")
+            sent = False
+        if not sent:
+            break
+        self._outbox.ack(seq)
+        count += 1
+        time.sleep(interval)
+    if count > 0:
+        logger.info(f"sent {count} queued message(s), {len(self._outbox)} pending")
+
+  def _publish(self, data: Dict[str, Any], payload: bytes, qos: int = 0):
+    with self._lock:
+        mqtt_client = self._mqtt_client
+        if not self._mqtt_v5:
+            return mqtt_client.publish(self._upstream_topic, payload, qos=qos)
+
+        message_cls = message_class(data)
+        properties = Properties(PacketTypes.PUBLISH)
+        topic = self._upstream_topic
+        request_id = data.get("request_id")
+        reply_route = self._reply_routes.get(request_id) if request_id is not None else None
+        if reply_route is not None:
+            topic, correlation_data = reply_route
+            if correlation_data is not None:
+                properties.CorrelationData = correlation_data
+            # the route is kept for the later chunks, until the final result
+            if data.get("status") in TERMINAL_STATUSES:
+                del self._reply_routes[request_id]
+        expiry = self._message_expiry.get(message_cls)
+        if expiry:
+            properties.MessageExpiryInterval = expiry
+        # the upstream topic is sent once with its alias, the later messages carry only the alias. The QoS 1/2
+        # messages always carry the full topic: paho re-sends them as they are after a reconnection, when the new
+        # connection has no alias yet
+        alias = self._topic_aliases.get(topic) if qos == 0 else None
+        if alias is not None:
+            properties.TopicAlias = alias
+            topic = ""
+        elif qos == 0 and reply_route is None and len(self._topic_aliases) < self._topic_alias_maximum:
+            alias = len(self._topic_aliases) + 1
+            self._topic_aliases[topic] = alias
+            properties.TopicAlias = alias
+        # published within the lock, the message establishing an alias has to go out first
+        return mqtt_client.publish(topic, payload, qos=qos, properties=properties)
+
+  # This function streams the items as a sequence of chunk messages instead of one large message. Each message
+  # carries the fields of 'message', the page of items in result[key] and 'chunk': {"seq", "final"}, the final
+  # chunk also carries "total" (number of chunks) and the fields returned by final_result(). Only the final chunk
+  # has the status of 'message', the others have the status 'Streaming'. A chunk is closed when it has page_size
+  # items or its size reaches the max message size. The items are consumed lazily, one page ahead at most.
+  def notify_chunks(self, message: Dict[str, Any], items: Iterable[Any], key: str, page_size: int,
+                    final_result: Optional[Callable[[], Dict[str, Any]]] = None):
+    # leave room for the message header and the final result
+    size_limit = self._max_message_size * 3 // 4
+    seq = 0
+    page = []
+    page_bytes = 0
+    pending = None
+    for item in items:
+        item_bytes = len(json.dumps(item)) + 1
+        if page and (len(page) >= page_size or page_bytes + item_bytes > size_limit):
+            # the previous page is not the last one, send it out
+            if pending is not None:
+                self._notify_chunk(message, key, pending, seq, False)
+                seq += 1
+            pending = page
+            page = []
+            page_bytes = 0
+        page.append(item)
+        page_bytes += item_bytes
+    if pending is not None:
+        self._notify_chunk(message, key, pending, seq, False)
+        seq += 1
+    self._notify_chunk(message, key, page, seq, True, final_result() if final_result else None)
+
+  def _notify_chunk(self, message: Dict[str, Any], key: str, page: list, seq: int, final: bool,
+                    extra_result: Optional[Dict[str, Any]] = None):
+    result = {key: page}
+    if extra_result:
+        result.update(extra_result)
+    chunk = {"seq": seq, "final": final}
+    if final:
+        chunk["total"] = seq + 1
+    data = dict(message)
+    if not final:
+        data["status"] = "Streaming"
+    data["result"] = result
+    data["chunk"] = chunk
+    self.notify_message(data)
@@ -0,0 +1,207 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, json, threading, glob
+from typing import Any, Dict, List, Optional, Tuple
+from utils.logger import get_logger
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# a new segment file is started when the active one reaches this size
+SEGMENT_SIZE = 256 * 1024
+
+# the segments are compacted when the dead records take more than this share of the log
+COMPACTION_RATIO = 0.5
+
+# This class is a bounded, disk backed queue of the upstream messages which could not be published while the MQTT
+# link is down. The messages are appended to a log of segment files ('put' and 'del' records as JSON lines) under
+# the outbox directory, the live messages are indexed in memory and the log is compacted when it is mostly dead
+# records. Messages are taken in the order of priority (lower first), then in the order they are added. A message
+# with a key supersedes the queued message of the same key (e.g. an older heartbeat). When the outbox is full, the
+# oldest messages of the lowest priority are evicted.
+class Outbox:
+    def __init__(self, outbox_dir: str, max_entries: int = 1000, max_bytes: int = 5 * 1024 * 1024):
+        self._outbox_dir = outbox_dir
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # seq -> (priority, key, data, size)
+        self._entries: Dict[int, Tuple[int, Optional[str], Any, int]] = {}
+        self._keys: Dict[str, int] = {}
+        self._seq = 0
+        self._live_bytes = 0
+        self._log_bytes = 0
+        self._segment_index = 0
+        self._segment_file = None
+        self._segment_bytes = 0
+        os.makedirs(outbox_dir, exist_ok=True)
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _segment_path(self, index: int) -> str:
+        return os.path.join(self._outbox_dir, f"segment-{index:08d}.log")
+
+    def _segment_indexes(self) -> List[int]:
+        indexes = []
+        for path in glob.glob(os.path.join(self._outbox_dir, "segment-*.log")):
+            try:
+                indexes.append(int(os.path.basename(path)[8:-4]))
+            except ValueError:
+                pass
+        return sorted(indexes)
+
+    # This function rebuilds the in memory index by replaying the segment files
+    def _load(self):
+        indexes = self._segment_indexes()
+        for index in indexes:
+            path = self._segment_path(index)
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # partially written record of a crash
+                        continue
+                    self._log_bytes += len(line)
+                    seq = record.get("seq", 0)
+                    self._seq = max(self._seq, seq)
+                    if record.get("op") == "put":
+                        self._index(seq, record.get("priority", 0), record.get("key"), record.get("data"), len(line))
+                    else:
+                        self._unindex(seq)
+        self._segment_index = indexes[-1] if indexes else 0
+        if self._entries:
+            logger.info(f"outbox loaded, {len(self._entries)} message(s) pending")
+        self._open_segment(self._segment_index)
+        self._maybe_compact()
+
+    def _open_segment(self, index: int):
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment_index = index
+        path = self._segment_path(index)
+        self._segment_file = open(path, "a")
+        self._segment_bytes = os.path.getsize(path)
+
+    def _append(self, record: Dict[str, Any]) -> int:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        if self._segment_bytes + len(line) > SEGMENT_SIZE and self._segment_bytes > 0:
+            self._open_segment(self._segment_index + 1)
+        self._segment_file.write(line)
+        self._segment_file.flush()
+        self._segment_bytes += len(line)
+        self._log_bytes += len(line)
+        return len(line)
+
+    def _index(self, seq: int, priority: int, key: Optional[str], data: Any, size: int):
+        if key is not None and key in self._keys:
+            self._unindex(self._keys[key])
+        self._entries[seq] = (priority, key, data, size)
+        self._live_bytes += size
+        if key is not None:
+            self._keys[key] = seq
+
+    def _unindex(self, seq: int) -> bool:
+        entry = self._entries.pop(seq, None)
+        if entry is None:
+            return False
+        _, key, _, size = entry
+        self._live_bytes -= size
+        if key is not None and self._keys.get(key) == seq:
+            del self._keys[key]
+        return True
+
+    def _delete(self, seq: int):
+        if self._unindex(seq):
+            self._append({"op": "del", "seq": seq})
+
+    # This function adds the message to the outbox, a queued message with the same key is superseded
+    def put(self, data: Any, priority: int = 0, key: Optional[str] = None):
+        with self._lock:
+            if key is not None and key in self._keys:
+                self._delete(self._keys[key])
+            self._seq += 1
+            seq = self._seq
+            size = self._append({"op": "put", "seq": seq, "priority": priority, "key": key, "data": data})
+            self._index(seq, priority, key, data, size)
+            self._evict()
+            self._maybe_compact()
+
+    # This function removes the queued message of the key, if any
+    def discard(self, key: str):
+        with self._lock:
+            if key in self._keys:
+                self._delete(self._keys[key])
+                self._maybe_compact()
+
+    def _evict(self):
+        while len(self._entries) > self._max_entries or self._live_bytes > self._max_bytes:
+            # the oldest message of the lowest priority
+            seq = min(self._entries, key=lambda seq: (-self._entries[seq][0], seq))
+            logger.warning(f"outbox is full, dropping the message {seq}")
+            self._delete(seq)
+
+    # This function gets the next messages to send [(seq, data)], the messages stay in the outbox until acked
+    def peek(self, count: int = 1) -> List[Tuple[int, Any]]:
+        with self._lock:
+            seqs = sorted(self._entries, key=lambda seq: (self._entries[seq][0], seq))[:count]
+            return [(seq, self._entries[seq][2]) for seq in seqs]
+
+    # This function removes the sent message from the outbox
+    def ack(self, seq: int):
+        with self._lock:
+            self._delete(seq)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self._log_bytes < SEGMENT_SIZE or self._live_bytes > self._log_bytes * (1 - COMPACTION_RATIO):
+            return
+        self._compact()
+
+    # This function rewrites the live messages into a new segment and removes the old segments
+    def _compact(self):
+        old_indexes = self._segment_indexes()
+        new_index = self._segment_index + 1
+        tmp_path = self._segment_path(new_index) + ".tmp"
+        log_bytes = 0
+        with open(tmp_path, "w") as file:
+            for seq in sorted(self._entries):
+                priority, key, data, _ = self._entries[seq]
+                line = json.dumps({"op": "put", "seq": seq, "priority": priority, "key": key, "data": data}, separators=(",", ":")) + "\n"
+                file.write(line)
+                log_bytes += len(line)
+            file.flush()
+            os.fsync(file.fileno())
+        self._segment_file.close()
+        self._segment_file = None
+        os.replace(tmp_path, self._segment_path(new_index))
+        for index in old_indexes:
+            try:
+                os.remove(self._segment_path(index))
+            except OSError:
+                pass
+        self._log_bytes = log_bytes
+        self._open_segment(new_index)
+        logger.info(f"outbox compacted, {len(self._entries)} message(s) pending")
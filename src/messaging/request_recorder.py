@@ -0,0 +1,160 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, json, gzip, zlib, time, queue, base64, threading
+from typing import Any, Dict, Iterator, Optional
+from utils.logger import get_logger, SECRET_KEYS, REDACTED
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# max number of the records waiting for the writer thread, the records beyond are dropped instead of blocking
+QUEUE_SIZE = 1000
+# the compressed stream is flushed (readable up to there) when no record came for this long, in seconds
+FLUSH_INTERVAL = 1
+# default max size of the recording, it is rotated to <file>.1 beyond
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+# This function masks the values of the secret keys (passwords, tokens...) of the payload, the other values are
+# kept as they are
+def redact_secrets(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: REDACTED if isinstance(key, str) and any(secret in key.lower() for secret in SECRET_KEYS)
+                else redact_secrets(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact_secrets(item) for item in value]
+    return value
+
+# This class records the downstream requests received from the broker to a gzip compressed JSON lines file for the
+# replay: the receive time, the topic, the wire encoding, the decoded payload (with the secrets masked unless
+# redact is off) and the MQTT v5 response route. The records are serialized by the caller (the handlers may change
+# the payload later) and written by a background thread. No file disables the recording.
+class RequestRecorder:
+    def __init__(self, file_path: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES, redact: bool = True):
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._file_path = None
+        self._max_bytes = max_bytes
+        self._redact = redact
+        self._stream = None
+        self._thread = None
+        self.recorded = 0
+        self.dropped = 0
+        self.configure(file_path, max_bytes, redact)
+
+    @property
+    def enabled(self) -> bool:
+        return self._file_path is not None
+
+    # This function changes the recording file and the options, the current file is closed
+    def configure(self, file_path: Optional[str], max_bytes: int = DEFAULT_MAX_BYTES, redact: bool = True):
+        with self._lock:
+            if file_path != self._file_path:
+                self._close_stream()
+                if file_path:
+                    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+                    logger.info(f"recording the requests to {file_path}")
+            self._file_path = file_path or None
+            self._max_bytes = max_bytes
+            self._redact = redact
+            if self._file_path is not None and self._thread is None:
+                self._thread = threading.Thread(target=self._write_records, name="request-recorder", daemon=True)
+                self._thread.start()
+
+    def record(self, topic: str, payload: Any, encoding: str = "json",
+               response_topic: Optional[str] = None, correlation_data: Optional[bytes] = None):
+        if self._file_path is None:
+            return
+        entry = {"time": time.time(), "topic": topic, "encoding": encoding,
+                 "payload": redact_secrets(payload) if self._redact else payload}
+        if response_topic:
+            entry["response_topic"] = response_topic
+            if correlation_data is not None:
+                entry["correlation_data"] = base64.b64encode(correlation_data).decode()
+        try:
+            line = json.dumps(entry, separators=(",", ":"), default=str) + "\n"
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+        except (TypeError, ValueError) as ex:
+            logger.warning(f"failed to record the request: {ex}")
+
+    # This function writes the queued records and closes the file, called at the shutdown
+    def close(self):
+        with self._lock:
+            self._write_pending()
+            self._close_stream()
+
+    def _write_records(self):
+        while True:
+            try:
+                line = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                with self._lock:
+                    if self._stream is not None:
+                        self._stream.flush(zlib.Z_SYNC_FLUSH)
+                continue
+            with self._lock:
+                self._write(line)
+
+    def _write_pending(self):
+        while True:
+            try:
+                self._write(self._queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _write(self, line: str):
+        if self._file_path is None:
+            return
+        try:
+            if self._stream is None:
+                self._stream = gzip.open(self._file_path, "ab")
+            elif self._max_bytes > 0 and self._stream.fileobj.tell() >= self._max_bytes:
+                self._close_stream()
+                os.replace(self._file_path, f"{self._file_path}.1")
+                self._stream = gzip.open(self._file_path, "ab")
+            self._stream.write(line.encode())
+            self.recorded += 1
+        except OSError as ex:
+            logger.warning(f"failed to write the request recording: {ex}")
+
+    def _close_stream(self):
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except OSError as ex:
+                logger.warning(f"failed to close the request recording: {ex}")
+            self._stream = None
+
+# This function reads the records of a recording in order, a record cut by a crash at the end of the file is skipped
+def read_recording(file_path: str) -> Iterator[Dict[str, Any]]:
+    with gzip.open(file_path, "rt") as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning(f"skipping a damaged record of the recording {file_path}")
+        except (EOFError, zlib.error):
+            # the stream of the last writer was not closed
+            pass
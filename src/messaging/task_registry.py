@@ -0,0 +1,187 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json, threading, time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+from messaging.mqtt_proxy import TERMINAL_STATUSES
+
+# default max number of the tasks kept in the registry and the time a finished task is kept, in seconds
+DEFAULT_MAX_ENTRIES = 500
+DEFAULT_TTL_SECONDS = 3600
+# max size of the JSON of a result kept in the registry, larger results are not kept
+MAX_RESULT_SIZE = 16384
+
+def _format_time(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp is not None else None
+
+class TaskRecord:
+    __slots__ = ("request_id", "request", "status", "start_time", "end_time", "timeline", "progress", "result", "reason")
+
+    def __init__(self, request_id: str, request: Optional[str], status: str, start_time: float):
+        self.request_id = request_id
+        self.request = request
+        self.status = status
+        self.start_time = start_time
+        self.end_time = None
+        # [(status, time)] in the order of the phases of the task
+        self.timeline = [(status, start_time)]
+        # the latest structured progress of the running task, e.g. {"bytes": .., "total": ..}
+        self.progress = None
+        self.result = None
+        self.reason = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def summary(self) -> Dict[str, Any]:
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return {
+            "request_id": self.request_id,
+            "request": self.request,
+            "status": self.status,
+            "start_time": _format_time(self.start_time),
+            "end_time": _format_time(self.end_time),
+            "duration": round(end_time - self.start_time, 3)
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        task = self.summary()
+        task["timeline"] = [{"status": status, "time": _format_time(timestamp)} for status, timestamp in self.timeline]
+        if self.progress is not None:
+            task["progress"] = self.progress
+        if self.result is not None:
+            task["result"] = self.result
+        if self.reason is not None:
+            task["reason"] = self.reason
+        return task
+
+# This class keeps the recent requests with their phase timeline and final result, so the cloud can poll the
+# status of a request instead of re-issuing it. The finished tasks are evicted after the TTL, and the least
+# recently updated tasks (finished ones first) when the registry is full.
+class TaskRegistry:
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self._max_entries = max(max_entries, 1)
+        self._ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # request_id -> TaskRecord, in the order of the last update
+        self._tasks: "OrderedDict[str, TaskRecord]" = OrderedDict()
+
+    def set_limits(self, max_entries: int, ttl_seconds: float):
+        with self._lock:
+            self._max_entries = max(max_entries, 1)
+            self._ttl_seconds = ttl_seconds
+            self._evict()
+
+    def start(self, request_id: str, request: Optional[str], status: str):
+        with self._lock:
+            self._tasks[request_id] = TaskRecord(request_id, request, status, time.time())
+            self._tasks.move_to_end(request_id)
+            self._evict()
+
+    def set_status(self, request_id: str, status: str, request: Optional[str] = None):
+        with self._lock:
+            task = self._tasks.get(request_id)
+            if task is None:
+                task = TaskRecord(request_id, request, status, time.time())
+                if task.finished:
+                    task.end_time = task.start_time
+                self._tasks[request_id] = task
+                self._evict()
+                return
+            if task.status != status and not task.finished:
+                task.status = status
+                task.timeline.append((status, time.time()))
+                # the progress belongs to the previous phase
+                task.progress = None
+                if task.finished:
+                    task.end_time = task.timeline[-1][1]
+            self._tasks.move_to_end(request_id)
+
+    # This function records a message sent for the request, the terminal status ends the task with its result
+    def record_message(self, data: Dict[str, Any]):
+        request_id = data.get("request_id")
+        status = data.get("status")
+        if request_id is None or status is None:
+            return
+        self.set_status(request_id, status, data.get("request"))
+        if status not in TERMINAL_STATUSES:
+            return
+        # the chunked results are not kept
+        result = data.get("result") if "chunk" not in data else None
+        if result is not None and len(json.dumps(result, default=str)) > MAX_RESULT_SIZE:
+            result = None
+        with self._lock:
+            task = self._tasks.get(request_id)
+            if task is not None:
+                task.result = result
+                task.reason = data.get("reason")
+
+    def set_progress(self, request_id: str, progress: Dict[str, Any]):
+        with self._lock:
+            task = self._tasks.get(request_id)
+            if task is not None and not task.finished:
+                task.progress = progress
+
+    def get_progress(self, request_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            task = self._tasks.get(request_id)
+            return task.progress if task is not None else None
+
+    def get_status(self, request_id: str) -> Optional[str]:
+        with self._lock:
+            task = self._tasks.get(request_id)
+            return task.status if task is not None else None
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._evict()
+            task = self._tasks.get(request_id)
+            return task.to_dict() if task is not None else None
+
+    def list(self, active_only: bool = False, request: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._evict()
+            tasks = []
+            # the most recently updated first
+            for task in reversed(self._tasks.values()):
+                if active_only and task.finished:
+                    continue
+                if request is not None and task.request != request:
+                    continue
+                tasks.append(task.summary())
+                if limit is not None and len(tasks) >= limit:
+                    break
+            return tasks
+
+    def _evict(self):
+        now = time.time()
+        for request_id in [request_id for request_id, task in self._tasks.items()
+                           if task.finished and now - task.end_time > self._ttl_seconds]:
+            del self._tasks[request_id]
+        while len(self._tasks) > self._max_entries:
+            request_id = next((request_id for request_id, task in self._tasks.items() if task.finished), None)
+            if request_id is None:
+                request_id = next(iter(self._tasks))
+            del self._tasks[request_id]
@@ -20,42 +20,246 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from concurrent.futures import ThreadPoolExecutor
-import threading
-from typing import Dict, Any, Optional
+import os, threading, math, time
+from typing import Dict, Any, Optional, List, Callable
+from utils.logger import get_logger
 from messaging.mqtt_proxy import MQTTProxy
+from messaging.task_registry import TaskRegistry
 
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# default tick of the status reporting and the keepalive interval of an unchanged status, in seconds
+DEFAULT_TICK_SECONDS = 2
+DEFAULT_KEEPALIVE_SECONDS = 10
+# min interval of publishing a progress-only change of a task, in seconds
+DEFAULT_PROGRESS_INTERVAL_SECONDS = 4
+
+# This class is a hashed timer wheel, the keys are placed in the slot of their due tick and the slot of the current
+# tick is expired at every advance, so scheduling, cancelling and expiring are O(1) per key
+class TimerWheel:
+    def __init__(self, slots: int = 64):
+        self._slots: List[Dict[str, int]] = [{} for _ in range(slots)]
+        # key -> slot index
+        self._positions: Dict[str, int] = {}
+        self._current = 0
+
+    def schedule(self, key: str, ticks: int):
+        self.cancel(key)
+        ticks = max(ticks, 1)
+        index = (self._current + ticks) % len(self._slots)
+        # the number of the full turns of the wheel before the key is due
+        self._slots[index][key] = (ticks - 1) // len(self._slots)
+        self._positions[key] = index
+
+    def cancel(self, key: str):
+        index = self._positions.pop(key, None)
+        if index is not None:
+            self._slots[index].pop(key, None)
+
+    # This function advances the wheel by one tick and returns the keys due at the tick
+    def advance(self) -> List[str]:
+        self._current = (self._current + 1) % len(self._slots)
+        slot = self._slots[self._current]
+        due = []
+        for key, rounds in list(slot.items()):
+            if rounds > 0:
+                slot[key] = rounds - 1
+            else:
+                del slot[key]
+                del self._positions[key]
+                due.append(key)
+        return due
+
+# This class is the stop event of a reported task, the task is removed from the reporter as soon as the event is set,
+# so no progress is published after the result of the task
+class _ReportingStopEvent(threading.Event):
+    def __init__(self, reporter: "TaskStatusReporter", request_id: str):
+        super().__init__()
+        self._reporter = reporter
+        self._request_id = request_id
+
+    def set(self):
+        super().set()
+        self._reporter._stop_reporting(self._request_id)
+
+# This class reports the status of the running tasks from a single scheduler thread, the status of a task is
+# published when it changes and as a keepalive when unchanged, the statuses of all the running tasks are sent in
+# one message per tick
 class TaskStatusReporter:
 
     _mqtt_proxy = None
-    _task_status: Dict[str, str] = None
-    _executor = None
+    _task_registry: TaskRegistry = None
     
-    def __init__(self, mqtt_proxy: MQTTProxy):
+    def __init__(self, mqtt_proxy: MQTTProxy, task_registry: Optional[TaskRegistry] = None,
+                 tick_seconds: float = DEFAULT_TICK_SECONDS, keepalive_seconds: float = DEFAULT_KEEPALIVE_SECONDS,
+                 progress_interval_seconds: float = DEFAULT_PROGRESS_INTERVAL_SECONDS):
         self._mqtt_proxy = mqtt_proxy
-        self._task_status: Dict[str, str] = {}
-        self._executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix="app-pool")
+        self._task_registry = task_registry or TaskRegistry()
+        self._tick_seconds = tick_seconds
+        self._keepalive_ticks = max(1, math.ceil(keepalive_seconds / tick_seconds))
+        self._lock = threading.Lock()
+        # held while a tick publishes, a stopped task waits for the publish in progress so no progress follows its
+        # result; the status setters only take _lock and are not held up by a slow publish
+        self._publish_lock = threading.Lock()
+        # request_id -> request of the reported tasks
+        self._reported: Dict[str, str] = {}
+        # the reported tasks whose status changed since the last publish
+        self._changed = set()
+        # the reported tasks whose progress changed since the last publish, published at most every progress interval
+        self._progress_changed = set()
+        self._progress_interval = progress_interval_seconds
+        self._last_publish = 0.0
+        self._wheel = TimerWheel()
+        self._scheduler_thread = None
+        self._stop_event = threading.Event()
+        # the ticks are driven by an external scheduler (e.g. the asyncio runtime) instead of the scheduler thread
+        self._external_scheduler = False
 
     def set_task_status(self, request_id: str, status: str):
-        self._task_status[request_id] = status
+        with self._lock:
+            if self._task_registry.get_status(request_id) != status and request_id in self._reported:
+                self._changed.add(request_id)
+            self._task_registry.set_status(request_id, status)
     
     def get_task_status(self, request_id: str) -> Optional[str]:
-        return self._task_status.get(request_id)
+        return self._task_registry.get_status(request_id)
+
+    # This function sets the structured progress of the task, it is cheap enough to be called by the producer at every
+    # step, the progress is published at the next tick after the progress interval
+    def set_task_progress(self, request_id: str, progress: Dict[str, Any]):
+        with self._lock:
+            self._task_registry.set_progress(request_id, progress)
+            if request_id in self._reported:
+                self._progress_changed.add(request_id)
+
+    # This function gets the progress callback of the task, to be passed to the producers
+    def progress_callback(self, request_id: str) -> Callable[[Dict[str, Any]], None]:
+        return lambda progress: self.set_task_progress(request_id, progress)
     
     def start_reporting(self, request_id: str, request: str, status: str) -> threading.Event:
-        self._task_status[request_id] = status
-        stop_event = threading.Event()
-        self._executor.submit(self._report_task_status_thread, stop_event, request_id, request)
-        return stop_event
-    
-    def _report_task_status_thread(self, stop_event: threading.Event, request_id: str, request: str):
-        while not stop_event.is_set():
-            status = self._task_status.get(request_id)
-            if status is not None:
-                message = {
-                    "request_id": request_id, 
-                    "request": request,
-                    "status": status
-                }
+        with self._lock:
+            self._task_registry.set_status(request_id, status, request)
+            self._reported[request_id] = request
+            self._changed.add(request_id)
+            self._start_scheduler()
+        return _ReportingStopEvent(self, request_id)
+
+    def _stop_reporting(self, request_id: str):
+        with self._publish_lock, self._lock:
+            self._reported.pop(request_id, None)
+            self._changed.discard(request_id)
+            self._progress_changed.discard(request_id)
+            self._wheel.cancel(request_id)
+
+    @property
+    def tick_seconds(self) -> float:
+        return self._tick_seconds
+
+    # This function changes the reporting intervals, the running keepalives are re-aligned at their next publish
+    def set_intervals(self, tick_seconds: float, keepalive_seconds: float, progress_interval_seconds: float):
+        with self._lock:
+            self._tick_seconds = tick_seconds
+            self._keepalive_ticks = max(1, math.ceil(keepalive_seconds / tick_seconds))
+            self._progress_interval = progress_interval_seconds
+
+    # This function disables the scheduler thread, tick() is called by the caller at every tick_seconds
+    def use_external_scheduler(self):
+        self._external_scheduler = True
+
+    def _start_scheduler(self):
+        if self._external_scheduler or self._stop_event.is_set():
+            return
+        if self._scheduler_thread is None or not self._scheduler_thread.is_alive():
+            self._scheduler_thread = threading.Thread(target=self._run_scheduler, name="task-status-reporter", daemon=True)
+            self._scheduler_thread.start()
+
+    # This function stops the scheduler thread, on the shutdown of the service
+    def stop(self):
+        self._stop_event.set()
+        if self._scheduler_thread is not None:
+            self._scheduler_thread.join(timeout=5)
+
+    def _run_scheduler(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self._tick_seconds
+            if self._stop_event.wait(max(0, next_tick - time.monotonic())):
+                return
+            try:
+                self.tick()
+            except Exception as ex:
+                logger.error(f"Error in reporting the task status: {ex}")
+
+    # This function publishes the due statuses, they are collected under the lock and published after releasing it
+    def tick(self):
+        with self._publish_lock:
+            message = self._collect_due()
+            if message is not None:
                 self._mqtt_proxy.notify_message(message)
-            stop_event.wait(2)
\ No newline at end of file
+
+    def _collect_due(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            due = set(self._wheel.advance())
+            # skip the tick when the upstream in-flight window is full, the changes are kept for the next tick
+            if not self._reported or self._mqtt_proxy.is_backpressured():
+                for request_id in due:
+                    self._wheel.schedule(request_id, 1)
+                return None
+            now = time.monotonic()
+            progress_due = self._progress_changed and now - self._last_publish >= self._progress_interval
+            if not self._changed and not due and not progress_due:
+                return None
+            # all the running tasks are sent in the message, their keepalives are re-aligned to this tick
+            tasks = []
+            for request_id in self._reported:
+                task = {
+                    "request_id": request_id,
+                    "request": self._reported[request_id],
+                    "status": self._task_registry.get_status(request_id)
+                }
+                progress = self._task_registry.get_progress(request_id)
+                if progress is not None:
+                    task["progress"] = progress
+                tasks.append(task)
+                self._wheel.schedule(request_id, self._keepalive_ticks)
+            self._changed.clear()
+            self._progress_changed.clear()
+            self._last_publish = now
+            # a single task is reported in the message format of the request, multiple tasks in one batch message
+            return tasks[0] if len(tasks) == 1 else {"status_update": "task_status", "tasks": tasks}
+
+# This class tracks the progress of a transfer (e.g. a download), the throughput is a moving average and the ETA is
+# estimated from it, the progress callback is called at most every update interval
+class TransferProgress:
+    def __init__(self, progress: Callable[[Dict[str, Any]], None], total: Optional[int] = None, update_interval: float = 1.0):
+        self._progress = progress
+        self._total = total
+        self._update_interval = update_interval
+        self._bytes = 0
+        self._throughput = None
+        self._last_bytes = 0
+        self._last_time = time.monotonic()
+
+    def add(self, count: int):
+        self._bytes += count
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        if elapsed < self._update_interval:
+            return
+        rate = (self._bytes - self._last_bytes) / elapsed
+        # exponential moving average of the throughput in bytes/second
+        self._throughput = rate if self._throughput is None else 0.3 * rate + 0.7 * self._throughput
+        self._last_bytes = self._bytes
+        self._last_time = now
+        self._progress(self.snapshot())
+
+    def snapshot(self) -> Dict[str, Any]:
+        progress = {"bytes": self._bytes, "total": self._total}
+        if self._throughput is not None:
+            progress["throughput"] = round(self._throughput)
+            if self._total and self._throughput > 0:
+                progress["eta"] = round(max(self._total - self._bytes, 0) / self._throughput, 1)
+        if self._total:
+            progress["percent"] = round(min(self._bytes * 100 / self._total, 100), 1)
+        return progress
@@ -20,31 +20,46 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os
+import os, signal
 from service.app_svc import AppManager
 from service.heart_beat import HeartBeat
-from utils.logger import get_logger
+from utils.logger import get_logger, configure_logging
 from utils.config import AppConfig
 from messaging.mqtt_manager import MQTTManager
-from messaging.message_processor import MessageProcessor
+from messaging.message_processor import MessageProcessor, IntakeQueue
+from service.async_runtime import AsyncRuntime
+from utils.metrics import start_metrics_server
 
 current_file = os.path.basename(__file__)
 logger = get_logger(current_file)
 
+# configuration fields of the broker connection, a change reconnects the client. paho takes the in-flight window
+# only before connecting, the proxy's own window applies at once
+MQTT_ENDPOINT_FIELDS = ["mqtt_host", "mqtt_port", "mqtt_protocol", "mqtt_user", "mqtt_pwd", "mqtt_device_key",
+                        "mqtt_protocol_version", "mqtt_receive_maximum", "mqtt_inflight_window"]
+
 class K3SContainerService:
     def __init__(self):
         self.config = None
         self.message_processor = None
         self.mqtt_manager = None
         self.heartbeat = None
+        self.async_runtime = None
+        self.metrics_server = None
+        self._warmed_up = False
     
     def _on_heartbeat(self):
         AppManager.report_apps_and_resources_status()
     
     def _on_connect_to_mqtt(self, client):
-        AppManager.set_mqtt_client(client)
-        self.message_processor.start()
-        self.heartbeat.start()
+        AppManager.set_mqtt_client(client, self.mqtt_manager.topic_alias_maximum)
+        if not self._warmed_up:
+            # the heavy modules and the kube config are loaded after connecting, in the background
+            self._warmed_up = True
+            AppManager.warm_up()
+        if self.async_runtime is None:
+            self.message_processor.start()
+            self.heartbeat.start()
         logger.info("Listening for the messages... (Ctrl+C to exit)")        
 
     def _on_message_from_mqtt(self, payload):
@@ -53,16 +68,84 @@ class K3SContainerService:
     def initialize(self):
         try:
             self.config = AppConfig()
+            self._configure_logging(self.config.snapshot)
             AppManager.init(self.config)
-            self.message_processor = MessageProcessor(self._on_message_from_mqtt)
+            intake_queue = IntakeQueue(self.config.intake_max_size, self.config.intake_policy,
+                                       self.config.intake_quotas, self.config.intake_read_quota)
+            self.message_processor = MessageProcessor(self._on_message_from_mqtt, AppManager.reject_request, intake_queue)
+            AppManager.set_intake_stats(self.message_processor.get_stats)
             self.mqtt_manager = MQTTManager(self.config, self.message_processor, self._on_connect_to_mqtt)
-            self.heartbeat = HeartBeat(self.config.heartbeat_frequency, self._on_heartbeat)
+            if self.config.runtime == "asyncio":
+                # MQTT I/O, request intake and timers on one event loop instead of the threads
+                self.async_runtime = AsyncRuntime(self.mqtt_manager, self.message_processor,
+                                                  self.config.async_max_concurrency, self.config.async_executor_workers)
+                self.async_runtime.add_timer(self.config.heartbeat_frequency, self._on_heartbeat)
+                task_status_reporter = AppManager.get_task_status_reporter()
+                task_status_reporter.use_external_scheduler()
+                self.async_runtime.add_timer(task_status_reporter.tick_seconds, task_status_reporter.tick, blocking=False)
+            else:
+                self.heartbeat = HeartBeat(self.config.heartbeat_frequency, self._on_heartbeat)
+            self._subscribe_config(intake_queue)
+            self._start_metrics_server()
             return True
         except Exception as ex:
             logger.error(f"initialization error: {ex}")
             return False
 
+    # This function applies the configuration changes of the service loop live, the configuration is reloaded on
+    # SIGHUP and when the file changes
+    def _subscribe_config(self, intake_queue):
+        self.config.subscribe(["log_level", "log_sample_interval", "log_max_bytes", "log_backup_count"], self._configure_logging)
+        self.config.subscribe(["heartbeat_frequency"], self._on_heartbeat_frequency_changed)
+        if self.async_runtime is not None:
+            task_status_reporter = AppManager.get_task_status_reporter()
+            self.config.subscribe(["task_status_tick"], lambda snapshot: self.async_runtime.set_timer_interval(
+                task_status_reporter.tick, snapshot.task_status_tick))
+        self.config.subscribe(["intake_max_size", "intake_policy", "intake_quotas", "intake_read_quota"],
+                              lambda snapshot: intake_queue.configure(snapshot.intake_max_size, snapshot.intake_policy,
+                                                                      snapshot.intake_quotas, snapshot.intake_read_quota))
+        self.config.subscribe(MQTT_ENDPOINT_FIELDS, self._on_mqtt_endpoint_changed)
+        self.config.subscribe(["recorder_file", "recorder_max_bytes", "recorder_redact"], self.mqtt_manager.configure_recorder)
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.config.request_reload())
+        self.config.watch()
+
+    def _start_metrics_server(self):
+        if self.config.metrics_port <= 0:
+            return
+        try:
+            self.metrics_server = start_metrics_server(self.config.metrics_host, self.config.metrics_port)
+        except OSError as ex:
+            # the service runs without the endpoint, the metrics are still summarized in the heartbeat
+            logger.error(f"failed to start the metrics endpoint: {ex}")
+
+    def _configure_logging(self, snapshot):
+        configure_logging(snapshot.log_level, snapshot.log_sample_interval, snapshot.log_max_bytes, snapshot.log_backup_count)
+
+    def _on_heartbeat_frequency_changed(self, snapshot):
+        if self.async_runtime is not None:
+            self.async_runtime.set_timer_interval(self._on_heartbeat, snapshot.heartbeat_frequency)
+        else:
+            self.heartbeat.set_frequency(snapshot.heartbeat_frequency)
+
+    def _on_mqtt_endpoint_changed(self, snapshot):
+        if self.async_runtime is not None:
+            # the client is driven by the event loop, it is disconnected from the loop thread
+            self.async_runtime.call_soon(self.mqtt_manager.apply_endpoint_change)
+        else:
+            self.mqtt_manager.apply_endpoint_change()
+
     def start(self):
+        if self.async_runtime is not None:
+            try:
+                self.async_runtime.run()
+            except KeyboardInterrupt:
+                logger.info("shutting down...")
+                self.shutdown()
+            except Exception as ex:
+                logger.error(f"runtime error: {ex}")
+                self.shutdown()
+                return 1
+            return 0
         try:
             # Connect to MQTT broaker
             if not self.mqtt_manager.connect():
@@ -82,10 +165,16 @@ class K3SContainerService:
     def shutdown(self):
         if self.mqtt_manager:
             self.mqtt_manager.disconnect()
+            self.mqtt_manager.recorder.close()
         if self.heartbeat:
             self.heartbeat.stop()
         if self.message_processor:
             self.message_processor.stop()
+        if AppManager.get_task_status_reporter():
+            AppManager.get_task_status_reporter().stop()
+        AppManager.save_status_snapshot()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
 
 def main():
     svc = K3SContainerService()
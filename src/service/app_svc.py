@@ -20,48 +20,247 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from service.k3s_helper import K3sHelper
-from kubernetes.client.exceptions import ApiException
-import os, sys, json, time, re, yaml, psutil, subprocess, traceback
-import configparser, requests
-from collections import Counter
+from service.k3s_helper import K3sHelper, APP_STATUS_FIELDS, get_api_client, kube_exceptions
+import os, sys, json, time, re, subprocess, traceback, threading, zlib, base64
+import configparser
+from collections import Counter, OrderedDict
 from utils.commons import genearte_random_string, format_k3s_api_error
-from jsonschema import validate, ValidationError
 from utils.logger import get_logger
 from utils.config import AppConfig
-from messaging.task_status_reporter import TaskStatusReporter
-from messaging.mqtt_proxy import MQTTProxy
+from messaging.task_status_reporter import TaskStatusReporter, TransferProgress
+from messaging.task_registry import TaskRegistry
+from messaging.mqtt_proxy import MQTTProxy, TERMINAL_STATUSES
+from messaging.outbox import Outbox
+from utils.cancellation import CancellationToken, RequestCancelledError, get_request_deadline
+from utils.lazy_import import LazyModule, preload, warm_up
+from utils.schema_validator import SchemaValidatorCache
+from utils.metrics import metrics, run_subprocess
+from utils.tracing import TraceExporter, start_trace, end_trace, current_trace, span
+from utils import profiler
+from service.status_snapshot import StatusSnapshot, APPS, RESOURCES, IMAGES
+
+# the heavy modules are imported on their first use, or by the warm-up after the MQTT connection
+requests = LazyModule("requests")
+psutil = LazyModule("psutil")
+
+# deployment definition schemas, in the 'deployment' directory of the home directory
+CREATE_DEPLOYMENT_SCHEMA = "create_deployment_schema.json"
+UPDATE_DEPLOYMENT_SCHEMA = "update_deployment_schema.json"
 
 current_file = os.path.basename(__file__)
 logger = get_logger(current_file)
 
+# max log lines of a container sent in one log entry of the chunked responses
+LOG_LINES_PER_ENTRY = 1000
+
+# chunk size of streaming the downloaded image file to the disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeouts of the image download, in seconds
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# max number of the cancelled requests remembered until they are dequeued
+MAX_CANCELLED_REQUESTS = 1000
+
+# file of the status snapshot loaded at the startup, in the home directory
+STATUS_SNAPSHOT_FILE = os.path.join("snapshot", "status.json.gz")
+
+REQUESTS_TOTAL = metrics.counter("requests", "Requests processed", ("request",))
+REQUEST_QUEUE_WAIT = metrics.histogram("request_queue_wait_ms", "Time the requests waited in the intake queue in milliseconds", ("request",))
+REQUEST_DURATION = metrics.histogram("request_duration_ms", "Execution time of the requests in milliseconds", ("request",))
+
+# the requests about the tasks are not kept in the task registry
+UNTRACKED_REQUESTS = frozenset(["get_task_status", "list_tasks"])
+
 class AppManager:
     
     _config = None
     _mqtt_proxy = None
     _task_status_reporter = None
+    _task_registry = None
+    # cancellation tokens of the running requests and the cancelled requests waiting in the queue
+    _cancel_tokens = {}
+    _cancelled_requests = OrderedDict()
+    _cancel_lock = threading.Lock()
+    # provider of the intake queue counters exported in the heartbeat
+    _intake_stats = None
+    # compiled validators of the deployment schemas
+    _schema_validators = None
+    # latest apps, resources and images, persisted across the restarts
+    _status_snapshot = None
+    # writer of the request traces to the local trace file
+    _trace_exporter = None
     
     @classmethod
     def init(cls, config):
         cls._config = config
-        cls._mqtt_proxy = MQTTProxy(config.upstream_topic)
-        cls._task_status_reporter = TaskStatusReporter(cls._mqtt_proxy)
+        cls._mqtt_proxy = MQTTProxy(config.upstream_topic, config.mqtt_max_message_size,
+                                    config.mqtt_encodings, config.mqtt_compress_threshold)
+        cls._mqtt_proxy.set_message_expiry({"heartbeat": config.mqtt_heartbeat_expiry, "progress": config.mqtt_progress_expiry})
+        outbox = Outbox(os.path.join(config.home_dir, "outbox"), config.outbox_max_entries, config.outbox_max_bytes)
+        cls._mqtt_proxy.set_outbox(outbox, config.outbox_drain_rate)
+        cls._mqtt_proxy.set_publish_options(config.mqtt_qos, config.mqtt_inflight_window)
+        cls._task_registry = TaskRegistry(config.task_registry_max_entries, config.task_registry_ttl)
+        cls._mqtt_proxy.add_listener(cls._record_task_message)
+        cls._mqtt_proxy.add_listener(cls._attach_timings)
+        cls._task_status_reporter = TaskStatusReporter(cls._mqtt_proxy, cls._task_registry,
+                                                       config.task_status_tick, config.task_status_keepalive,
+                                                       config.task_progress_interval)
+        cls._schema_validators = SchemaValidatorCache(os.path.join(config.home_dir, 'deployment'))
+        cls._status_snapshot = StatusSnapshot(os.path.join(config.home_dir, STATUS_SNAPSHOT_FILE),
+                                              config.snapshot_write_interval)
+        cls._trace_exporter = TraceExporter(cls._get_trace_file(config), config.trace_max_bytes)
+        cls._subscribe_config(config)
+
+    # This function applies the configuration changes of the upstream messaging and the task reporting live
+    @classmethod
+    def _subscribe_config(cls, config):
+        config.subscribe(["upstream_topic"], lambda snapshot: cls._mqtt_proxy.set_upstream_topic(snapshot.upstream_topic))
+        config.subscribe(["mqtt_heartbeat_expiry", "mqtt_progress_expiry"], lambda snapshot: cls._mqtt_proxy.set_message_expiry(
+            {"heartbeat": snapshot.mqtt_heartbeat_expiry, "progress": snapshot.mqtt_progress_expiry}))
+        config.subscribe(["mqtt_qos", "mqtt_inflight_window"], lambda snapshot: cls._mqtt_proxy.set_publish_options(
+            dict(snapshot.mqtt_qos), snapshot.mqtt_inflight_window))
+        config.subscribe(["mqtt_encodings", "mqtt_compress_threshold"], lambda snapshot: cls._mqtt_proxy.set_encodings(
+            list(snapshot.mqtt_encodings), snapshot.mqtt_compress_threshold))
+        config.subscribe(["outbox_drain_rate"], lambda snapshot: cls._mqtt_proxy.set_drain_rate(snapshot.outbox_drain_rate))
+        config.subscribe(["task_status_tick", "task_status_keepalive", "task_progress_interval"],
+                         lambda snapshot: cls._task_status_reporter.set_intervals(
+                             snapshot.task_status_tick, snapshot.task_status_keepalive, snapshot.task_progress_interval))
+        config.subscribe(["task_registry_max_entries", "task_registry_ttl"], lambda snapshot: cls._task_registry.set_limits(
+            snapshot.task_registry_max_entries, snapshot.task_registry_ttl))
+        config.subscribe(["snapshot_write_interval"], lambda snapshot: cls._status_snapshot.set_write_interval(
+            snapshot.snapshot_write_interval))
+        config.subscribe(["trace_file", "trace_max_bytes"], lambda snapshot: cls._trace_exporter.configure(
+            cls._get_trace_file(snapshot), snapshot.trace_max_bytes))
+
+    # This function gets the path of the trace file of the configuration, None when the export is disabled
+    @staticmethod
+    def _get_trace_file(config):
+        if not config.trace_file:
+            return None
+        return os.path.join(config.home_dir, config.trace_file)
     
     @classmethod
-    def set_mqtt_client(cls, mqtt_client):
-        cls._mqtt_proxy.set_client(mqtt_client)
+    def set_mqtt_client(cls, mqtt_client, topic_alias_maximum: int = 0):
+        cls._mqtt_proxy.set_client(mqtt_client, topic_alias_maximum)
+
+    # This function imports the heavy modules, loads the kube config and compiles the deployment schemas in the background,
+    # called once the MQTT connection is up so the first requests do not pay for them
+    @classmethod
+    def warm_up(cls):
+        warm_up([
+            lambda: preload(requests, psutil, kube_exceptions),
+            get_api_client,
+            lambda: cls._schema_validators.get(CREATE_DEPLOYMENT_SCHEMA),
+            lambda: cls._schema_validators.get(UPDATE_DEPLOYMENT_SCHEMA)
+        ], lambda ex: logger.warning(f"warm-up failed: {ex}"))
+
+    # This function writes the pending changes of the status snapshot, called at the shutdown
+    @classmethod
+    def save_status_snapshot(cls):
+        if cls._status_snapshot is not None:
+            cls._status_snapshot.save(force=True)
+
+    @classmethod
+    def get_task_status_reporter(cls):
+        return cls._task_status_reporter
+
+    @classmethod
+    def set_intake_stats(cls, intake_stats):
+        cls._intake_stats = intake_stats
+
+    # This function adds a listener called with every upstream message before it is sent, e.g. by the replay tool
+    @classmethod
+    def add_message_listener(cls, listener):
+        cls._mqtt_proxy.add_listener(listener)
 
     @classmethod
     def notify_message(cls, data):
        cls._mqtt_proxy.notify_message(data)
 
+    # This function keeps the status and the result of the upstream messages of the requests in the task registry
+    @classmethod
+    def _record_task_message(cls, data):
+        if data.get("request") not in UNTRACKED_REQUESTS:
+            cls._task_registry.record_message(data)
+
+    # This function attaches the timings of the request's trace to its terminal response, when the request
+    # asked for them with "trace": true
+    @classmethod
+    def _attach_timings(cls, data):
+        trace = current_trace()
+        if (trace is not None and trace.report and data.get("request_id") == trace.request_id
+                and data.get("status") in TERMINAL_STATUSES):
+            data["timings"] = trace.to_dict()
 
     # This function determines the request and call the relevant function to process the request
     @classmethod
     def process_request(cls, payload):
-        logger.info(f"Received the payload: {json.dumps(payload)}")
+        # MQTT v5 response topic and correlation data of the request
+        reply_route = payload.pop("_reply_route", None)
+        received_time = payload.pop("_received_time", None)
+        # the payload is logged with the secrets masked and the large values cut, by the logging thread
+        logger.info("Received the payload", extra={"payload": payload})
         request_id = payload.get("request_id")
         request = payload.get("request")
+        start_time = time.monotonic()
+        REQUESTS_TOTAL.inc(request=request)
+        queue_wait_ms = None
+        if received_time is not None:
+            queue_wait_ms = max(0.0, time.time() - received_time) * 1000
+            REQUEST_QUEUE_WAIT.observe(queue_wait_ms, request=request)
+        if reply_route is not None and request_id is not None:
+            cls._mqtt_proxy.register_reply_route(request_id, *reply_route)
+        # the cloud advertises the encodings it accepts for the upstream messages
+        accept_encoding = payload.get("accept_encoding")
+        if isinstance(accept_encoding, list):
+            cls._mqtt_proxy.set_accepted_encodings(accept_encoding)
+        if request_id is not None and request not in UNTRACKED_REQUESTS:
+            cls._task_registry.start(request_id, request, "Received")
+        if request_id is None or request == "cancel_request":
+            cls._dispatch_request(request, payload)
+            REQUEST_DURATION.observe((time.monotonic() - start_time) * 1000, request=request)
+            return
+        if request == "profile":
+            # the profile samples the other threads for a while, it does not hold the request worker meanwhile
+            threading.Thread(target=cls._run_request, args=(request_id, request, payload, received_time, queue_wait_ms, start_time),
+                             name=f"profile-{request_id}", daemon=True).start()
+            return
+        cls._run_request(request_id, request, payload, received_time, queue_wait_ms, start_time)
+
+    # This function processes the tracked request with its cancellation token and its trace
+    @classmethod
+    def _run_request(cls, request_id, request, payload, received_time, queue_wait_ms, start_time):
+        # the request is traced when it asks for the timings in its response or when the traces are exported
+        trace_requested = payload.get("trace") is True
+        if trace_requested or cls._trace_exporter.enabled:
+            start_trace(request_id, request, trace_requested, queue_wait_ms)
+        try:
+            cancel_token = cls._start_request(request_id, payload, received_time)
+            # the request cancelled or expired while waiting in the queue is dropped without doing the work
+            cancel_token.check()
+            cls._dispatch_request(request, payload)
+        except Exception as ex:
+            cls._handle_generic_error(request_id, request, ex)
+        finally:
+            cls._end_request(request_id)
+            REQUEST_DURATION.observe((time.monotonic() - start_time) * 1000, request=request)
+            trace = end_trace()
+            if trace is not None and cls._trace_exporter.enabled:
+                cls._trace_exporter.export(trace)
+
+    # This function answers the request shed by the overloaded intake queue
+    @classmethod
+    def reject_request(cls, payload):
+        reply_route = payload.pop("_reply_route", None)
+        request_id = payload.get("request_id")
+        if request_id is None:
+            return
+        if reply_route is not None:
+            cls._mqtt_proxy.register_reply_route(request_id, *reply_route)
+        cls.notify_message({"request_id": request_id, "request": payload.get("request"), "status": "Rejected", "reason": "overloaded"})
+
+    @classmethod
+    def _dispatch_request(cls, request, payload):
         match request:
             case "import_image":
                 cls.import_image(payload)
@@ -105,6 +304,18 @@ class AppManager:
             case "delete_all_apps_and_images":
                 cls.delete_all_apps_and_images(payload)
                 return
+            case "get_task_status":
+                cls.get_task_status(payload)
+                return
+            case "list_tasks":
+                cls.list_tasks(payload)
+                return
+            case "cancel_request":
+                cls.cancel_request(payload)
+                return
+            case "profile":
+                cls.profile(payload)
+                return
             case "get_ssh_public_key":
                 cls.get_ssh_public_key(payload)
                 return
@@ -133,6 +344,8 @@ class AppManager:
         
         # event object to control the status reporting thread
         stop_event = None
+        cancel_token = cls._get_cancel_token(request_id)
+        local_image_file = None
         
         try:
             random_string = genearte_random_string()
@@ -140,51 +353,74 @@ class AppManager:
             
             stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Downloading")
 
-            # start downloading the image file
+            # start downloading the image file, streamed to the file with the download progress reported
             logger.info(f"Downloading the image file")
-            response = requests.get(image_download_url, auth=(auth_user, auth_password))
-            status_code = response.status_code
-            if status_code == 200:
-                #print(f"writing to {local_image_file}")
-                with open(local_image_file, "wb") as f:
-                    f.write(response.content)
-                logger.info("Image file downloaded successfully.")
-            else:
-                error = f"failed to downloaded the file!, error code: {status_code}"
-                raise RuntimeError(error)
+            with span("download"), requests.get(image_download_url, auth=(auth_user, auth_password), stream=True,
+                                                timeout=DOWNLOAD_TIMEOUT) as response:
+                status_code = response.status_code
+                if status_code == 200:
+                    content_length = response.headers.get("Content-Length")
+                    download_progress = TransferProgress(cls._task_status_reporter.progress_callback(request_id),
+                                                         int(content_length) if content_length else None)
+                    with open(local_image_file, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            # stop the download as soon as the request is cancelled
+                            cancel_token.check()
+                            f.write(chunk)
+                            download_progress.add(len(chunk))
+                    cls._task_status_reporter.set_task_progress(request_id, download_progress.snapshot())
+                    logger.info("Image file downloaded successfully.")
+                else:
+                    error = f"failed to downloaded the file!, error code: {status_code}"
+                    raise RuntimeError(error)
 
             cls._task_status_reporter.set_task_status(request_id, "Importing")
 
-            k3s = K3sHelper()
+            k3s = K3sHelper(cancel_token)
             logger.info(f"Importing the image file into k3 cluster")
-            k3s.import_image(local_image_file)
-            os.remove(local_image_file)
+            with span("import"):
+                k3s.import_image(local_image_file)
+                os.remove(local_image_file)
 
             # stop the status reporting thread
             stop_event.set()
             
-            images_list = k3s.get_imported_images()
+            with span("list_images"):
+                images_list = k3s.get_imported_images()
+            cls._status_snapshot.update(IMAGES, images_list)
             cls.notify_message({"request_id":request_id, "request": "import_image", "status": "Completed", "result": images_list})
             logger.info(f"Completed the request 'import_image'")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
         finally:
             if stop_event is not None:
                 stop_event.set()
+            # remove the partially downloaded file of a failed/cancelled request
+            if local_image_file is not None and os.path.exists(local_image_file):
+                os.remove(local_image_file)
                 
     # This function gets the list of imported image names
     @classmethod
     def get_imported_images(cls, payload):
         logger.info("Processing the request 'get_imported_images'")
+        request = "get_imported_images"
         # check the necessary parameters are specified in the request
         request_id = payload.get("request_id")
         if request_id is None:
             return        
         try:
+            # answer from the snapshot of the previous run until the image list has been read in this run
+            images_list, stale = cls._status_snapshot.get(IMAGES)
+            if images_list is not None and stale:
+                result = {"images": images_list, "stale": True, "snapshot_time": cls._status_snapshot.get_time(IMAGES)}
+                cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": result})
+                logger.info(f"Completed the request '{request}' from the snapshot")
+                return
             k3s = K3sHelper()
             images_list = k3s.get_imported_images()
+            cls._status_snapshot.update(IMAGES, images_list)
             cls.notify_message({"request_id":request_id, "request": "get_imported_images", "status": "Completed", "result": {"images": images_list}})
             logger.info(f"Completed the request 'get_imported_images'")
         except Exception as ex:
@@ -209,17 +445,11 @@ class AppManager:
                 error = "deployment_definition is not specified in the request!"
                 raise RuntimeError(error)
 
-            deployment_schema_file = os.path.join(cls._config.home_dir, 'deployment', 'create_deployment_schema.json')
-            
-            # load the deployment schema
-            with open(deployment_schema_file, "r") as file:
-                deployment_schema = json.load(file)
-
-            # validate the deployment definition
-            try:
-                validate(instance=deployment_definition, schema=deployment_schema)
-            except ValidationError as ex:
-                error = f"create deployment validation has failed, {ex.message}"
+            # validate the deployment definition, all the errors are reported at once
+            with span("validate"):
+                errors = cls._schema_validators.validate(CREATE_DEPLOYMENT_SCHEMA, deployment_definition)
+            if errors:
+                error = f"create deployment validation has failed, {'; '.join(errors)}"
                 raise RuntimeError(error)
 
             deployment_name = deployment_definition.get("metadata", {}).get("name")
@@ -227,17 +457,19 @@ class AppManager:
             
             stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Deploying")
             
-            k3s = K3sHelper()
-            if namespace != "default":
-                k3s.create_namespace(namespace)
+            k3s = K3sHelper(cls._get_cancel_token(request_id))
+            with span("deploy"):
+                if namespace != "default":
+                    k3s.create_namespace(namespace)
 
-            # initiate the deployment
-            k3s.deploy_app(deployment_definition)
+                # initiate the deployment
+                k3s.deploy_app(deployment_definition, cls._task_status_reporter.progress_callback(request_id))
             
             # stop the status reporting thread
             stop_event.set()
             
-            app = k3s.get_app_status(deployment_name, namespace)
+            with span("app_status"):
+                app = k3s.get_app_status(deployment_name, namespace)
             # determine the operation status based on app's status
             app_status = app.get("status")
             if app_status == "Healthy":
@@ -246,7 +478,7 @@ class AppManager:
                 status = "Failed"
             cls.notify_message({"request_id":request_id, "request": "deploy_app", "status": status, "result": app})
             logger.info(f"Completed the request 'deploy_app'")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -281,7 +513,7 @@ class AppManager:
         try:
             stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Starting")
             
-            k3s = K3sHelper()
+            k3s = K3sHelper(cls._get_cancel_token(request_id))
             app = k3s.get_app_status(app_name, namespace)
             if app is None:
                 error = "application not found in the system"
@@ -290,7 +522,7 @@ class AppManager:
                 # Deployment is found. If the app is stopped, then scale it up
                 app_status = app.get("status")
                 if app_status == "Stopped":
-                    k3s.scale_patch_app(app_name, namespace, replicas)
+                    k3s.scale_patch_app(app_name, namespace, replicas, cls._task_status_reporter.progress_callback(request_id))
         
             # stop the reporting thread
             stop_event.set()
@@ -304,7 +536,7 @@ class AppManager:
                 status = "Failed"            
             cls.notify_message({"request_id":request_id, "request": request, "status": status, "result": app})
             logger.info(f"Completed the request 'start_app'")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -331,7 +563,7 @@ class AppManager:
         stop_event = None
         
         try:
-            k3s = K3sHelper()
+            k3s = K3sHelper(cls._get_cancel_token(request_id))
             app = k3s.get_app_status(app_name, namespace)
             # if the deployment is found and running, the scale down the replicas to 0, to stop it
             if app is not None:
@@ -339,7 +571,7 @@ class AppManager:
                 if app_status != "Stopped":
                     # proceed to stop the app
                     stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Stopping")
-                    k3s.scale_patch_app(app_name, namespace, 0)
+                    k3s.scale_patch_app(app_name, namespace, 0, cls._task_status_reporter.progress_callback(request_id))
             else:
                 error = "The specified app is not found"
                 raise RuntimeError(error)
@@ -351,7 +583,7 @@ class AppManager:
             app = k3s.get_app_status(app_name, namespace)
             cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": app})
             logger.info(f"Completed the request 'stop_app'")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
            cls._handle_generic_error(request_id, request, ex)
@@ -376,15 +608,16 @@ class AppManager:
             cls.notify_message({"request_id":request_id, "request": request, "status": "Failed", "reason": error})
             return        
         try:
+            fields, _, _ = cls._get_status_filters(payload)
             k3s = K3sHelper()
-            app = k3s.get_app_status(app_name, namespace)
+            app = k3s.get_app_status(app_name, namespace, fields)
             if app:
                 cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": app})
                 logger.info(f"Completed the request 'get_app_status'")
             else:
                 cls.notify_message({"request_id":request_id, "request": request, "status": "Failed", "reason": "specified app not found in the system"})
                 logger.error(f"specified app/image is not found in the device")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -396,16 +629,28 @@ class AppManager:
         request = "get_apps_and_resources_status"
         request_id = payload.get("request_id")
         try:
+            fields, namespaces, label_selector = cls._get_status_filters(payload)
+            page_size = cls._get_page_size(payload)
+            if fields is None and namespaces is None and label_selector is None and cls._answer_from_snapshot(request_id, request, page_size):
+                return
             k3s = K3sHelper()
-            apps = k3s.get_apps_status()
+            if page_size:
+                # stream the apps in chunks, the resources and app counts are sent with the final chunk
+                apps_status = []
+                def iter_apps():
+                    for app in k3s.iter_apps_status(namespaces, label_selector, fields, page_size):
+                        apps_status.append(app.get("status"))
+                        yield app
+                def final_result():
+                    return {"resources": cls.get_resources_status(), "app_counts": cls._get_app_counts(apps_status)}
+                message = {"request_id":request_id, "request": request, "status": "Completed"}
+                cls._mqtt_proxy.notify_chunks(message, iter_apps(), "apps", page_size, final_result)
+                logger.info(f"Completed the request '{request}'")
+                return
+
+            apps = k3s.get_apps_status(namespaces, label_selector, fields)
             resources = cls.get_resources_status()
-            apps_status = [app["status"] for app in apps]
-            apps_status_counts = Counter(apps_status)
-            app_counts = {
-                "total": len(apps_status)
-            }
-            for status, count in apps_status_counts.items():
-                app_counts[status] = count
+            app_counts = cls._get_app_counts([app.get("status") for app in apps])
             
             result = {
                 "apps": apps,
@@ -414,11 +659,35 @@ class AppManager:
             }
             cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": result})
             logger.info(f"Completed the request '{request}'")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
 
+    # This function answers the unfiltered apps and resources status from the snapshot of the previous run with
+    # 'stale': true, until the apps' status has been computed live in this run. Returns False if not answered.
+    @classmethod
+    def _answer_from_snapshot(cls, request_id, request, page_size):
+        apps, stale = cls._status_snapshot.get(APPS)
+        if apps is None or not stale:
+            return False
+        resources, _ = cls._status_snapshot.get(RESOURCES)
+        result = {
+            "resources": resources,
+            "app_counts": cls._get_app_counts([app.get("status") for app in apps]),
+            "stale": True,
+            "snapshot_time": cls._status_snapshot.get_time(APPS)
+        }
+        message = {"request_id":request_id, "request": request, "status": "Completed"}
+        if page_size:
+            cls._mqtt_proxy.notify_chunks(message, iter(apps), "apps", page_size, lambda: result)
+        else:
+            result["apps"] = apps
+            message["result"] = result
+            cls.notify_message(message)
+        logger.info(f"Completed the request '{request}' from the snapshot")
+        return True
+
     # This function updates the spec of the deployed app
     @classmethod
     def update_app(cls, payload):
@@ -438,23 +707,18 @@ class AppManager:
                 error = "deployment_definition is not specified in the request!"
                 raise RuntimeError(error)
             
-            # load the deployment_schema
-            deployment_schema_file = os.path.join(cls._config.home_dir, 'deployment', 'update_deployment_schema.json')
-            with open(deployment_schema_file, "r") as file:
-                deployment_schema = json.load(file)
-            
-            # validate the deployment definition
-            try:
-                validate(instance=deployment_definition, schema=deployment_schema)
-            except ValidationError as ex:
-                error = f"update deployment schema validation has failed, {ex.message}"
+            # validate the deployment definition, all the errors are reported at once
+            with span("validate"):
+                errors = cls._schema_validators.validate(UPDATE_DEPLOYMENT_SCHEMA, deployment_definition)
+            if errors:
+                error = f"update deployment schema validation has failed, {'; '.join(errors)}"
                 raise RuntimeError(error)
 
             deployment_name = deployment_definition.get("metadata").get("name")
             namespace = deployment_definition.get("metadata").get("namespace", "default")
             
             # check whether the deployment exists
-            k3s = K3sHelper()
+            k3s = K3sHelper(cls._get_cancel_token(request_id))
             deployment = k3s.get_deployment(deployment_name, namespace)
             if deployment is None:
                 error = "deployment not found!"
@@ -473,7 +737,7 @@ class AppManager:
             stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Updating")
 
             # update the deployment spec
-            k3s.update_app(deployment_name, namespace, spec)
+            k3s.update_app(deployment_name, namespace, spec, cls._task_status_reporter.progress_callback(request_id))
 
             # stop the status reporting thread
             stop_event.set()
@@ -487,7 +751,7 @@ class AppManager:
                 status = "Failed"
             cls.notify_message({"request_id":request_id, "request": request, "status": status, "result": app})
             logger.info(f"Completed the request '{request}'")            
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -528,8 +792,8 @@ class AppManager:
             stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Patching")
 
             # patch the scale value to the deployment
-            k3s = K3sHelper()   
-            k3s.scale_patch_app(app_name, namespace, replicas)
+            k3s = K3sHelper(cls._get_cancel_token(request_id))   
+            k3s.scale_patch_app(app_name, namespace, replicas, cls._task_status_reporter.progress_callback(request_id))
             app = {}
             try:
                 app = k3s.get_app_status(app_name, namespace)
@@ -541,7 +805,7 @@ class AppManager:
 
             cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": app})
             logger.info(f"Completed the request 'get_apps_status'")             
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -577,8 +841,9 @@ class AppManager:
             stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Patching")
             
             # patch the scale value to the deployment
-            k3s = K3sHelper()
-            k3s.image_patch_app(app_name, namespace, container_name, new_image, image_pull_policy)
+            k3s = K3sHelper(cls._get_cancel_token(request_id))
+            k3s.image_patch_app(app_name, namespace, container_name, new_image, image_pull_policy,
+                                cls._task_status_reporter.progress_callback(request_id))
             app = {}
             try:
                 app = k3s.get_app_status(app_name, namespace)
@@ -590,7 +855,7 @@ class AppManager:
 
             cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": app})
             logger.info(f"Completed the request 'image_patch_app'")             
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -618,7 +883,19 @@ class AppManager:
         previous_logs = payload.get("previous_logs", False)
 
         try:
+            page_size = cls._get_page_size(payload)
             k3s = K3sHelper()
+            if page_size:
+                # stream the log entries in chunks, the app status is sent with the final chunk
+                app = k3s.get_app_status(app_name, namespace)
+                if app is None:
+                    raise RuntimeError("app not found")
+                logs = k3s.iter_app_logs(app_name, namespace, tail_n_lines, previous_logs, LOG_LINES_PER_ENTRY)
+                message = {"request_id":request_id, "request": request, "status": "Completed"}
+                cls._mqtt_proxy.notify_chunks(message, logs, "logs", page_size, lambda: app)
+                logger.info(f"Completed the request 'get_app_status_and_logs'")
+                return
+
             app = k3s.get_app_status_and_logs(app_name, namespace, tail_n_lines, previous_logs)
             if app:
                 cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": app})
@@ -627,7 +904,7 @@ class AppManager:
                 error = "specified app is not found in the system"
                 cls.notify_message({"request_id":request_id, "request": request, "status": "Failed", "reason": error})
                 logger.error(error)                
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -651,13 +928,13 @@ class AppManager:
             return    
         try:
 
-            k3s = K3sHelper()
+            k3s = K3sHelper(cls._get_cancel_token(request_id))
             app = k3s.delete_app(app_name, namespace)
  
             cls.notify_message({"request_id":request_id, "request": request, "status": "Completed"})
             logger.info(f"Completed the request 'delete_app'")
  
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -677,7 +954,7 @@ class AppManager:
             k3s.delete_image(image, False)
             cls.notify_message({"request_id":request_id, "request": request, "status": "Completed"})
             logger.info(f"Completed the request 'delete_image'")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -699,15 +976,15 @@ class AppManager:
         try:
             stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Deleting")
             
-            k3s = K3sHelper()
-            k3s.delete_all_apps_and_images()
+            k3s = K3sHelper(cls._get_cancel_token(request_id))
+            k3s.delete_all_apps_and_images(cls._task_status_reporter.progress_callback(request_id))
 
             # stop the status reporting thread
             stop_event.set()
 
             cls.notify_message({"request_id":request_id, "request": request, "status": "Completed"})
             logger.info(f"Completed the request '{request}'")
-        except ApiException as ex:
+        except kube_exceptions.ApiException as ex:
             cls._handle_api_error(request_id, request, ex)
         except Exception as ex:
             cls._handle_generic_error(request_id, request, ex)
@@ -758,33 +1035,171 @@ class AppManager:
     # This function is called periodically in a timer thread, keeps reporting all the apps' status with CPU and Memory usage metrics
     @classmethod
     def report_apps_and_resources_status(cls):
-        logger.info(f"Processing 'report_apps_and_resources_status'")
+        logger.info(f"Processing 'report_apps_and_resources_status'", extra={"sample": "heartbeat"})
+        if cls._mqtt_proxy.is_backpressured():
+            # the upstream link is congested, skip this heartbeat instead of piling up the messages
+            logger.warning("upstream in-flight window is full, skipping the heartbeat")
+            return
         try:
             pwd = os.getcwd()
             username = pwd.split("/")[2]
         
+            if not cls._status_snapshot.is_synced(APPS):
+                # the first heartbeats after a restart are sent from the snapshot until the live status is computed
+                cls._report_status_snapshot(username)
             k3s = K3sHelper()
             apps = k3s.get_apps_status()
             resources = cls.get_resources_status()
-            apps_status = [app["status"] for app in apps]
-            apps_status_counts = Counter(apps_status)
-            app_counts = {
-                "total": len(apps_status)
-            }
-            for status, count in apps_status_counts.items():
-                app_counts[status] = count
+            app_counts = cls._get_app_counts([app["status"] for app in apps])
+            cls._status_snapshot.update(APPS, apps)
+            cls._status_snapshot.update(RESOURCES, resources)
+            if not cls._status_snapshot.is_synced(IMAGES):
+                cls._sync_images_snapshot(k3s)
             
             status = {
                 "username": username,
                 "apps": apps,
                 "resources": resources,
-                "app_counts": app_counts
+                "app_counts": app_counts,
+                "publish": cls._mqtt_proxy.get_publish_stats()
             }
+            if cls._intake_stats is not None:
+                status["intake"] = cls._intake_stats()
+            status["metrics"] = metrics.summary()
             cls.notify_message({"status_update":"apps_and_resources_status", "status": status})
         except Exception as ex:
             error = str(ex)
             logger.error(error)
 
+    # This function reads the image list once after the startup so the snapshot's image inventory gets refreshed
+    # even if no image request comes
+    @classmethod
+    def _sync_images_snapshot(cls, k3s):
+        try:
+            cls._status_snapshot.update(IMAGES, k3s.get_imported_images())
+        except Exception as ex:
+            logger.warning(f"failed to read the imported images: {ex}")
+
+    @classmethod
+    def _report_status_snapshot(cls, username):
+        apps, _ = cls._status_snapshot.get(APPS)
+        resources, _ = cls._status_snapshot.get(RESOURCES)
+        if apps is None:
+            return
+        status = {
+            "username": username,
+            "apps": apps,
+            "resources": resources,
+            "app_counts": cls._get_app_counts([app["status"] for app in apps]),
+            "stale": True,
+            "snapshot_time": cls._status_snapshot.get_time(APPS)
+        }
+        cls.notify_message({"status_update":"apps_and_resources_status", "status": status})
+
+    # This function gets the status, phase timeline and result of a recent request from the task registry
+    @classmethod
+    def get_task_status(cls, payload):
+        logger.info(f"Processing the request 'get_task_status'")
+        request = "get_task_status"
+        request_id = payload.get("request_id")
+        if request_id is None:
+            return
+        task_request_id = payload.get("task_request_id")
+        if task_request_id is None:
+            error = "task_request_id is not specified in the request"
+            logger.error(error)
+            cls.notify_message({"request_id":request_id, "request": request, "status": "Failed", "reason": error})
+            return
+        task = cls._task_registry.get(task_request_id)
+        if task:
+            cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": task})
+            logger.info(f"Completed the request 'get_task_status'")
+        else:
+            cls.notify_message({"request_id":request_id, "request": request, "status": "Failed", "reason": "specified task not found in the registry"})
+            logger.error(f"specified task is not found in the registry")
+
+    # This function cancels a queued or running request, the queued request is dropped when it is dequeued and the
+    # running one stops at its next cancellation check, both are reported with the 'Cancelled' status
+    @classmethod
+    def cancel_request(cls, payload):
+        logger.info(f"Processing the request 'cancel_request'")
+        request = "cancel_request"
+        request_id = payload.get("request_id")
+        if request_id is None:
+            return
+        task_request_id = payload.get("task_request_id")
+        if task_request_id is None:
+            error = "task_request_id is not specified in the request"
+            logger.error(error)
+            cls.notify_message({"request_id":request_id, "request": request, "status": "Failed", "reason": error})
+            return
+        if cls._task_registry.get_status(task_request_id) in TERMINAL_STATUSES:
+            cls.notify_message({"request_id":request_id, "request": request, "status": "Failed", "reason": "specified request is already finished"})
+            return
+        with cls._cancel_lock:
+            cancel_token = cls._cancel_tokens.get(task_request_id)
+            if cancel_token is not None:
+                cancel_token.cancel()
+                state = "cancelling"
+            else:
+                # not started yet, remember it until it is dequeued
+                cls._cancelled_requests[task_request_id] = True
+                while len(cls._cancelled_requests) > MAX_CANCELLED_REQUESTS:
+                    cls._cancelled_requests.popitem(last=False)
+                state = "cancelled"
+        cls.notify_message({"request_id":request_id, "request": request, "status": "Completed",
+                            "result": {"task_request_id": task_request_id, "state": state}})
+        logger.info(f"Completed the request 'cancel_request'")
+
+    # This function lists the recent requests from the task registry, the most recently updated first
+    @classmethod
+    def list_tasks(cls, payload):
+        logger.info(f"Processing the request 'list_tasks'")
+        request = "list_tasks"
+        request_id = payload.get("request_id")
+        if request_id is None:
+            return
+        try:
+            active_only = bool(payload.get("active_only", False))
+            limit = payload.get("limit")
+            limit = int(limit) if limit is not None else None
+            tasks = cls._task_registry.list(active_only, payload.get("task_request"), limit)
+            cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": {"tasks": tasks}})
+            logger.info(f"Completed the request 'list_tasks'")
+        except Exception as ex:
+            cls._handle_generic_error(request_id, request, ex)
+
+    # This function profiles the live process for the requested seconds, the top stacks sampled on the CPU and
+    # optionally the top growing allocation sites (tracemalloc) are returned. The report is compressed unless the
+    # upstream encoding already compresses the messages.
+    @classmethod
+    def profile(cls, payload):
+        logger.info(f"Processing the request 'profile'")
+        request = "profile"
+        request_id = payload.get("request_id")
+        if request_id is None:
+            return
+        stop_event = None
+        try:
+            stop_event = cls._task_status_reporter.start_reporting(request_id, request, "Profiling")
+            report = profiler.profile(duration=float(payload.get("duration", profiler.DEFAULT_DURATION)),
+                                      interval=float(payload.get("interval_ms", profiler.DEFAULT_INTERVAL * 1000)) / 1000,
+                                      top=int(payload.get("top", profiler.DEFAULT_TOP)),
+                                      memory=payload.get("memory") is True,
+                                      cpu_only=payload.get("cpu_only", True) is not False,
+                                      wait=cls._get_cancel_token(request_id).wait)
+            stop_event.set()
+            if "zlib" not in cls._mqtt_proxy.encoding:
+                data = zlib.compress(json.dumps(report, separators=(",", ":")).encode(), 9)
+                report = {"encoding": "zlib+base64", "data": base64.b64encode(data).decode()}
+            cls.notify_message({"request_id":request_id, "request": request, "status": "Completed", "result": report})
+            logger.info(f"Completed the request 'profile'")
+        except Exception as ex:
+            cls._handle_generic_error(request_id, request, ex)
+        finally:
+            if stop_event is not None:
+                stop_event.set()
+
     @classmethod
     def get_ssh_public_key(cls, payload):
         logger.info(f"Processing the request 'get_ssh_public_key'")
@@ -828,14 +1243,14 @@ class AppManager:
 
             request_start_time = int(time.time())
 
-            result = subprocess.run(
+            result = run_subprocess(
                 ['sudo', 'systemctl', 'stop', service_name],
                 capture_output=True,
                 text=True,
                 check=True
             )
 
-            result = subprocess.run(
+            result = run_subprocess(
                 ['sudo', 'systemctl', 'start', service_name],
                 capture_output=True,
                 text=True,
@@ -888,7 +1303,7 @@ class AppManager:
             return
         service_name = 'quarkifi-stream-ssh-tunnel'
         try:
-            result = subprocess.run(
+            result = run_subprocess(
                 ['sudo', 'systemctl', 'stop', service_name],
                 capture_output=True,
                 text=True,
@@ -900,6 +1315,62 @@ class AppManager:
             logger.error(f"Failed to stop the service {service_name}: {ex.stderr}")
             cls._handle_generic_error(request_id, request, ex)
 
+    # This function creates the cancellation token of the request with its deadline ('deadline'/'ttl' fields)
+    @classmethod
+    def _start_request(cls, request_id, payload, received_time):
+        cancel_token = CancellationToken(get_request_deadline(payload, received_time))
+        with cls._cancel_lock:
+            if cls._cancelled_requests.pop(request_id, None):
+                cancel_token.cancel()
+            cls._cancel_tokens[request_id] = cancel_token
+        return cancel_token
+
+    @classmethod
+    def _end_request(cls, request_id):
+        with cls._cancel_lock:
+            cls._cancel_tokens.pop(request_id, None)
+
+    @classmethod
+    def _get_cancel_token(cls, request_id):
+        with cls._cancel_lock:
+            cancel_token = cls._cancel_tokens.get(request_id)
+        return cancel_token if cancel_token is not None else CancellationToken()
+
+    # This function gets the optional 'page_size' of the request, when specified the result is sent in chunks
+    @classmethod
+    def _get_page_size(cls, payload):
+        page_size = payload.get("page_size")
+        if page_size is not None and (not isinstance(page_size, int) or page_size <= 0):
+            raise RuntimeError("page_size should be a positive integer")
+        return page_size
+
+    @classmethod
+    def _get_app_counts(cls, apps_status):
+        apps_status_counts = Counter([status for status in apps_status if status is not None])
+        app_counts = {
+            "total": len(apps_status)
+        }
+        for status, count in apps_status_counts.items():
+            app_counts[status] = count
+        return app_counts
+
+    # This function gets the optional filters of the status queries, 'fields' (projection of the app status fields),
+    # 'namespaces' and 'label_selector'
+    @classmethod
+    def _get_status_filters(cls, payload):
+        fields = payload.get("fields")
+        if fields is not None:
+            if not isinstance(fields, list) or not set(fields).issubset(APP_STATUS_FIELDS):
+                raise RuntimeError(f"fields is not valid, supported fields: {', '.join(sorted(APP_STATUS_FIELDS))}")
+        namespaces = payload.get("namespaces")
+        if namespaces is not None:
+            if not isinstance(namespaces, list) or not all(isinstance(namespace, str) for namespace in namespaces):
+                raise RuntimeError("namespaces should be a list of namespace names")
+        label_selector = payload.get("label_selector")
+        if label_selector is not None and not isinstance(label_selector, str):
+            raise RuntimeError("label_selector should be a string")
+        return fields, namespaces, label_selector
+
     @classmethod
     def _handle_error(cls, request_id: str, request: str, error: str):
         logger.error(f"request: {request}, request_id: {request_id}, error: {error}")
@@ -911,11 +1382,15 @@ class AppManager:
         })
     
     @classmethod
-    def _handle_api_error(cls, request_id: str, request: str, ex: ApiException):
+    def _handle_api_error(cls, request_id: str, request: str, ex: "kube_exceptions.ApiException"):
         error = format_k3s_api_error(ex)
         cls._handle_error(request_id, request, error)
     
     @classmethod
     def _handle_generic_error(cls, request_id: str, request: str, ex: Exception):
+        if isinstance(ex, RequestCancelledError):
+            logger.info(f"request: {request}, request_id: {request_id}, {ex.status}: {ex}")
+            cls._mqtt_proxy.notify_message({"request_id": request_id, "request": request, "status": ex.status, "reason": str(ex)})
+            return
         error = str(ex)
         cls._handle_error(request_id, request, error)            
@@ -0,0 +1,275 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, asyncio, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+import paho.mqtt.client as mqtt
+from utils.logger import get_logger
+from messaging.message_processor import IDEMPOTENT_REQUESTS, IntakeQueue
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# interval of the paho housekeeping (keepalive pings, retries) and the reconnection backoff limits, in seconds
+MQTT_MISC_INTERVAL = 1
+MIN_RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 120
+# longest sleep of a timer before its interval is re-read, in seconds
+MAX_TIMER_SLEEP = 1
+# max wait for the DISCONNECT to be written and the socket closed at the shutdown, in seconds
+DISCONNECT_TIMEOUT = 2
+
+# This class drives the paho client's network I/O from the asyncio event loop through the socket callbacks of paho,
+# the callbacks can be called from any thread (e.g. publish from an executor thread), so they are handed over to
+# the event loop thread. The callbacks on the event loop thread run right away, paho closes the socket right after
+# calling on_socket_close.
+class AsyncMQTTLoop:
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_read_error: Optional[Callable] = None):
+        self._loop = loop
+        # called with the client and the exception of a failed read, returns False if the exception is not handled
+        self._on_read_error = on_read_error
+        # created on the event loop thread
+        self._loop_thread = threading.get_ident()
+        self._misc_task = None
+
+    def _call(self, callback: Callable, *args):
+        # the client can still be used after the runtime stopped, e.g. by the shutdown of the service
+        if self._loop.is_closed():
+            return
+        if threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def attach(self, client: mqtt.Client):
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def detach(self, client: mqtt.Client):
+        client.on_socket_open = None
+        client.on_socket_close = None
+        client.on_socket_register_write = None
+        client.on_socket_unregister_write = None
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._open, client, sock)
+
+    def _open(self, client, sock):
+        self._loop.add_reader(sock, self._read, client)
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self._loop.create_task(self._misc_loop(client))
+
+    def _read(self, client: mqtt.Client):
+        try:
+            client.loop_read()
+        except Exception as ex:
+            if self._on_read_error is None or not self._on_read_error(client, ex):
+                raise
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._close, sock)
+
+    def _close(self, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._loop.remove_writer, sock)
+
+    async def _misc_loop(self, client: mqtt.Client):
+        while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(MQTT_MISC_INTERVAL)
+
+# This class consumes the intake queue on the event loop, the blocking handlers run in the executor. The idempotent
+# reads run concurrently up to max_concurrency, the other requests run one at a time in the order of arrival, as in
+# the threaded runtime. A request is taken from the queue only when a slot of its kind is free, the waiting requests
+# stay in the bounded intake queue where its limits and shedding apply.
+class AsyncRequestRunner:
+    def __init__(self, intake_queue: IntakeQueue, on_message_callback: Callable, max_concurrency: int = 4):
+        self._intake_queue = intake_queue
+        self._on_message_callback = on_message_callback
+        self._max_concurrency = max(max_concurrency, 1)
+        self._loop = None
+        self._wakeup = None
+        self._read_semaphore = None
+        self._write_semaphore = None
+        self._tasks = set()
+
+    # This function wakes up the consumer, can be called from any thread
+    def notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._read_semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._write_semaphore = asyncio.Semaphore(1)
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                head = self._intake_queue.peek()
+                if head is None:
+                    break
+                semaphore = self._semaphore(head)
+                await semaphore.acquire()
+                # the head can be shed or replaced while waiting for the slot
+                payload = self._intake_queue.get_if(lambda queued: self._semaphore(queued) is semaphore)
+                if payload is None:
+                    semaphore.release()
+                    continue
+                task = asyncio.create_task(self._handle(payload, semaphore))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    def _semaphore(self, payload) -> asyncio.Semaphore:
+        request = payload.get("request") if isinstance(payload, dict) else None
+        return self._read_semaphore if request in IDEMPOTENT_REQUESTS else self._write_semaphore
+
+    async def _handle(self, payload, semaphore: asyncio.Semaphore):
+        try:
+            await self._loop.run_in_executor(None, self._on_message_callback, payload)
+        except Exception as ex:
+            logger.error(f"Error processing message: {ex}")
+        finally:
+            semaphore.release()
+
+# This class is the asyncio runtime of the service, the MQTT network I/O, the request intake and the timers (heartbeat,
+# task status ticks) run on one event loop, the blocking kube/subprocess calls run in a small executor
+class AsyncRuntime:
+    def __init__(self, mqtt_manager, message_processor, max_concurrency: int = 4, executor_workers: int = 4):
+        self._mqtt_manager = mqtt_manager
+        self._message_processor = message_processor
+        self._executor_workers = max(executor_workers, 1)
+        self._max_concurrency = max(max_concurrency, 1)
+        self._runner = AsyncRequestRunner(message_processor.message_queue, message_processor.on_message_callback, max_concurrency)
+        # [interval, callback, blocking], the interval can be changed while the timer runs
+        self._timers: List[list] = []
+        self._loop = None
+
+    # This function adds a periodic timer, the blocking callbacks run in the executor
+    def add_timer(self, interval: float, callback: Callable, blocking: bool = True):
+        self._timers.append([interval, callback, blocking])
+
+    # This function runs the callback on the event loop thread, e.g. to act on the MQTT client from another thread
+    def call_soon(self, callback: Callable, *args):
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    # This function changes the interval of the timer of the callback
+    def set_timer_interval(self, callback: Callable, interval: float):
+        for timer in self._timers:
+            if timer[1] == callback:
+                timer[0] = interval
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        # the running reads, the running write, the blocking timers and the broker connection each have a worker, a
+        # slow request cannot hold up the heartbeat
+        blocking_timers = sum(1 for timer in self._timers if timer[2])
+        workers = max(self._executor_workers, self._max_concurrency + 1 + blocking_timers + 1)
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="async-executor")
+        self._loop.set_default_executor(executor)
+        mqtt_loop = AsyncMQTTLoop(self._loop, self._mqtt_manager.handle_loop_error)
+        self._mqtt_manager.set_client_setup(mqtt_loop.attach)
+        self._message_processor.set_enqueue_listener(self._runner.notify)
+        tasks = [asyncio.create_task(self._runner.run())]
+        for timer in self._timers:
+            tasks.append(asyncio.create_task(self._run_timer(timer)))
+        tasks.append(asyncio.create_task(self._supervise_connection()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # cancelled by the interruption (SIGINT, KeyboardInterrupt raised by a signal handler) or stopped by an
+            # error, the runtime is wound down while the loop still runs
+            for task in tasks:
+                task.cancel()
+            await self._shutdown(mqtt_loop, executor)
+
+    # This function disconnects from the broker on the event loop (paho writes the DISCONNECT through the loop's
+    # writer callback), detaches the client from the loop and drops the requests not started in the executor
+    async def _shutdown(self, mqtt_loop: AsyncMQTTLoop, executor: ThreadPoolExecutor):
+        self._message_processor.set_enqueue_listener(None)
+        client = self._mqtt_manager.client
+        if client is not None:
+            try:
+                self._mqtt_manager.disconnect()
+                deadline = time.monotonic() + DISCONNECT_TIMEOUT
+                while client.socket() is not None and time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+            except Exception as ex:
+                logger.error(f"Failed to disconnect from MQTT broker: {ex}")
+            mqtt_loop.detach(client)
+        self._mqtt_manager.set_client_setup(None)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run_timer(self, timer: list):
+        _, callback, blocking = timer
+        # the first run is right away, as the heartbeat thread of the threaded runtime
+        next_time = time.monotonic() - timer[0]
+        while True:
+            start = next_time
+            # the interval is re-read while waiting, so a changed interval applies to the wait in progress
+            while time.monotonic() < start + timer[0]:
+                await asyncio.sleep(min(start + timer[0] - time.monotonic(), MAX_TIMER_SLEEP))
+            # a shortened interval does not fire the missed runs
+            next_time = max(start + timer[0], time.monotonic())
+            try:
+                if blocking:
+                    await self._loop.run_in_executor(None, callback)
+                else:
+                    callback()
+            except Exception as ex:
+                logger.error(f"Error in the timer callback: {ex}")
+
+    # This function connects to the broker and reconnects with backoff when the connection is lost, the connect
+    # calls block on the network so they run in the executor
+    async def _supervise_connection(self):
+        delay = MIN_RECONNECT_DELAY
+        connected = await self._loop.run_in_executor(None, self._mqtt_manager.connect)
+        while True:
+            await asyncio.sleep(delay if not connected else MIN_RECONNECT_DELAY)
+            client = self._mqtt_manager.client
+            if connected and client is not None and client.socket() is not None:
+                continue
+            try:
+                if client is None:
+                    connected = await self._loop.run_in_executor(None, self._mqtt_manager.connect)
+                else:
+                    await self._loop.run_in_executor(None, self._mqtt_manager.reconnect)
+                    connected = True
+            except Exception as ex:
+                logger.error(f"Failed to reconnect to MQTT broker: {ex}")
+                connected = False
+            delay = MIN_RECONNECT_DELAY if connected else min(delay * 2, MAX_RECONNECT_DELAY)
@@ -0,0 +1,293 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, threading, time
+from typing import Dict, List, Optional, Tuple
+from utils.logger import get_logger
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# drop the samples of the cgroups which are not seen for this long (e.g. deleted pods)
+SAMPLE_EXPIRY_SECONDS = 600
+
+# interval between the two samples taken when there is no previous sample to compute the rates
+PRIME_INTERVAL_SECONDS = 0.1
+
+# This class reads the pod/container CPU usage, memory working set and CPU throttling counters
+# directly from the cgroup filesystem (v1 and v2), without depending on the metrics-server.
+# Pods are mapped to the cgroups via the kubepods hierarchy using the pod uid, QoS class and
+# container ids, both 'cgroupfs' (k3s default) and 'systemd' cgroup driver layouts are supported.
+class CgroupMetricsCollector:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._init()
+        return cls._instance
+
+    def _init(self):
+        self._lock = threading.Lock()
+        # cgroup path -> (timestamp, cpu_usage_ns, nr_periods, nr_throttled, throttled_ns)
+        self._samples: Dict[str, Tuple[float, int, int, int, int]] = {}
+        self._last_seen: Dict[str, float] = {}
+        # cpu cgroup dir -> (timestamp, cpu_usage_ns, nr_periods, nr_throttled, throttled_ns) of the priming pass, the
+        # previous sample of the targets seen for the first time
+        self._primed: Dict[str, Tuple[float, int, int, int, int]] = {}
+        self._version = None
+        self._kubepods_dirs = None
+        self._detected = False
+
+    def _detect(self):
+        if self._detected:
+            return
+        self._detected = True
+        if os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+            self._version = 2
+            self._kubepods_dirs = {
+                "cpu": self._find_kubepods_dir(CGROUP_ROOT),
+                "memory": self._find_kubepods_dir(CGROUP_ROOT)
+            }
+        else:
+            cpu_root = None
+            for name in ["cpu,cpuacct", "cpuacct,cpu", "cpuacct"]:
+                if os.path.isdir(os.path.join(CGROUP_ROOT, name)):
+                    cpu_root = os.path.join(CGROUP_ROOT, name)
+                    break
+            memory_root = os.path.join(CGROUP_ROOT, "memory")
+            self._version = 1
+            self._kubepods_dirs = {
+                "cpu": self._find_kubepods_dir(cpu_root) if cpu_root else None,
+                "memory": self._find_kubepods_dir(memory_root) if os.path.isdir(memory_root) else None
+            }
+        logger.info(f"cgroup v{self._version} detected, kubepods: {self._kubepods_dirs}")
+
+    def _find_kubepods_dir(self, root: str) -> Optional[str]:
+        for name in ["kubepods", "kubepods.slice"]:
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                return path
+        return None
+
+    def is_available(self) -> bool:
+        # cgroup metrics are available when the kubepods hierarchy is found and readable
+        self._detect()
+        cpu_dir = self._kubepods_dirs.get("cpu")
+        memory_dir = self._kubepods_dirs.get("memory")
+        return (cpu_dir is not None and memory_dir is not None
+                and os.access(cpu_dir, os.R_OK) and os.access(memory_dir, os.R_OK))
+
+    def _pod_dir(self, kubepods_dir: str, pod_uid: str, qos_class: Optional[str]) -> Optional[str]:
+        qos = (qos_class or "").lower()
+        candidates = []
+        if qos == "guaranteed":
+            # cgroupfs driver
+            candidates.append(os.path.join(kubepods_dir, f"pod{pod_uid}"))
+            # systemd driver
+            candidates.append(os.path.join(kubepods_dir, f"kubepods-pod{pod_uid.replace('-', '_')}.slice"))
+        elif qos in ["burstable", "besteffort"]:
+            candidates.append(os.path.join(kubepods_dir, qos, f"pod{pod_uid}"))
+            candidates.append(os.path.join(kubepods_dir, f"kubepods-{qos}.slice",
+                                           f"kubepods-{qos}-pod{pod_uid.replace('-', '_')}.slice"))
+        else:
+            # QoS class is not known, try all the layouts
+            candidates.append(os.path.join(kubepods_dir, f"pod{pod_uid}"))
+            for qos in ["burstable", "besteffort"]:
+                candidates.append(os.path.join(kubepods_dir, qos, f"pod{pod_uid}"))
+                candidates.append(os.path.join(kubepods_dir, f"kubepods-{qos}.slice",
+                                               f"kubepods-{qos}-pod{pod_uid.replace('-', '_')}.slice"))
+        for path in candidates:
+            if os.path.isdir(path):
+                return path
+        return None
+
+    def _container_dir(self, pod_dir: str, container_id: str) -> Optional[str]:
+        # container_id is in the form '<runtime>://<id>'
+        runtime, _, cid = container_id.partition("://")
+        if not cid:
+            return None
+        for name in [cid, f"cri-containerd-{cid}.scope", f"{runtime}-{cid}.scope"]:
+            path = os.path.join(pod_dir, name)
+            if os.path.isdir(path):
+                return path
+        return None
+
+    def _read_kv_file(self, path: str) -> Dict[str, int]:
+        values = {}
+        with open(path, "r") as file:
+            for line in file:
+                key, _, value = line.partition(" ")
+                try:
+                    values[key] = int(value)
+                except ValueError:
+                    pass
+        return values
+
+    def _read_int(self, path: str) -> int:
+        with open(path, "r") as file:
+            return int(file.read().strip())
+
+    def _read_cpu_counters(self, cpu_dir: str):
+        # returns (cpu_usage_ns, nr_periods, nr_throttled, throttled_ns)
+        if self._version == 2:
+            cpu_stat = self._read_kv_file(os.path.join(cpu_dir, "cpu.stat"))
+            cpu_usage = cpu_stat.get("usage_usec", 0) * 1000
+            throttled = cpu_stat.get("throttled_usec", 0) * 1000
+        else:
+            cpu_usage = self._read_int(os.path.join(cpu_dir, "cpuacct.usage"))
+            cpu_stat = {}
+            if os.path.exists(os.path.join(cpu_dir, "cpu.stat")):
+                cpu_stat = self._read_kv_file(os.path.join(cpu_dir, "cpu.stat"))
+            throttled = cpu_stat.get("throttled_time", 0)
+        return cpu_usage, cpu_stat.get("nr_periods", 0), cpu_stat.get("nr_throttled", 0), throttled
+
+    def _read_counters(self, cpu_dir: str, memory_dir: str):
+        # returns (cpu_usage_ns, nr_periods, nr_throttled, throttled_ns, working_set_bytes)
+        if self._version == 2:
+            memory_usage = self._read_int(os.path.join(memory_dir, "memory.current"))
+            inactive_file = self._read_kv_file(os.path.join(memory_dir, "memory.stat")).get("inactive_file", 0)
+        else:
+            memory_usage = self._read_int(os.path.join(memory_dir, "memory.usage_in_bytes"))
+            inactive_file = self._read_kv_file(os.path.join(memory_dir, "memory.stat")).get("total_inactive_file", 0)
+        # working set is the memory usage excluding the inactive file cache (same as kubelet/cadvisor)
+        working_set = max(memory_usage - inactive_file, 0)
+        return self._read_cpu_counters(cpu_dir) + (working_set,)
+
+    def _resolve_dirs(self, pod_uid: str, qos_class: Optional[str], container_id: Optional[str] = None):
+        cpu_pod_dir = self._pod_dir(self._kubepods_dirs["cpu"], pod_uid, qos_class)
+        memory_pod_dir = self._pod_dir(self._kubepods_dirs["memory"], pod_uid, qos_class)
+        if cpu_pod_dir is None or memory_pod_dir is None:
+            return None
+        if container_id is None:
+            return cpu_pod_dir, memory_pod_dir
+        cpu_dir = self._container_dir(cpu_pod_dir, container_id)
+        memory_dir = self._container_dir(memory_pod_dir, container_id)
+        if cpu_dir is None or memory_dir is None:
+            return None
+        return cpu_dir, memory_dir
+
+    def _read_targets(self, targets: Dict[str, Tuple[str, str]]) -> Dict[str, tuple]:
+        counters = {}
+        for key, (cpu_dir, memory_dir) in targets.items():
+            try:
+                counters[key] = (time.monotonic(),) + self._read_counters(cpu_dir, memory_dir)
+            except (OSError, ValueError):
+                # the cgroup is gone (e.g. container restarted) or not readable
+                pass
+        return counters
+
+    # This function reads the cpu counters of all the pod and container cgroups of the kubepods hierarchy, in one
+    # pass, as the previous sample of the targets seen for the first time
+    def _prime_all(self):
+        kubepods_dir = self._kubepods_dirs["cpu"]
+        stat_file = "cpu.stat" if self._version == 2 else "cpuacct.usage"
+        # kubepods/<qos>/<pod>/<container> is the deepest layout
+        base_depth = kubepods_dir.rstrip(os.sep).count(os.sep)
+        for path, dirs, files in os.walk(kubepods_dir):
+            if path.count(os.sep) - base_depth >= 3:
+                dirs[:] = []
+            if stat_file not in files or path in self._primed:
+                continue
+            try:
+                self._primed[path] = (time.monotonic(),) + self._read_cpu_counters(path)
+            except (OSError, ValueError):
+                pass
+
+    def _compute_usage(self, key: str, current: tuple, cpu_dir: Optional[str] = None) -> dict:
+        timestamp, cpu_usage, nr_periods, nr_throttled, throttled, working_set = current
+        usage = {"cpu": None, "memory": working_set, "throttled_ratio": None, "throttled_seconds": None}
+        previous = self._samples.get(key)
+        if previous is None and cpu_dir is not None:
+            previous = self._primed.pop(cpu_dir, None)
+        if previous is not None:
+            prev_timestamp, prev_cpu_usage, prev_nr_periods, prev_nr_throttled, prev_throttled = previous
+            elapsed_ns = (timestamp - prev_timestamp) * 1_000_000_000
+            # counters are reset when the cgroup is recreated, ignore the sample in that case
+            if elapsed_ns > 0 and cpu_usage >= prev_cpu_usage:
+                usage["cpu"] = (cpu_usage - prev_cpu_usage) / elapsed_ns  # in cores
+                periods = nr_periods - prev_nr_periods
+                if periods > 0 and nr_throttled >= prev_nr_throttled:
+                    usage["throttled_ratio"] = (nr_throttled - prev_nr_throttled) / periods
+                if throttled >= prev_throttled:
+                    usage["throttled_seconds"] = (throttled - prev_throttled) / 1_000_000_000
+        self._samples[key] = (timestamp, cpu_usage, nr_periods, nr_throttled, throttled)
+        self._last_seen[key] = timestamp
+        return usage
+
+    def _expire_samples(self):
+        now = time.monotonic()
+        expired = [key for key, last_seen in self._last_seen.items() if now - last_seen > SAMPLE_EXPIRY_SECONDS]
+        for key in expired:
+            self._samples.pop(key, None)
+            self._last_seen.pop(key, None)
+        # the primed cgroups not asked for (e.g. the pods of the system namespaces)
+        for path in [path for path, sample in self._primed.items() if now - sample[0] > SAMPLE_EXPIRY_SECONDS]:
+            del self._primed[path]
+
+    # This function collects the usage of the given pods and their containers.
+    # pods is a list of (pod_uid, qos_class, {container_name: container_id}).
+    # Returns {pod_uid: {"cpu", "memory", "throttled_ratio", "throttled_seconds", "containers": {name: usage}}},
+    # cpu is in cores and memory (working set) is in bytes.
+    def collect(self, pods: List[Tuple[str, Optional[str], Dict[str, str]]]) -> Dict[str, dict]:
+        if not self.is_available():
+            return {}
+        targets = {}
+        for pod_uid, qos_class, container_ids in pods:
+            dirs = self._resolve_dirs(pod_uid, qos_class)
+            if dirs is None:
+                continue
+            targets[pod_uid] = dirs
+            for container_name, container_id in container_ids.items():
+                if not container_id:
+                    continue
+                dirs = self._resolve_dirs(pod_uid, qos_class, container_id)
+                if dirs is not None:
+                    targets[f"{pod_uid}/{container_name}"] = dirs
+
+        # rates need two samples, when a target is seen for the first time all the pod cgroups are primed in one
+        # pass and a quick second sample is taken after a single sleep, outside the lock. The next calls (e.g. for
+        # the other apps of a status query) find their previous sample primed and do not sleep.
+        with self._lock:
+            cold = any(key not in self._samples and dirs[0] not in self._primed for key, dirs in targets.items())
+            if cold:
+                self._prime_all()
+        if cold:
+            time.sleep(PRIME_INTERVAL_SECONDS)
+
+        with self._lock:
+            counters = self._read_targets(targets)
+            usages = {}
+            for pod_uid, _, container_ids in pods:
+                if pod_uid not in counters:
+                    continue
+                usage = self._compute_usage(pod_uid, counters[pod_uid], targets[pod_uid][0])
+                usage["containers"] = {}
+                for container_name in container_ids:
+                    key = f"{pod_uid}/{container_name}"
+                    if key in counters:
+                        usage["containers"][container_name] = self._compute_usage(key, counters[key], targets[key][0])
+                usages[pod_uid] = usage
+            self._expire_samples()
+        return usages
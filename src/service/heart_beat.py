@@ -20,7 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os, threading
+import os, time, threading
 from typing import Callable
 from utils.logger import get_logger
 
@@ -32,7 +32,14 @@ class HeartBeat:
         self._heartbeat_frequency = heartbeat_frequency
         self._on_heartbeat_callback = on_heartbeat_callback
         self._stop_event = threading.Event()
+        # set when the frequency is changed, wakes up the wait for the next heartbeat
+        self._frequency_changed = threading.Event()
         self._reporter_thread = None
+
+    # This function changes the interval of the heartbeats, applied to the wait in progress
+    def set_frequency(self, heartbeat_frequency: int):
+        self._heartbeat_frequency = heartbeat_frequency
+        self._frequency_changed.set()
     
     def start(self):
         if not self._reporter_thread or not self._reporter_thread.is_alive():
@@ -42,6 +49,7 @@ class HeartBeat:
     
     def stop(self):
         self._stop_event.set()
+        self._frequency_changed.set()
         if self._reporter_thread:
             self._reporter_thread.join(timeout=5)
     
@@ -49,6 +57,16 @@ class HeartBeat:
         while not self._stop_event.is_set():
             try:
                 self._on_heartbeat_callback()
-                self._stop_event.wait(self._heartbeat_frequency)
+                self._wait()
             except Exception as ex:
-                logger.error(f"Error reporting status: {ex}")
\ No newline at end of file
+                logger.error(f"Error reporting status: {ex}")
+
+    # This function waits for the next heartbeat, the wait is re-computed when the frequency changes
+    def _wait(self):
+        start = time.monotonic()
+        while not self._stop_event.is_set():
+            remaining = start + self._heartbeat_frequency - time.monotonic()
+            if remaining <= 0:
+                return
+            self._frequency_changed.wait(remaining)
+            self._frequency_changed.clear()
\ No newline at end of file
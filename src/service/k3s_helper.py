@@ -20,47 +20,180 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os, re, threading, subprocess, tempfile, shutil, json, psutil
-from kubernetes import client, config
-from kubernetes.client import V1Pod
-from kubernetes.client.exceptions import ApiException
-from typing import List, Dict, Optional
-from utils.commons import format_uptime
+import os, re, time, subprocess, tempfile, shutil, json, threading, functools, inspect
+from typing import List, Dict, Optional, Callable, Any
+from utils.commons import format_uptime, parse_k8s_timestamp
 from datetime import datetime, timedelta
 from utils.logger import get_logger
+from utils.config import get_app_config
+from service.cgroup_metrics import CgroupMetricsCollector
+from service.resource_accounting import ResourceAccounting, sum_container_metrics
+from service.kube_records import DeploymentRecord, PodRecord
+from utils.cancellation import CancellationToken, RequestCancelledError
+from utils.lazy_import import LazyModule
+from utils.metrics import metrics, run_subprocess
+from utils.tracing import span
+
+# the kubernetes client and psutil are imported on their first use
+client = LazyModule("kubernetes.client")
+kube_config = LazyModule("kubernetes.config")
+kube_exceptions = LazyModule("kubernetes.client.exceptions")
+psutil = LazyModule("psutil")
 
 current_file = os.path.basename(__file__)
 logger = get_logger(current_file)
 
+# fields of the app status, can be projected by the status queries
+APP_STATUS_FIELDS = frozenset(["app_name", "namespace", "status", "creation_time", "last_update_time", "pods", "replicas", "cpu_usage", "mem_usage", "uptime"])
+# fields which require listing the app's pods
+POD_FIELDS = frozenset(["status", "pods", "cpu_usage", "mem_usage", "uptime"])
+# fields which require the pods' usage metrics
+METRICS_FIELDS = frozenset(["cpu_usage", "mem_usage"])
+
+# the API client shared by the API objects (one connection pool), loaded from the kubeconfig of the configuration
+# ([k3s] kube_config) on the first use and reloaded when the kubeconfig or its path changes
+_api_client = None
+# (path, mtime) of the kubeconfig the client is loaded from
+_api_client_source = None
+_api_client_lock = threading.Lock()
+
+KUBE_API_CALLS = metrics.counter("kube_api_calls", "Kubernetes API calls per K3sHelper method", ("method",))
+KUBE_API_ERRORS = metrics.counter("kube_api_errors", "Kubernetes API calls which failed, per K3sHelper method", ("method",))
+KUBE_API_DURATION = metrics.histogram("kube_api_call_duration_ms", "Latency of the Kubernetes API calls in milliseconds", ("method",))
+HELPER_DURATION = metrics.histogram("k3s_helper_duration_ms", "Duration of the K3sHelper methods in milliseconds", ("method",))
+
+# the K3sHelper method running in the thread, the label of its Kubernetes API calls
+_current_method = threading.local()
+
+# This function wraps the API client's call_api, the calls are counted and timed per K3sHelper method, and traced
+# with the HTTP method and the resource path (call_api(resource_path, method, ...))
+def _instrument_api_client(api_client):
+    call_api = api_client.call_api
+    @functools.wraps(call_api)
+    def timed_call_api(*args, **kwargs):
+        method = getattr(_current_method, "name", None) or "other"
+        start = time.monotonic()
+        try:
+            with span("kube_api", verb=args[1] if len(args) > 1 else kwargs.get("method"),
+                      path=args[0] if args else kwargs.get("resource_path")):
+                return call_api(*args, **kwargs)
+        except Exception:
+            KUBE_API_ERRORS.inc(method=method)
+            raise
+        finally:
+            KUBE_API_CALLS.inc(method=method)
+            KUBE_API_DURATION.observe((time.monotonic() - start) * 1000, method=method)
+    api_client.call_api = timed_call_api
+    return api_client
+
+def get_api_client():
+    global _api_client, _api_client_source
+    kube_config_file = get_app_config().kube_config_file
+    source = (kube_config_file, os.path.getmtime(kube_config_file))
+    with _api_client_lock:
+        if _api_client is None or source != _api_client_source:
+            configuration = client.Configuration()
+            kube_config.load_kube_config(kube_config_file, client_configuration=configuration)
+            previous_client = _api_client
+            _api_client = _instrument_api_client(client.ApiClient(configuration))
+            _api_client_source = source
+            # the connection pool and the threads of the replaced client are released
+            if previous_client is not None:
+                try:
+                    previous_client.close()
+                except Exception as ex:
+                    logger.warning(f"Failed to close the previous API client: {ex}")
+        return _api_client
+
+# This function builds the rollout progress reported while waiting for a deployment from its replica counts
+def rollout_progress(replicas: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "desired": replicas.get("desired"),
+        "ready": replicas.get("ready"),
+        "updated": replicas.get("updated"),
+        "available": replicas.get("available")
+    }
+
 class K3sHelper:
-    def __init__(self):
+    # cancel_token: optional cancellation token of the request, the wait loops stop when it is cancelled
+    def __init__(self, cancel_token: Optional[CancellationToken] = None):
+        self._cancel_token = cancel_token
         try:
-            config.load_kube_config("/etc/rancher/k3s/k3s.yaml")
-            self.core_api = client.CoreV1Api()
+            self.api_client = get_api_client()
+            self.core_api = client.CoreV1Api(self.api_client)
         except Exception as e:
             raise RuntimeError(f"Failed to load kubeconfig: {str(e)}")
     
+    # This function waits for the given seconds, raises RequestCancelledError when the request is cancelled meanwhile
+    def _wait(self, seconds: float):
+        if self._cancel_token is not None:
+            self._cancel_token.wait(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _check_cancelled(self):
+        if self._cancel_token is not None:
+            self._cancel_token.check()
+
     def extract_appname_and_imagename(self, imagepath):
         start_index = imagepath.rindex("/") + 1
         image_name = imagepath[start_index:]
         app_name, _ = image_name.split(":", 1)
         return app_name, image_name
     
-    def parse_quantity(self, quantity_str: str):
-        #Parse Kubernetes quantity strings (CPU/memory) into numeric values
-        if quantity_str.endswith('n'):  # nanocores
-            return float(quantity_str[:-1]) / 1_000_000  # to millicores
-        elif quantity_str.endswith('m'):  # millicores
-            return float(quantity_str[:-1])
-        elif quantity_str.endswith('Ki'):  # kibibytes
-            return float(quantity_str[:-2]) / 1024  # to MiB
-        elif quantity_str.endswith('Mi'):  # mebibytes
-            return float(quantity_str[:-2])
-        elif quantity_str.endswith('Gi'):  # gibibytes
-            return float(quantity_str[:-2]) * 1024  # to MiB
-        else:  # assume bytes (no suffix)
-            return float(quantity_str) / (1024 * 1024)  # bytes to MiB
-    
+    def get_pod_cgroup_ref(self, pod: PodRecord):
+        # pod reference used by the cgroup metrics collector, (pod_uid, qos_class, {container_name: container_id})
+        return pod.uid, pod.qos_class, pod.container_ids
+
+    # The below functions call the Kubernetes API with '_preload_content=False' and parse the raw JSON
+    # response into compact records, skipping the deserialization into the OpenAPI model objects
+
+    def read_deployment_record(self, app_name: str, namespace: str) -> DeploymentRecord:
+        apps_v1_api = client.AppsV1Api(self.api_client)
+        response = apps_v1_api.read_namespaced_deployment(app_name, namespace, _preload_content=False)
+        return DeploymentRecord.from_dict(json.loads(response.data))
+
+    # This function yields the deployments of the given namespaces (all namespaces if not specified). The label
+    # selector and the 'kube-system' exclusion are applied by the API server, page_size fetches the deployments
+    # in pages using the 'limit'/'continue' pagination of the list calls
+    def iter_deployment_records(self, namespaces: Optional[List[str]] = None, label_selector: Optional[str] = None,
+                                exclude_system: bool = False, page_size: Optional[int] = None):
+        apps_v1_api = client.AppsV1Api(self.api_client)
+        kwargs = {"_preload_content": False}
+        if label_selector:
+            kwargs["label_selector"] = label_selector
+        if page_size:
+            kwargs["limit"] = page_size
+        if namespaces:
+            list_calls = [(apps_v1_api.list_namespaced_deployment, [namespace]) for namespace in namespaces
+                          if not (exclude_system and namespace == "kube-system")]
+        else:
+            if exclude_system:
+                kwargs["field_selector"] = "metadata.namespace!=kube-system"
+            list_calls = [(apps_v1_api.list_deployment_for_all_namespaces, [])]
+        for list_call, args in list_calls:
+            continue_token = None
+            while True:
+                call_kwargs = dict(kwargs)
+                if continue_token:
+                    call_kwargs["_continue"] = continue_token
+                response = list_call(*args, **call_kwargs)
+                deployments = json.loads(response.data)
+                for item in deployments.get("items") or []:
+                    yield DeploymentRecord.from_dict(item)
+                continue_token = (deployments.get("metadata") or {}).get("continue")
+                if not continue_token:
+                    break
+
+    def list_deployment_records(self, namespaces: Optional[List[str]] = None, label_selector: Optional[str] = None,
+                                exclude_system: bool = False) -> List[DeploymentRecord]:
+        return list(self.iter_deployment_records(namespaces, label_selector, exclude_system))
+
+    def list_pod_records(self, namespace: str, label_selector: str) -> List[PodRecord]:
+        core_v1_api = client.CoreV1Api(self.api_client)
+        response = core_v1_api.list_namespaced_pod(namespace=namespace, label_selector=label_selector, _preload_content=False)
+        return [PodRecord.from_dict(item) for item in json.loads(response.data).get("items") or []]
+
     def get_system_boot_time(self):
         """get system boot time as UTC datetime"""
         boot_timestamp = psutil.boot_time()
@@ -68,7 +201,7 @@ class K3sHelper:
     
     # This function is to import the specified image into the k3s cluster
     def import_image(self, image_file: str) -> None:
-        result = subprocess.run(
+        result = run_subprocess(
             ['sudo', 'k3s', 'ctr', 'images', 'import', image_file],
             text=True,
             stdout=subprocess.PIPE,
@@ -84,7 +217,7 @@ class K3sHelper:
 
     def get_imported_images(self):
         #get list of all images imported into k3s cluster
-        result = subprocess.run(
+        result = run_subprocess(
             ['sudo', 'k3s', 'ctr', 'images', 'list', '-q'],
             capture_output=True,
             text=True,
@@ -102,9 +235,9 @@ class K3sHelper:
     # create namespace
     def create_namespace(self, namespace: str):
         try:
-            core_v1_api = client.CoreV1Api()
+            core_v1_api = client.CoreV1Api(self.api_client)
             core_v1_api.read_namespace(name=namespace)
-        except ApiException as e:
+        except kube_exceptions.ApiException as e:
             if e.status == 404:
                 ns_body = client.V1Namespace(metadata=client.V1ObjectMeta(name=namespace))
                 core_v1_api.create_namespace(ns_body)
@@ -112,21 +245,19 @@ class K3sHelper:
                 raise
         
         
-    def deploy_app(self, deployment_yaml: str):
-        apps_v1_api = client.AppsV1Api()
-        core_v1_api = client.CoreV1Api()
-        api_client = client.ApiClient()
+    # progress: optional callback called with the rollout progress (desired/ready/updated replicas) while waiting
+    def deploy_app(self, deployment_yaml: str, progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        apps_v1_api = client.AppsV1Api(self.api_client)
         
         app_name = deployment_yaml.get("metadata").get("name")
         namespace = deployment_yaml.get("metadata").get("namespace", "default")
-        deployment_obj = api_client._ApiClient__deserialize(deployment_yaml, client.V1Deployment)
         
         # check the images with imagePullPolicy "Never" are available in local repo
-        containers = deployment_obj.spec.template.spec.containers
+        containers = deployment_yaml.get("spec", {}).get("template", {}).get("spec", {}).get("containers", [])
         images = []
         for container in containers:
-            image = container.image
-            image_pull_policy = container.image_pull_policy
+            image = container.get("image")
+            image_pull_policy = container.get("imagePullPolicy")
             if image_pull_policy == "Never":
                 images.append(image)
         imported_images = self.get_imported_images()
@@ -134,28 +265,27 @@ class K3sHelper:
             error = "image(s) specified in the deployment definition is not found in the system!"
             raise RuntimeError(error)
         
-        # Create deployment
-        apps_v1_api.create_namespaced_deployment(namespace=namespace, body=deployment_obj)
+        # Create deployment, the definition is sent as it is without building the model object
+        apps_v1_api.create_namespaced_deployment(namespace=namespace, body=deployment_yaml, _preload_content=False)
 
         # wait for the deployment to reach 'healthy' state
-        wait_event = threading.Event()
-        wait_event.wait(5)
-        for _ in range(120):
-            app = self.get_deployment_status(app_name=app_name, namespace=namespace) or {}
-            app_status = app.get("status")
-            if app_status == "Healthy":
-                break
-            else:
-                wait_event.wait(1)
+        with span("rollout_wait"):
+            self._wait(5)
+            for _ in range(120):
+                app = self.get_deployment_status(app_name=app_name, namespace=namespace) or {}
+                if progress is not None and app.get("replicas"):
+                    progress(rollout_progress(app["replicas"]))
+                app_status = app.get("status")
+                if app_status == "Healthy":
+                    break
+                else:
+                    self._wait(1)
     
     def get_deployment(self, app_name: str, namespace: str):
-        apps_v1_api = client.AppsV1Api()
-        deployment = apps_v1_api.read_namespaced_deployment(app_name, namespace)
-        return deployment
+        return self.read_deployment_record(app_name, namespace)
 
-    def update_app(self, app_name: str, namespace: str, spec: dict):
-        apps_v1_api = client.AppsV1Api()
-        core_v1_api = client.CoreV1Api()
+    def update_app(self, app_name: str, namespace: str, spec: dict, progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        apps_v1_api = client.AppsV1Api(self.api_client)
         
         spec_patch = {
             "spec": spec
@@ -164,70 +294,76 @@ class K3sHelper:
         apps_v1_api.patch_namespaced_deployment(
             name=app_name,
             namespace=namespace,
-            body=spec_patch
+            body=spec_patch,
+            _preload_content=False
         )
 
         # wait for the deployment to reach the desired state
-        wait_event = threading.Event()
-        wait_event.wait(5)
-        for _ in range(120):
-            app = self.get_deployment_status(app_name=app_name, namespace=namespace) or {}
-            app_status = app.get("status")
-            if app_status == "Healthy":
-                break
-            else:
-                wait_event.wait(1)    
+        with span("rollout_wait"):
+            self._wait(5)
+            for _ in range(120):
+                app = self.get_deployment_status(app_name=app_name, namespace=namespace) or {}
+                if progress is not None and app.get("replicas"):
+                    progress(rollout_progress(app["replicas"]))
+                app_status = app.get("status")
+                if app_status == "Healthy":
+                    break
+                else:
+                    self._wait(1)
         
-    def scale_patch_app(self, app_name: str, namespace: str, replicas: int):
+    def scale_patch_app(self, app_name: str, namespace: str, replicas: int, progress: Optional[Callable[[Dict[str, Any]], None]] = None):
         scale_patch = {
             "spec": {
                 "replicas": replicas
             }
         }
-        apps_v1_api = client.AppsV1Api()
-        core_v1_api = client.CoreV1Api()
+        apps_v1_api = client.AppsV1Api(self.api_client)
         
         apps_v1_api.patch_namespaced_deployment(
             name=app_name,
             namespace=namespace,
-            body=scale_patch
+            body=scale_patch,
+            _preload_content=False
         )
 
         # wait for the deployment to reach the desired state
-        wait_event = threading.Event()
-        wait_event.wait(5)
-        for _ in range(120):
-            deployment = apps_v1_api.read_namespaced_deployment(app_name, namespace)
-            if deployment is not None:
-                try:
-                    if replicas == 0: # case of stop app
-                        label_selector = ",".join([f"{k}={v}" for k, v in deployment.spec.selector.match_labels.items()])
-                        pods = core_v1_api.list_namespaced_pod(namespace, label_selector=label_selector).items
-                        # wait till all pods are deleted for the app
-                        if len(pods) > 0:
-                            wait_event.wait(1)
-                        else:
-                            break
-                    else: # case of start app or scale up
-                        label_selector = ",".join([f"{k}={v}" for k, v in deployment.spec.selector.match_labels.items()])
-                        pods = core_v1_api.list_namespaced_pod(namespace, label_selector=label_selector).items
-                        statuses = [pod.status.phase for pod in pods]
-                        # wait for all pods to reach 'Running' state
-                        if all(status == 'Running' for status in statuses):
-                            break
-                        else:
-                            wait_event.wait(1)
-                except Exception as ex:
-                    wait_event.wait(1)
+        with span("rollout_wait"):
+            self._wait(5)
+            for _ in range(120):
+                deployment = self.read_deployment_record(app_name, namespace)
+                if deployment is not None:
+                    try:
+                        if progress is not None:
+                            progress(rollout_progress({"desired": deployment.replicas, "ready": deployment.ready_replicas,
+                                                       "updated": deployment.updated_replicas, "available": deployment.available_replicas}))
+                        if replicas == 0: # case of stop app
+                            pods = self.list_pod_records(namespace, deployment.label_selector)
+                            # wait till all pods are deleted for the app
+                            if len(pods) > 0:
+                                self._wait(1)
+                            else:
+                                break
+                        else: # case of start app or scale up
+                            pods = self.list_pod_records(namespace, deployment.label_selector)
+                            statuses = [pod.phase for pod in pods]
+                            # wait for all pods to reach 'Running' state
+                            if all(status == 'Running' for status in statuses):
+                                break
+                            else:
+                                self._wait(1)
+                    except RequestCancelledError:
+                        raise
+                    except Exception as ex:
+                        self._wait(1)
 
 
-    def image_patch_app(self, app_name: str, namespace: str, container_name: str, new_image: str, image_Pull_policy: str):
-        apps_v1_api = client.AppsV1Api()
-        core_v1_api = client.CoreV1Api()
+    def image_patch_app(self, app_name: str, namespace: str, container_name: str, new_image: str, image_Pull_policy: str,
+                        progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        apps_v1_api = client.AppsV1Api(self.api_client)
         
         if image_Pull_policy is None:
-            deployment = apps_v1_api.read_namespaced_deployment(app_name, namespace)
-            for container in deployment.spec.template.spec.containers:
+            deployment = self.read_deployment_record(app_name, namespace)
+            for container in deployment.containers:
                 if container_name == container.name:
                     image_Pull_policy = container.image_pull_policy
         
@@ -252,54 +388,63 @@ class K3sHelper:
         apps_v1_api.patch_namespaced_deployment(
             name=app_name,
             namespace=namespace,
-            body=image_patch
+            body=image_patch,
+            _preload_content=False
         )
 
         # wait for the image patch is complete
-        wait_event = threading.Event()
-        wait_event.wait(5)
-        for _ in range(120):
-            deployment = apps_v1_api.read_namespaced_deployment(app_name, namespace)
-            label_selector = ",".join([f"{k}={v}" for k, v in deployment.spec.selector.match_labels.items()])
-            pods = core_v1_api.list_namespaced_pod(namespace, label_selector=label_selector).items
-            # check all targetted containers are updated with new image
-            all_updated = True
-            for pod in pods:
-                for container in pod.spec.containers:
-                    if container.name == container_name and container.image != new_image:
-                        all_updated = False
-                        break
-            # if not all the targetted containers are not updated with new image, then wait for a sec and check again
-            if not all_updated:
-                wait_event.wait(1)
-            else:
-                break
+        with span("rollout_wait"):
+            self._wait(5)
+            for _ in range(120):
+                deployment = self.read_deployment_record(app_name, namespace)
+                pods = self.list_pod_records(namespace, deployment.label_selector)
+                # check all targetted containers are updated with new image
+                all_updated = True
+                updated_pods = 0
+                for pod in pods:
+                    pod_updated = True
+                    for container in pod.containers:
+                        if container.name == container_name and container.image != new_image:
+                            all_updated = False
+                            pod_updated = False
+                            break
+                    updated_pods += 1 if pod_updated else 0
+                if progress is not None:
+                    progress({"desired": deployment.replicas, "ready": deployment.ready_replicas, "pods": len(pods), "updated_pods": updated_pods})
+                # if not all the targetted containers are not updated with new image, then wait for a sec and check again
+                if not all_updated:
+                    self._wait(1)
+                else:
+                    break
 
         
-    def get_app_status(self, app_name: str, namespace: str="dafault"):
-        core_v1_api = client.CoreV1Api()
-        apps_v1_api = client.AppsV1Api()
-        metrics_api = client.CustomObjectsApi()
-        try:
-            deployment = apps_v1_api.read_namespaced_deployment(app_name, namespace)
-        except Exception as ex:
-            return None
+    # This function gets the status of the app, fields is the projection of the app status fields (all the fields
+    # if not specified), the pods and the metrics are fetched only when the requested fields need them
+    def get_app_status(self, app_name: str, namespace: str="dafault", fields: Optional[List[str]] = None,
+                       deployment: Optional[DeploymentRecord] = None):
+        fields = APP_STATUS_FIELDS if not fields else frozenset(fields)
+        need_pods = not fields.isdisjoint(POD_FIELDS)
+        need_metrics = not fields.isdisjoint(METRICS_FIELDS)
+        metrics_api = client.CustomObjectsApi(self.api_client)
+        if deployment is None:
+            try:
+                deployment = self.read_deployment_record(app_name, namespace)
+            except Exception as ex:
+                return None
         if deployment:
-            creation_time = deployment.metadata.creation_timestamp
-            last_update_time = deployment.status.conditions[-1].last_update_time
-            desired_replicas = deployment.spec.replicas or 0
-            available_replicas = deployment.status.available_replicas or 0
-            updated_replicas = deployment.status.updated_replicas or 0
-            unavailable_replicas = deployment.status.unavailable_replicas or 0
+            creation_time = deployment.creation_timestamp
+            last_update_time = deployment.last_update_time
+            desired_replicas = deployment.replicas
+            available_replicas = deployment.available_replicas
+            updated_replicas = deployment.updated_replicas
+            unavailable_replicas = deployment.unavailable_replicas
 
             app_uptime = None
             app = None
             pods_ = []
 
-            match_labels = deployment.spec.selector.match_labels
-            label_selector = ",".join([f"{k}={v}" for k, v in match_labels.items()])
-            pods = core_v1_api.list_namespaced_pod(namespace=namespace, label_selector=label_selector).items
-            statuses = [pod.status.phase for pod in pods]
+            pods = self.list_pod_records(namespace, deployment.label_selector) if need_pods else []
+            statuses = [pod.phase for pod in pods]
 
             app_status = "Unknown"
             if desired_replicas == 0 and len(pods) == 0:
@@ -319,62 +464,60 @@ class K3sHelper:
                 elif all(status == 'Pending' for status in statuses):
                     app_status = "Pending"
 
-            total_cpu_usage = 0
-            total_memory_usage = 0
-            pod_count = 0
+            # accumulate the pods' requests, limits and usage for the usage percentages
+            accounting = ResourceAccounting()
+
+            # read the pods' usage directly from cgroups when available, metrics-server is used as the fallback
+            metrics_source = get_app_config().metrics_source
+            cgroup_usages = {}
+            if need_metrics and metrics_source in ["auto", "cgroup"]:
+                collector = CgroupMetricsCollector()
+                if collector.is_available():
+                    cgroup_usages = collector.collect([self.get_pod_cgroup_ref(pod) for pod in pods])
 
             for pod in pods:
-                pod_name = pod.metadata.name
+                pod_name = pod.name
                 containers = []
+                container_usages = {}
+
+                pod_usage = cgroup_usages.get(pod.uid)
+                usage = None
+                if pod_usage is not None and pod_usage.get("cpu") is not None:
+                    usage = (pod_usage["cpu"], pod_usage["memory"])
+                    container_usages = pod_usage.get("containers", {})
+                elif need_metrics and metrics_source != "cgroup":
+                    # Get pod metrics for CPU and memory usage
+                    try:
+                        pod_metrics = metrics_api.get_namespaced_custom_object(
+                            group="metrics.k8s.io",
+                            version="v1beta1", 
+                            namespace=namespace,
+                            plural="pods",
+                            name=pod_name
+                        )
+                        usage = sum_container_metrics(pod_metrics.get('containers', []))
+                    except Exception:
+                        # If metrics are not available, skip this pod
+                        pass
+
+                containers_resources = [(container.requests, container.limits) for container in pod.containers]
+                accounting.add_pod(containers_resources, usage)
                 
-                # Get pod metrics for CPU and memory usage
-                try:
-                    pod_metrics = metrics_api.get_namespaced_custom_object(
-                        group="metrics.k8s.io",
-                        version="v1beta1", 
-                        namespace=namespace,
-                        plural="pods",
-                        name=pod_name
-                    )
-                    
-                    pod_cpu_usage = 0
-                    pod_memory_usage = 0
-                    
-                    for container_metric in pod_metrics.get('containers', []):
-                        # Parse CPU usage (e.g., "1500m" -> 1.5 cores)
-                        cpu_str = container_metric.get('usage', {}).get('cpu', '0')
-                        if cpu_str.endswith('m'):
-                            pod_cpu_usage += int(cpu_str[:-1]) / 1000
-                        elif cpu_str.endswith('n'):
-                            pod_cpu_usage += int(cpu_str[:-1]) / 1000000000
-                        else:
-                            pod_cpu_usage += float(cpu_str)
-                        
-                        # Parse memory usage (e.g., "128Mi" -> bytes)
-                        memory_str = container_metric.get('usage', {}).get('memory', '0')
-                        if memory_str.endswith('Ki'):
-                            pod_memory_usage += int(memory_str[:-2]) * 1024
-                        elif memory_str.endswith('Mi'):
-                            pod_memory_usage += int(memory_str[:-2]) * 1024 * 1024
-                        elif memory_str.endswith('Gi'):
-                            pod_memory_usage += int(memory_str[:-2]) * 1024 * 1024 * 1024
-                        else:
-                            pod_memory_usage += int(memory_str)
-                    
-                    total_cpu_usage += pod_cpu_usage
-                    total_memory_usage += pod_memory_usage
-                    pod_count += 1
-                    
-                except Exception:
-                    # If metrics are not available, skip this pod
-                    pass
-                
-                for container in pod.spec.containers:
-                    containers.append({"name": container.name, "image": container.image})
-                pods_.append({"name": pod_name, "status":pod.status.phase, "containers": containers})
-                namespace = pod.metadata.namespace
-                status = pod.status.phase
-                start_time = pod.status.start_time
+                for container in pod.containers:
+                    container_ = {"name": container.name, "image": container.image}
+                    container_usage = container_usages.get(container.name)
+                    if container_usage is not None and container_usage.get("cpu") is not None:
+                        container_["metrics"] = {
+                            "cpu_cores": round(container_usage["cpu"], 4),
+                            "memory_bytes": container_usage["memory"],
+                            "cpu_throttled_ratio": container_usage["throttled_ratio"],
+                            "cpu_throttled_seconds": container_usage["throttled_seconds"]
+                        }
+                    containers.append(container_)
+                pods_.append({"name": pod_name, "status":pod.phase, "containers": containers})
+                namespace = pod.namespace
+                status = pod.phase
+                start_time = pod.start_time
                 if start_time is not None:
                     # get system boot time to handle reboot scenarios
                     boot_time = self.get_system_boot_time()
@@ -390,50 +533,19 @@ class K3sHelper:
                         if pod_uptime > app_uptime:
                             app_uptime = pod_uptime
 
-            # Get total CPU and memory requests for baseline calculation
-            total_cpu_requests = 0
-            total_memory_requests = 0
-            
-            for pod in pods:
-                for container in pod.spec.containers:
-                    if container.resources and container.resources.requests:
-                        # Parse CPU requests
-                        cpu_request = container.resources.requests.get('cpu', '0')
-                        if cpu_request.endswith('m'):
-                            total_cpu_requests += int(cpu_request[:-1]) / 1000
-                        elif cpu_request.endswith('n'):
-                            total_cpu_requests += int(cpu_request[:-1]) / 1000000000
-                        else:
-                            total_cpu_requests += float(cpu_request) if cpu_request != '0' else 0
-                        
-                        # Parse memory requests
-                        memory_request = container.resources.requests.get('memory', '0')
-                        if memory_request.endswith('Ki'):
-                            total_memory_requests += int(memory_request[:-2]) * 1024
-                        elif memory_request.endswith('Mi'):
-                            total_memory_requests += int(memory_request[:-2]) * 1024 * 1024
-                        elif memory_request.endswith('Gi'):
-                            total_memory_requests += int(memory_request[:-2]) * 1024 * 1024 * 1024
-                        else:
-                            total_memory_requests += int(memory_request) if memory_request != '0' else 0
-            
-            # Calculate CPU usage percentage
-            # If no CPU requests are defined, use pod_count as baseline (1 core per pod)
-            cpu_baseline = total_cpu_requests if total_cpu_requests > 0 else pod_count
-            cpu_usage_percentage = round((total_cpu_usage / cpu_baseline * 100), 2) if pod_count > 0 and cpu_baseline > 0 else 0
-            
-            # Calculate memory usage percentage
-            # If no memory requests are defined, use system memory as baseline
-            virtual_memory_total = psutil.virtual_memory().total
-            memory_baseline = total_memory_requests if total_memory_requests > 0 else virtual_memory_total
-            memory_usage_percentage = round((total_memory_usage / memory_baseline * 100), 2) if pod_count > 0 and memory_baseline > 0 else 0
+            # CPU usage is relative to the CPU requests (1 core per pod if not defined) and
+            # memory usage is relative to the memory requests (system memory if not defined)
+            cpu_usage_percentage = memory_usage_percentage = 0
+            if need_metrics:
+                virtual_memory_total = psutil.virtual_memory().total
+                cpu_usage_percentage, memory_usage_percentage = accounting.usage_percentages(virtual_memory_total)
 
             app = {
                 "app_name": app_name,
                 "namespace": namespace,
                 "status": app_status,
-                "creation_time": creation_time.isoformat(),
-                "last_update_time": last_update_time.isoformat(),
+                "creation_time": creation_time.isoformat() if creation_time else None,
+                "last_update_time": last_update_time.isoformat() if last_update_time else None,
                 "pods": pods_,
                 "replicas": {
                   "desired": desired_replicas,
@@ -446,99 +558,105 @@ class K3sHelper:
             }
             if app_uptime is not None:
                 app["uptime"] = app_uptime
+            if fields is not APP_STATUS_FIELDS:
+                app = {key: value for key, value in app.items() if key in fields or key in ["app_name", "namespace"]}
             return app
         else:
             return None
 
         
     def get_app_status_and_logs(self, app_name: str, namespace: str, tail_n_lines, previous_logs:bool):
-        # create API clients
         app = self.get_app_status(app_name, namespace)
         if app:
-            core_v1_api = client.CoreV1Api()
-            apps_v1_api = client.AppsV1Api()
-            deployment = apps_v1_api.read_namespaced_deployment(app_name, namespace)
-            selector = deployment.spec.selector.match_labels
-            label_selector = ",".join(f"{k}={v}" for k, v in selector.items())
-            pods = core_v1_api.list_namespaced_pod(namespace, label_selector=label_selector)
-            logs = []
-            # get pod level logs
-            problematic_pod_update_time = None
-            for pod in pods.items:
-                pod_name = pod.metadata.name
+            app["logs"] = list(self.iter_app_logs(app_name, namespace, tail_n_lines, previous_logs))
+            return app
+        else:
+            raise RuntimeError("app not found")
+
+    # This function yields the log entries of the app's containers one at a time, followed by the app level error
+    # events entry. max_lines splits the logs of a container into multiple entries of at most max_lines lines
+    def iter_app_logs(self, app_name: str, namespace: str, tail_n_lines, previous_logs: bool, max_lines: Optional[int] = None):
+        core_v1_api = client.CoreV1Api(self.api_client)
+        deployment = self.read_deployment_record(app_name, namespace)
+        pods = self.list_pod_records(namespace, deployment.label_selector)
+        # get pod level logs
+        problematic_pod_update_time = None
+        for pod in pods:
+            pod_name = pod.name
+            for container in pod.containers:
+                container_name = container.name
                 lines = []
-                for container in pod.spec.containers:
-                    container_name = container.name
-                    try:
-                        log_string = core_v1_api.read_namespaced_pod_log(
-                                        name=pod_name,
-                                        namespace=namespace,
-                                        container=container_name,
-                                        tail_lines=tail_n_lines,
-                                        previous = previous_logs
-                                    )
-                        lines = log_string.split('\n')
-                        lines = [line for line in lines if line]
-                    except Exception as ex:
-                        # ignore, exception will be thrown if previous container is not found
-                        pass
-                    logs.append({
+                try:
+                    log_string = core_v1_api.read_namespaced_pod_log(
+                                    name=pod_name,
+                                    namespace=namespace,
+                                    container=container_name,
+                                    tail_lines=tail_n_lines,
+                                    previous = previous_logs
+                                )
+                    lines = log_string.split('\n')
+                    lines = [line for line in lines if line]
+                except Exception as ex:
+                    # ignore, exception will be thrown if previous container is not found
+                    pass
+                if max_lines and len(lines) > max_lines:
+                    for index in range(0, len(lines), max_lines):
+                        yield {
+                            "pod": pod_name,
+                            "container": container_name,
+                            "logs": lines[index:index + max_lines]
+                        }
+                else:
+                    yield {
                         "pod": pod_name,
                         "container": container_name,
                         "logs": lines
-                    })
-                if pod.status.phase != 'Running':
-                    pod_last_update_time = min(managed_field.time for managed_field in pod.metadata.managed_fields)
-                    if problematic_pod_update_time == None:
+                    }
+            if pod.phase != 'Running' and pod.managed_time is not None:
+                pod_last_update_time = pod.managed_time
+                if problematic_pod_update_time == None:
+                    problematic_pod_update_time = pod_last_update_time
+                else:
+                    if problematic_pod_update_time > pod_last_update_time:
                         problematic_pod_update_time = pod_last_update_time
-                    else:
-                        if problematic_pod_update_time > pod_last_update_time:
-                            problematic_pod_update_time = pod_last_update_time
 
-            
-            lines = []
-            # if any pod is not in 'Running' state, get app level error logs if any
-            if problematic_pod_update_time is not None:
-                events = core_v1_api.list_namespaced_event(namespace)
-                problematic_pod_update_time = problematic_pod_update_time - timedelta(seconds=10)
-                print(f"problematic_pod_update_time: {problematic_pod_update_time}");
-                for event in events.items:
-                    if event.involved_object.name.startswith(app_name):
-                        # only include events that occurred after the current deployment was created
-                        if event.first_timestamp and event.first_timestamp >= problematic_pod_update_time:
-                            if event.reason in ["Failed", "BackOff", "Error", "Warning"]:
-                                line = f"{event.reason}: {event.message}"
-                                lines.append(line)
-            logs.append({
-                "app": app_name,
-                "logs": lines
-            })
-            app["logs"] = logs
-            return app
-        else:
-            raise RuntimeError("app not found")
+        lines = []
+        # if any pod is not in 'Running' state, get app level error logs if any
+        if problematic_pod_update_time is not None:
+            response = core_v1_api.list_namespaced_event(namespace, _preload_content=False)
+            events = json.loads(response.data).get("items") or []
+            problematic_pod_update_time = problematic_pod_update_time - timedelta(seconds=10)
+            for event in events:
+                involved_object_name = (event.get("involvedObject") or {}).get("name") or ""
+                if involved_object_name.startswith(app_name):
+                    # only include events that occurred after the current deployment was created
+                    first_timestamp = parse_k8s_timestamp(event.get("firstTimestamp"))
+                    if first_timestamp and first_timestamp >= problematic_pod_update_time:
+                        reason = event.get("reason")
+                        if reason in ["Failed", "BackOff", "Error", "Warning"]:
+                            line = f"{reason}: {event.get('message')}"
+                            lines.append(line)
+        yield {
+            "app": app_name,
+            "logs": lines
+        }
         
     def get_deployment_status(self, app_name: str, namespace: str="dafault"):
-        core_v1_api = client.CoreV1Api()
-        apps_v1_api = client.AppsV1Api()
-        metrics_api = client.CustomObjectsApi()
         try:
-            deployment = apps_v1_api.read_namespaced_deployment(app_name, namespace)
+            deployment = self.read_deployment_record(app_name, namespace)
         except Exception as ex:
             return None
         if deployment:
-            creation_time = deployment.metadata.creation_timestamp
-            last_update_time = deployment.status.conditions[-1].last_update_time
-            desired_replicas = deployment.spec.replicas or 0
-            available_replicas = deployment.status.available_replicas or 0
-            updated_replicas = deployment.status.updated_replicas or 0
-            unavailable_replicas = deployment.status.unavailable_replicas or 0
+            creation_time = deployment.creation_timestamp
+            last_update_time = deployment.last_update_time
+            desired_replicas = deployment.replicas
+            available_replicas = deployment.available_replicas
+            updated_replicas = deployment.updated_replicas
+            unavailable_replicas = deployment.unavailable_replicas
 
             app_uptime = None
-            match_labels = deployment.spec.selector.match_labels
-            label_selector = ",".join([f"{k}={v}" for k, v in match_labels.items()])
-            pods = core_v1_api.list_namespaced_pod(namespace=namespace, label_selector=label_selector).items
-            statuses = [pod.status.phase for pod in pods]
+            pods = self.list_pod_records(namespace, deployment.label_selector)
+            statuses = [pod.phase for pod in pods]
 
             app_status = "Unknown"
             if desired_replicas == 0 and len(pods) == 0:
@@ -559,8 +677,8 @@ class K3sHelper:
                     app_status = "Pending"
                     
             for pod in pods:
-                status = pod.status.phase
-                start_time = pod.status.start_time
+                status = pod.phase
+                start_time = pod.start_time
                 if start_time is not None:
                     # get system boot time to handle reboot scenarios
                     boot_time = self.get_system_boot_time()
@@ -581,13 +699,14 @@ class K3sHelper:
                 "app_name": app_name,
                 "namespace": namespace,
                 "status": app_status,
-                "creation_time": creation_time.isoformat(),
-                "last_update_time": last_update_time.isoformat(),
+                "creation_time": creation_time.isoformat() if creation_time else None,
+                "last_update_time": last_update_time.isoformat() if last_update_time else None,
                 "replicas": {
                   "desired": desired_replicas,
                   "available": available_replicas,
                   "updated": updated_replicas,
-                  "unavailable": unavailable_replicas
+                  "unavailable": unavailable_replicas,
+                  "ready": deployment.ready_replicas
                 }
             }
             if app_uptime is not None:
@@ -597,53 +716,52 @@ class K3sHelper:
             return None
             
     # This function gets the status of all the deployments/apps
-    def get_apps_status(self):
-        apps_v1_api = client.AppsV1Api()
-        # fetch deployments in all namespaces
-        deployments = apps_v1_api.list_deployment_for_all_namespaces()
-        apps = []
-        for deployment in deployments.items:
-            name = deployment.metadata.name
-            namespace = deployment.metadata.namespace
-            if namespace != 'kube-system':
-                app = self.get_app_status(name, namespace)
-                apps.append(app)
-        return apps
+    # namespaces, label_selector: filters pushed down to the deployments list call, fields: app status fields projection
+    def get_apps_status(self, namespaces: Optional[List[str]] = None, label_selector: Optional[str] = None,
+                        fields: Optional[List[str]] = None):
+        return list(self.iter_apps_status(namespaces, label_selector, fields))
+
+    # This function yields the apps' status one at a time, the deployments are listed in pages of page_size
+    def iter_apps_status(self, namespaces: Optional[List[str]] = None, label_selector: Optional[str] = None,
+                         fields: Optional[List[str]] = None, page_size: Optional[int] = None):
+        # fetch deployments in all namespaces except 'kube-system'
+        for deployment in self.iter_deployment_records(namespaces, label_selector, True, page_size):
+            app = self.get_app_status(deployment.name, deployment.namespace, fields, deployment)
+            if app is not None:
+                yield app
 
     # This function deletes the specified deployment/app from the k3s cluster
     def delete_app(self, app_name: str, namespace: str = "default"):
-        apps_v1_api = client.AppsV1Api()
+        apps_v1_api = client.AppsV1Api(self.api_client)
         apps_v1_api.delete_namespaced_deployment(
             name=app_name,
             namespace=namespace,
             body=client.V1DeleteOptions()
         )
         # wait for the deployment to get deleted
-        wait_event = threading.Event()
         for _ in range(60):
             try:
-                apps_v1_api.read_namespaced_deployment(app_name, namespace)
-            except ApiException as ex:
+                apps_v1_api.read_namespaced_deployment(app_name, namespace, _preload_content=False)
+            except kube_exceptions.ApiException as ex:
                 # check if the deployment is deleted
                 if ex.status == 404:
                     break
-            wait_event.wait(1)
+            self._wait(1)
 
     # This function deletes the specified image from the k3s cluster
     def delete_image(self, target_image: str, force: bool = False) -> None:
-        apps_v1_api = client.AppsV1Api()
         if force == False:
             logger.info("delete_image, checking whether any apps using the image")
-            deployments = apps_v1_api.list_deployment_for_all_namespaces()
+            deployments = self.list_deployment_records()
             images_in_use = set()
-            for deployment in deployments.items:
-                for container in deployment.spec.template.spec.containers:
+            for deployment in deployments:
+                for container in deployment.containers:
                     images_in_use.add(container.image)
 
             if target_image in images_in_use:
                 raise RuntimeError("The specified image is in use!")
 
-        result = subprocess.run(
+        result = run_subprocess(
             ['sudo', 'crictl', 'rmi', target_image],
             text=True,
             stdout=subprocess.PIPE,
@@ -658,21 +776,75 @@ class K3sHelper:
             raise RuntimeError(error)
 
     # This function deletes all the deployed apps and imported images from the system
-    def delete_all_apps_and_images(self):
-        apps_v1_api = client.AppsV1Api()
-        deployments = apps_v1_api.list_deployment_for_all_namespaces()
-        for deployment in deployments.items:
-            app_name = deployment.metadata.name
-            namespace = deployment.metadata.namespace
-            if namespace != 'kube-system':
-                try:
-                    self.delete_app(app_name, namespace)
-                except Exception as ex:
-                    pass
-            
+    # progress: optional callback called with the number of the apps and images remaining
+    def delete_all_apps_and_images(self, progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        deployments = [deployment for deployment in self.list_deployment_records() if deployment.namespace != 'kube-system']
         images = self.get_imported_images()
+        total = len(deployments) + len(images)
+        remaining = total
+        for deployment in deployments:
+            self._check_cancelled()
+            if progress is not None:
+                progress({"stage": "apps", "total": total, "remaining": remaining})
+            try:
+                self.delete_app(deployment.name, deployment.namespace)
+            except RequestCancelledError:
+                raise
+            except Exception as ex:
+                pass
+            remaining -= 1
+
         for image in images:
+            self._check_cancelled()
+            if progress is not None:
+                progress({"stage": "images", "total": total, "remaining": remaining})
             try:
                 self.delete_image(image, True)
             except Exception as ex:
                 pass
+            remaining -= 1
+        if progress is not None:
+            progress({"stage": "images", "total": total, "remaining": 0})
+
+# This function wraps the K3sHelper method, its duration is recorded, it is traced as a span 'k3s.<name>' and its
+# Kubernetes API calls are labelled with its name (the innermost method when they are nested); the generator methods
+# are labelled and timed only while producing the items, not while the caller consumes them, and are not traced
+def _instrument_method(name: str, method: Callable) -> Callable:
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(*args, **kwargs):
+            items = method(*args, **kwargs)
+            elapsed = 0.0
+            try:
+                while True:
+                    previous = getattr(_current_method, "name", None)
+                    _current_method.name = name
+                    start = time.monotonic()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.monotonic() - start
+                        _current_method.name = previous
+                    yield item
+            finally:
+                HELPER_DURATION.observe(elapsed * 1000, method=name)
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_current_method, "name", None)
+        _current_method.name = name
+        start = time.monotonic()
+        try:
+            with span(f"k3s.{name}"):
+                return method(*args, **kwargs)
+        finally:
+            _current_method.name = previous
+            HELPER_DURATION.observe((time.monotonic() - start) * 1000, method=name)
+    return wrapper
+
+for _name, _method in list(vars(K3sHelper).items()):
+    if not _name.startswith("_") and inspect.isfunction(_method):
+        setattr(K3sHelper, _name, _instrument_method(_name, _method))
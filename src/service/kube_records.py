@@ -0,0 +1,131 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from datetime import datetime
+from typing import Dict, List, Optional
+from utils.commons import parse_k8s_timestamp
+
+# Compact records holding only the fields of the Kubernetes objects used by the status code. These are built
+# directly from the raw JSON responses (_preload_content=False) instead of the OpenAPI model objects.
+
+class ContainerRecord:
+    __slots__ = ("name", "image", "image_pull_policy", "requests", "limits")
+
+    def __init__(self, name: str, image: str, image_pull_policy: Optional[str], requests: Optional[Dict], limits: Optional[Dict]):
+        self.name = name
+        self.image = image
+        self.image_pull_policy = image_pull_policy
+        self.requests = requests
+        self.limits = limits
+
+    @classmethod
+    def from_dict(cls, container: Dict) -> "ContainerRecord":
+        resources = container.get("resources") or {}
+        return cls(
+            container.get("name"),
+            container.get("image"),
+            container.get("imagePullPolicy"),
+            resources.get("requests"),
+            resources.get("limits")
+        )
+
+class PodRecord:
+    __slots__ = ("name", "namespace", "uid", "phase", "qos_class", "start_time", "containers", "container_ids", "managed_time")
+
+    def __init__(self, name: str, namespace: str, uid: str, phase: Optional[str], qos_class: Optional[str],
+                 start_time: Optional[datetime], containers: List[ContainerRecord], container_ids: Dict[str, str],
+                 managed_time: Optional[datetime]):
+        self.name = name
+        self.namespace = namespace
+        self.uid = uid
+        self.phase = phase
+        self.qos_class = qos_class
+        self.start_time = start_time
+        self.containers = containers
+        self.container_ids = container_ids
+        # the earliest time of the pod's managed fields
+        self.managed_time = managed_time
+
+    @classmethod
+    def from_dict(cls, pod: Dict) -> "PodRecord":
+        metadata = pod.get("metadata") or {}
+        spec = pod.get("spec") or {}
+        status = pod.get("status") or {}
+        container_ids = {}
+        for container_status in status.get("containerStatuses") or []:
+            container_ids[container_status.get("name")] = container_status.get("containerID")
+        managed_times = [parse_k8s_timestamp(field.get("time")) for field in metadata.get("managedFields") or [] if field.get("time")]
+        return cls(
+            metadata.get("name"),
+            metadata.get("namespace"),
+            metadata.get("uid"),
+            status.get("phase"),
+            status.get("qosClass"),
+            parse_k8s_timestamp(status.get("startTime")),
+            [ContainerRecord.from_dict(container) for container in spec.get("containers") or []],
+            container_ids,
+            min(managed_times) if managed_times else None
+        )
+
+class DeploymentRecord:
+    __slots__ = ("name", "namespace", "creation_timestamp", "last_update_time", "replicas", "available_replicas",
+                 "updated_replicas", "unavailable_replicas", "ready_replicas", "match_labels", "containers")
+
+    def __init__(self, name: str, namespace: str, creation_timestamp: Optional[datetime], last_update_time: Optional[datetime],
+                 replicas: int, available_replicas: int, updated_replicas: int, unavailable_replicas: int,
+                 ready_replicas: int, match_labels: Dict[str, str], containers: List[ContainerRecord]):
+        self.name = name
+        self.namespace = namespace
+        self.creation_timestamp = creation_timestamp
+        self.last_update_time = last_update_time
+        self.replicas = replicas
+        self.available_replicas = available_replicas
+        self.updated_replicas = updated_replicas
+        self.unavailable_replicas = unavailable_replicas
+        self.ready_replicas = ready_replicas
+        self.match_labels = match_labels
+        self.containers = containers
+
+    @property
+    def label_selector(self) -> str:
+        return ",".join([f"{k}={v}" for k, v in self.match_labels.items()])
+
+    @classmethod
+    def from_dict(cls, deployment: Dict) -> "DeploymentRecord":
+        metadata = deployment.get("metadata") or {}
+        spec = deployment.get("spec") or {}
+        status = deployment.get("status") or {}
+        conditions = status.get("conditions") or []
+        template_spec = (spec.get("template") or {}).get("spec") or {}
+        return cls(
+            metadata.get("name"),
+            metadata.get("namespace"),
+            parse_k8s_timestamp(metadata.get("creationTimestamp")),
+            parse_k8s_timestamp(conditions[-1].get("lastUpdateTime")) if conditions else None,
+            spec.get("replicas") or 0,
+            status.get("availableReplicas") or 0,
+            status.get("updatedReplicas") or 0,
+            status.get("unavailableReplicas") or 0,
+            status.get("readyReplicas") or 0,
+            (spec.get("selector") or {}).get("matchLabels") or {},
+            [ContainerRecord.from_dict(container) for container in template_spec.get("containers") or []]
+        )
@@ -0,0 +1,141 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re, math
+from array import array
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+# Kubernetes quantity: <signedNumber><suffix>, suffix is binarySI, decimalSI or decimalExponent
+_QUANTITY_PATTERN = re.compile(r"^([+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))(Ki|Mi|Gi|Ti|Pi|Ei|[eE][+-]?[0-9]+|[numkMGTPE])?$")
+
+_SUFFIX_MULTIPLIERS = {
+    None: 1,
+    "n": 1e-9,
+    "u": 1e-6,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+    "Ki": 2 ** 10,
+    "Mi": 2 ** 20,
+    "Gi": 2 ** 30,
+    "Ti": 2 ** 40,
+    "Pi": 2 ** 50,
+    "Ei": 2 ** 60,
+}
+
+# This function parses the Kubernetes quantity string (e.g. "250m", "1.5", "128Mi", "1G", "12e6") into
+# the base unit value, i.e. cores for CPU and bytes for memory. The results are memoized, as the same
+# handful of quantities are repeated across the pods and status queries.
+@lru_cache(maxsize=4096)
+def parse_quantity(quantity) -> float:
+    if quantity is None:
+        return 0.0
+    if isinstance(quantity, (int, float)):
+        return float(quantity)
+    match = _QUANTITY_PATTERN.match(quantity.strip())
+    if match is None:
+        raise ValueError(f"invalid quantity: {quantity}")
+    number, suffix = match.groups()
+    if suffix is not None and suffix[0] in "eE" and len(suffix) > 1:
+        return float(number) * (10 ** int(suffix[1:]))
+    return float(number) * _SUFFIX_MULTIPLIERS[suffix]
+
+def parse_quantity_or_zero(quantity) -> float:
+    try:
+        return parse_quantity(quantity)
+    except (ValueError, TypeError):
+        return 0.0
+
+# This class accumulates the CPU/memory requests, limits and usage of the pods in columnar arrays
+# (one entry per pod) and aggregates them in one pass. CPU values are in cores and memory in bytes.
+class ResourceAccounting:
+    COLUMNS = ["cpu_requests", "memory_requests", "cpu_limits", "memory_limits", "cpu_usage", "memory_usage"]
+
+    def __init__(self):
+        self.cpu_requests = array("d")
+        self.memory_requests = array("d")
+        self.cpu_limits = array("d")
+        self.memory_limits = array("d")
+        self.cpu_usage = array("d")
+        self.memory_usage = array("d")
+        # 1 when the usage metrics are available for the pod, else 0
+        self.has_usage = array("b")
+
+    def __len__(self):
+        return len(self.has_usage)
+
+    # containers_resources: iterable of (requests, limits) dicts of the pod's containers,
+    # usage: (cpu, memory) of the pod in base units, None if the metrics are not available
+    def add_pod(self, containers_resources: Iterable[Tuple[Optional[Dict], Optional[Dict]]], usage: Optional[Tuple[float, float]] = None):
+        cpu_requests = memory_requests = cpu_limits = memory_limits = 0.0
+        for requests, limits in containers_resources:
+            if requests:
+                cpu_requests += parse_quantity_or_zero(requests.get("cpu"))
+                memory_requests += parse_quantity_or_zero(requests.get("memory"))
+            if limits:
+                cpu_limits += parse_quantity_or_zero(limits.get("cpu"))
+                memory_limits += parse_quantity_or_zero(limits.get("memory"))
+        self.cpu_requests.append(cpu_requests)
+        self.memory_requests.append(memory_requests)
+        self.cpu_limits.append(cpu_limits)
+        self.memory_limits.append(memory_limits)
+        if usage is None:
+            self.cpu_usage.append(0.0)
+            self.memory_usage.append(0.0)
+            self.has_usage.append(0)
+        else:
+            self.cpu_usage.append(usage[0])
+            self.memory_usage.append(usage[1])
+            self.has_usage.append(1)
+
+    def totals(self) -> Dict[str, float]:
+        totals = {column: math.fsum(getattr(self, column)) for column in self.COLUMNS}
+        totals["pods_with_usage"] = sum(self.has_usage)
+        return totals
+
+    # This function computes the CPU and memory usage percentages of the pods. CPU usage is relative to the
+    # total CPU requests, or 1 core per pod if no requests are defined. Memory usage is relative to the total
+    # memory requests, or the system memory if no requests are defined.
+    def usage_percentages(self, system_memory: float) -> Tuple[float, float]:
+        totals = self.totals()
+        pod_count = totals["pods_with_usage"]
+        if pod_count == 0:
+            return 0, 0
+        cpu_baseline = totals["cpu_requests"] if totals["cpu_requests"] > 0 else pod_count
+        memory_baseline = totals["memory_requests"] if totals["memory_requests"] > 0 else system_memory
+        cpu_usage_percentage = round(totals["cpu_usage"] / cpu_baseline * 100, 2) if cpu_baseline > 0 else 0
+        memory_usage_percentage = round(totals["memory_usage"] / memory_baseline * 100, 2) if memory_baseline > 0 else 0
+        return cpu_usage_percentage, memory_usage_percentage
+
+# This function sums up the usage reported by metrics-server for the containers of a pod, returns (cpu, memory)
+def sum_container_metrics(container_metrics: Iterable[Dict]) -> Tuple[float, float]:
+    cpu = memory = 0.0
+    for container_metric in container_metrics:
+        usage = container_metric.get("usage", {})
+        cpu += parse_quantity_or_zero(usage.get("cpu", "0"))
+        memory += parse_quantity_or_zero(usage.get("memory", "0"))
+    return cpu, memory
@@ -0,0 +1,125 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, json, gzip, time, threading
+from typing import Any, Dict, Optional, Tuple
+from utils.logger import get_logger
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# version of the snapshot file format, a file of another version is ignored
+SNAPSHOT_VERSION = 1
+
+# parts of the snapshot
+APPS = "apps"
+RESOURCES = "resources"
+IMAGES = "images"
+SNAPSHOT_PARTS = (APPS, RESOURCES, IMAGES)
+
+# This class keeps the latest apps, resources and image inventory on the disk (gzipped compact JSON under the home
+# directory) so that after a restart the queries can be answered right away from the previous run's data while the
+# k3s API server is still starting. A part loaded from the file is stale until it is updated by a live computation
+# in this run. The file is written atomically (temporary file, fsync, rename), at most once per write interval.
+class StatusSnapshot:
+    def __init__(self, file_path: str, write_interval: float = 60):
+        self._file_path = file_path
+        self._write_interval = write_interval
+        self._lock = threading.Lock()
+        # part -> {"data": ..., "time": epoch seconds of the computation}
+        self._parts: Dict[str, Dict[str, Any]] = {}
+        # parts updated by a live computation in this run
+        self._synced = set()
+        self._dirty = False
+        self._last_write = 0.0
+        self._load()
+
+    # This function loads the snapshot of the previous run, a missing or corrupted file is an empty snapshot
+    def _load(self):
+        if not os.path.exists(self._file_path):
+            return
+        try:
+            with gzip.open(self._file_path, "rt") as file:
+                snapshot = json.load(file)
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                logger.warning(f"ignoring the status snapshot of version {snapshot.get('version')}")
+                return
+            self._parts = {part: value for part, value in snapshot.get("parts", {}).items() if part in SNAPSHOT_PARTS}
+            logger.info(f"status snapshot loaded, parts: {sorted(self._parts)}")
+        except Exception as ex:
+            logger.warning(f"failed to load the status snapshot: {ex}")
+
+    def set_write_interval(self, write_interval: float):
+        self._write_interval = write_interval
+
+    # This function sets a part computed live, the snapshot is written when the write interval has passed
+    def update(self, part: str, data: Any):
+        with self._lock:
+            self._parts[part] = {"data": data, "time": time.time()}
+            self._synced.add(part)
+            self._dirty = True
+        self.save()
+
+    # This function gets the data of a part and whether it is stale (loaded from the disk, not yet computed live),
+    # (None, True) when the part is not known
+    def get(self, part: str) -> Tuple[Optional[Any], bool]:
+        with self._lock:
+            value = self._parts.get(part)
+            if value is None:
+                return None, True
+            return value["data"], part not in self._synced
+
+    # This function gets the time the part was computed, epoch seconds
+    def get_time(self, part: str) -> Optional[float]:
+        with self._lock:
+            value = self._parts.get(part)
+            return value["time"] if value is not None else None
+
+    def is_synced(self, part: str) -> bool:
+        with self._lock:
+            return part in self._synced
+
+    # This function writes the snapshot to the disk if it has changed since the last write, once per write interval
+    # unless forced (e.g. at the shutdown)
+    def save(self, force: bool = False):
+        with self._lock:
+            if not self._dirty or (not force and time.monotonic() - self._last_write < self._write_interval):
+                return
+            snapshot = {"version": SNAPSHOT_VERSION, "saved_at": time.time(), "parts": dict(self._parts)}
+            self._dirty = False
+            self._last_write = time.monotonic()
+        try:
+            self._write(snapshot)
+        except Exception as ex:
+            logger.warning(f"failed to save the status snapshot: {ex}")
+            with self._lock:
+                self._dirty = True
+
+    def _write(self, snapshot: Dict[str, Any]):
+        os.makedirs(os.path.dirname(self._file_path), exist_ok=True)
+        tmp_path = self._file_path + ".tmp"
+        data = json.dumps(snapshot, separators=(",", ":")).encode()
+        with open(tmp_path, "wb") as file:
+            file.write(gzip.compress(data))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self._file_path)
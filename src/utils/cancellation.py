@@ -0,0 +1,87 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading, time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+# This exception is raised by the long running operations when their request is cancelled or its deadline is passed,
+# status is the terminal status reported for the request ('Cancelled' or 'Expired')
+class RequestCancelledError(Exception):
+    def __init__(self, status: str, message: str):
+        super().__init__(message)
+        self.status = status
+
+# This function gets the deadline (epoch seconds) of the request from its optional 'deadline' (epoch seconds or an
+# ISO 8601 time) and 'ttl' (seconds from the time the request is received) fields, the earlier one is taken
+def get_request_deadline(payload: Dict[str, Any], received_time: Optional[float] = None) -> Optional[float]:
+    deadlines = []
+    deadline = payload.get("deadline")
+    if isinstance(deadline, (int, float)) and not isinstance(deadline, bool):
+        deadlines.append(float(deadline))
+    elif isinstance(deadline, str):
+        deadlines.append(datetime.fromisoformat(deadline.replace("Z", "+00:00")).timestamp())
+    elif deadline is not None:
+        raise RuntimeError("deadline should be epoch seconds or an ISO 8601 time")
+    ttl = payload.get("ttl")
+    if ttl is not None:
+        if not isinstance(ttl, (int, float)) or isinstance(ttl, bool) or ttl <= 0:
+            raise RuntimeError("ttl should be a positive number of seconds")
+        deadlines.append((received_time or time.time()) + ttl)
+    return min(deadlines) if deadlines else None
+
+# This class is the cancellation token of a request, it is cancelled by a 'cancel_request' or when the deadline of
+# the request is passed. The wait loops of the operations wait on the token so they stop promptly on the cancellation.
+class CancellationToken:
+    def __init__(self, deadline: Optional[float] = None):
+        self._event = threading.Event()
+        self._deadline = deadline
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def status(self) -> Optional[str]:
+        if self._event.is_set():
+            return "Cancelled"
+        if self._deadline is not None and time.time() >= self._deadline:
+            return "Expired"
+        return None
+
+    def is_cancelled(self) -> bool:
+        return self.status is not None
+
+    # This function raises RequestCancelledError if the request is cancelled or expired
+    def check(self):
+        status = self.status
+        if status == "Cancelled":
+            raise RequestCancelledError(status, "the request is cancelled")
+        if status == "Expired":
+            raise RequestCancelledError(status, "the deadline of the request is passed")
+
+    # This function waits for the given seconds, raises RequestCancelledError as soon as the request is cancelled
+    # or its deadline is passed
+    def wait(self, seconds: float):
+        if self._deadline is not None:
+            seconds = min(seconds, max(self._deadline - time.time(), 0))
+        self._event.wait(seconds)
+        self.check()
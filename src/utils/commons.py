@@ -22,7 +22,6 @@
 
 import json, tarfile
 from datetime import datetime, timezone
-from kubernetes.client.exceptions import ApiException
 import random
 import string
 
@@ -36,7 +35,7 @@ def genearte_random_string(length: int = 10):
     random_string = ''.join(random.choices(characters, k=length))
     return random_string
 
-def format_k3s_api_error(ex: ApiException):
+def format_k3s_api_error(ex: "kubernetes.client.exceptions.ApiException"):
     # capture the error details and notify the client
     body = json.loads(ex.body) or dict()
     status = ex.status or ""
@@ -72,4 +71,12 @@ def format_uptime(start_time):
         result = f"{minutes}m {seconds}s"
     else:
         result = f"{seconds}s"
-    return result            
\ No newline at end of file
+    return result
+
+def parse_k8s_timestamp(value):
+    # parse the RFC3339 timestamp of Kubernetes API (e.g. 2024-01-01T10:00:00Z) into timezone aware datetime
+    if value is None:
+        return None
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
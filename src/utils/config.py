@@ -20,17 +20,187 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import os
+import os, threading
 import configparser
-from typing import Optional
+import dataclasses
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable, Iterable, List, Mapping, Optional, Tuple
 from utils.logger import get_logger
 
 current_file = os.path.basename(__file__)
 logger = get_logger(current_file)
 
+# interval of checking the configuration file for the changes, in seconds
+DEFAULT_WATCH_INTERVAL = 5
+
+# kubeconfig written by k3s
+DEFAULT_KUBE_CONFIG_FILE = "/etc/rancher/k3s/k3s.yaml"
+
+# MQTT version of the devices without the protocol_version setting, MQTT v5 is opted in through the configuration
+DEFAULT_MQTT_PROTOCOL_VERSION = "3.1"
+
+# fields which are applied only at the start of the service
+RESTART_FIELDS = frozenset(["home_dir", "runtime", "async_max_concurrency", "async_executor_workers",
+                            "outbox_max_entries", "outbox_max_bytes", "metrics_host", "metrics_port"])
+
+# This class is an immutable, typed snapshot of the configuration, parsed once from the configuration file. A new
+# snapshot is built on every reload and swapped in as a whole, so a reader always sees a consistent configuration.
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    home_dir: str
+    heartbeat_frequency: int
+    # interval of publishing the changed status of the running tasks, in seconds
+    task_status_tick: float
+    # interval of re-publishing an unchanged status of a running task, in seconds
+    task_status_keepalive: float
+    # min interval of publishing a progress-only change of a running task, in seconds
+    task_progress_interval: float
+    task_registry_max_entries: int
+    # time a finished request is kept in the task registry, in seconds
+    task_registry_ttl: float
+    # 'threads' or 'asyncio'
+    runtime: str
+    # max number of the read requests run concurrently by the asyncio runtime
+    async_max_concurrency: int
+    # threads of the executor running the blocking calls in the asyncio runtime
+    async_executor_workers: int
+    # interval of checking the configuration file for the changes, in seconds
+    config_watch_interval: float
+    # max number of the requests waiting in the intake queue
+    intake_max_size: int
+    # shedding policy of the intake queue, reject_newest, drop_oldest_read or coalesce
+    intake_policy: str
+    # max number of the queued requests of each idempotent read request type
+    intake_read_quota: int
+    # max number of the queued requests per request type, e.g. import_image:2,deploy_app:5
+    intake_quotas: Mapping[str, int]
+    mqtt_host: str
+    mqtt_port: int
+    mqtt_protocol: str
+    mqtt_user: str
+    mqtt_pwd: str
+    mqtt_device_key: str
+    mqtt_max_message_size: int
+    # 5, 3.1.1 or 3.1, MQTT v5 falls back to v3.1.1 when the broker does not support it
+    mqtt_protocol_version: str
+    mqtt_receive_maximum: int
+    # heartbeats not delivered within this interval are dropped by the broker (MQTT v5), 0 to disable
+    mqtt_heartbeat_expiry: int
+    mqtt_progress_expiry: int
+    # QoS per upstream message class, results at QoS 1, progress and heartbeats at QoS 0 by default
+    mqtt_qos: Mapping[str, int]
+    mqtt_inflight_window: int
+    # upstream encodings in the order of preference, e.g. msgpack+zlib,json+zlib,json
+    mqtt_encodings: Tuple[str, ...]
+    mqtt_compress_threshold: int
+    outbox_max_entries: int
+    outbox_max_bytes: int
+    # messages per second sent from the outbox after the reconnection
+    outbox_drain_rate: int
+    # min interval of writing the status snapshot to the disk, in seconds
+    snapshot_write_interval: float
+    # kubeconfig of the cluster API
+    kube_config_file: str
+    # auto: cgroup metrics when readable, else metrics-server; cgroup; metrics-server
+    metrics_source: str
+    # local address of the OpenMetrics endpoint (http://host:port/metrics), port 0 disables the endpoint
+    metrics_host: str
+    metrics_port: int
+    # file the received requests are recorded to for the replay (relative to the home directory), empty disables
+    # the recording; the secrets of the requests are masked unless recorder_redact is off
+    recorder_file: str
+    recorder_max_bytes: int
+    recorder_redact: bool
+    # file the request traces are exported to (relative to the home directory), empty disables the export
+    trace_file: str
+    trace_max_bytes: int
+    log_level: str
+    # min interval between the logged records of a repetitive activity (e.g. the heartbeat), in seconds, 0 logs all
+    log_sample_interval: float
+    log_max_bytes: int
+    log_backup_count: int
+    upstream_topic: str
+    downstream_topic: str
+
+    # This function parses the configuration, raises ValueError (or configparser.Error) for an invalid one
+    @classmethod
+    def parse(cls, config: configparser.ConfigParser, home_dir: str) -> "ConfigSnapshot":
+        heartbeat_frequency = int(config.get("general", "heartbeat_frequency"))
+        mqtt_user = config.get("mqtt", "user")
+        mqtt_device_key = config.get("mqtt", "device_key")
+        intake_quotas = {}
+        for item in config.get("intake", "quotas", fallback="").split(","):
+            if item.strip():
+                request, quota = item.split(":", 1)
+                intake_quotas[request.strip()] = int(quota)
+        encodings = config.get("mqtt", "encodings", fallback="json")
+        return cls(
+            home_dir=home_dir,
+            heartbeat_frequency=heartbeat_frequency,
+            task_status_tick=float(config.get("general", "task_status_tick", fallback="2")),
+            task_status_keepalive=float(config.get("general", "task_status_keepalive", fallback="10")),
+            task_progress_interval=float(config.get("general", "task_progress_interval", fallback="4")),
+            task_registry_max_entries=int(config.get("general", "task_registry_max_entries", fallback="500")),
+            task_registry_ttl=float(config.get("general", "task_registry_ttl", fallback="3600")),
+            runtime=config.get("general", "runtime", fallback="threads"),
+            async_max_concurrency=int(config.get("general", "async_max_concurrency", fallback="4")),
+            async_executor_workers=int(config.get("general", "async_executor_workers", fallback="4")),
+            config_watch_interval=float(config.get("general", "config_watch_interval", fallback=str(DEFAULT_WATCH_INTERVAL))),
+            intake_max_size=int(config.get("intake", "max_size", fallback="100")),
+            intake_policy=config.get("intake", "policy", fallback="reject_newest"),
+            intake_read_quota=int(config.get("intake", "read_quota", fallback="10")),
+            intake_quotas=MappingProxyType(intake_quotas),
+            mqtt_host=config.get("mqtt", "host"),
+            mqtt_port=int(config.get("mqtt", "port")),
+            mqtt_protocol=config.get("mqtt", "protocol"),
+            mqtt_user=mqtt_user,
+            mqtt_pwd=config.get("mqtt", "password"),
+            mqtt_device_key=mqtt_device_key,
+            mqtt_max_message_size=int(config.get("mqtt", "max_message_size", fallback="262144")),
+            mqtt_protocol_version=config.get("mqtt", "protocol_version", fallback=DEFAULT_MQTT_PROTOCOL_VERSION),
+            mqtt_receive_maximum=int(config.get("mqtt", "receive_maximum", fallback="10")),
+            mqtt_heartbeat_expiry=int(config.get("mqtt", "heartbeat_expiry", fallback=str(2 * heartbeat_frequency))),
+            mqtt_progress_expiry=int(config.get("mqtt", "progress_expiry", fallback="30")),
+            mqtt_qos=MappingProxyType({
+                "result": int(config.get("mqtt", "qos_result", fallback="1")),
+                "progress": int(config.get("mqtt", "qos_progress", fallback="0")),
+                "heartbeat": int(config.get("mqtt", "qos_heartbeat", fallback="0"))
+            }),
+            mqtt_inflight_window=int(config.get("mqtt", "inflight_window", fallback="20")),
+            mqtt_encodings=tuple(encoding.strip() for encoding in encodings.split(",") if encoding.strip()),
+            mqtt_compress_threshold=int(config.get("mqtt", "compress_threshold", fallback="1024")),
+            outbox_max_entries=int(config.get("outbox", "max_entries", fallback="1000")),
+            outbox_max_bytes=int(config.get("outbox", "max_bytes", fallback=str(5 * 1024 * 1024))),
+            outbox_drain_rate=int(config.get("outbox", "drain_rate", fallback="10")),
+            snapshot_write_interval=float(config.get("snapshot", "write_interval", fallback="60")),
+            kube_config_file=config.get("k3s", "kube_config", fallback=DEFAULT_KUBE_CONFIG_FILE),
+            metrics_source=config.get("metrics", "source", fallback="auto"),
+            metrics_host=config.get("metrics", "host", fallback="127.0.0.1"),
+            metrics_port=int(config.get("metrics", "port", fallback="9464")),
+            recorder_file=config.get("recorder", "file", fallback=""),
+            recorder_max_bytes=int(config.get("recorder", "max_bytes", fallback=str(10 * 1024 * 1024))),
+            recorder_redact=config.getboolean("recorder", "redact", fallback=True),
+            trace_file=config.get("tracing", "file", fallback=""),
+            trace_max_bytes=int(config.get("tracing", "max_bytes", fallback=str(5 * 1024 * 1024))),
+            log_level=config.get("logging", "level", fallback="INFO"),
+            log_sample_interval=float(config.get("logging", "sample_interval", fallback="60")),
+            log_max_bytes=int(config.get("logging", "max_bytes", fallback="1000000")),
+            log_backup_count=int(config.get("logging", "backup_count", fallback="3")),
+            upstream_topic=f"/{mqtt_user}/{mqtt_device_key}/upstream_edge_k3s",
+            downstream_topic=f"/{mqtt_user}/{mqtt_device_key}/downstream_edge_k3s"
+        )
+
+    # This function gets the names of the fields whose values differ in the other snapshot
+    def changed_fields(self, other: "ConfigSnapshot") -> List[str]:
+        return [field.name for field in dataclasses.fields(self) if getattr(self, field.name) != getattr(other, field.name)]
+
+# This class is the configuration of the service, loaded from config/config.ini of the home directory. The values
+# are read from the current ConfigSnapshot, which is replaced on reload (SIGHUP or a change of the file). The
+# components subscribe to the fields they can apply without a restart.
 class AppConfig:
     _instance = None
-    _config = None
+    _snapshot: ConfigSnapshot = None
     
     def __new__(cls):
         if cls._instance is None:
@@ -39,7 +209,6 @@ class AppConfig:
         return cls._instance
     
     def _load_config(self):
-        self._config = configparser.ConfigParser()
         self._home_dir = os.getenv("K3S_THIN_CLIENT_HOME")
         
         if self._home_dir is None:
@@ -52,50 +221,270 @@ class AppConfig:
             logger.error(f"Configuration file not found: {self.config_file}")
             raise FileNotFoundError(f"Configuration file not found: {self.config_file}")
         
-        self._config.read(self.config_file)
+        # [(fields, callback)] called with the new snapshot when any of the fields changes
+        self._subscribers: List[Tuple[frozenset, Callable[[ConfigSnapshot], None]]] = []
+        self._reload_lock = threading.Lock()
+        self._reload_event = threading.Event()
+        self._watch_thread = None
+        self._mtime = os.stat(self.config_file).st_mtime_ns
+        self._snapshot = self._read()
         logger.info(f"Configuration loaded")
 
+    def _read(self) -> ConfigSnapshot:
+        config = configparser.ConfigParser()
+        config.read(self.config_file)
+        return ConfigSnapshot.parse(config, self._home_dir)
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        return self._snapshot
+
+    # This function registers the callback called with the new snapshot when any of the fields changes on reload,
+    # the callbacks are called in the order of subscription from the reloading thread
+    def subscribe(self, fields: Iterable[str], callback: Callable[[ConfigSnapshot], None]):
+        self._subscribers.append((frozenset(fields), callback))
+
+    # This function re-reads the configuration file and swaps in the new snapshot, an invalid configuration is
+    # logged and the current one is kept. Returns the names of the changed fields.
+    def reload(self) -> List[str]:
+        with self._reload_lock:
+            try:
+                self._mtime = os.stat(self.config_file).st_mtime_ns
+                snapshot = self._read()
+            except Exception as ex:
+                logger.error(f"invalid configuration, keeping the current one: {ex}")
+                return []
+            old_snapshot = self._snapshot
+            changed = old_snapshot.changed_fields(snapshot)
+            if not changed:
+                return []
+            self._snapshot = snapshot
+            logger.info(f"configuration reloaded, changed: {', '.join(changed)}")
+            restart_fields = RESTART_FIELDS.intersection(changed)
+            if restart_fields:
+                logger.warning(f"the change of {', '.join(sorted(restart_fields))} takes effect after a restart")
+            for fields, callback in self._subscribers:
+                if fields.intersection(changed):
+                    try:
+                        callback(snapshot)
+                    except Exception as ex:
+                        logger.error(f"failed to apply the configuration change: {ex}")
+            return changed
+
+    # This function asks the watcher thread to reload the configuration, safe to call from a signal handler
+    def request_reload(self):
+        self._reload_event.set()
+
+    # This function starts the thread reloading the configuration when the file changes or a reload is requested
+    def watch(self):
+        if self._watch_thread is None:
+            self._watch_thread = threading.Thread(target=self._watch, name="config-watch", daemon=True)
+            self._watch_thread.start()
+
+    def _watch(self):
+        while True:
+            requested = self._reload_event.wait(self._snapshot.config_watch_interval)
+            self._reload_event.clear()
+            try:
+                changed_on_disk = os.stat(self.config_file).st_mtime_ns != self._mtime
+            except OSError:
+                changed_on_disk = False
+            if requested or changed_on_disk:
+                self.reload()
+
     @property
     def home_dir(self) -> str:
         return self._home_dir
         
     @property
     def heartbeat_frequency(self) -> int:
-        return int(self._config.get("general", "heartbeat_frequency"))
+        return self._snapshot.heartbeat_frequency
     
+    @property
+    def task_status_tick(self) -> float:
+        return self._snapshot.task_status_tick
+
+    @property
+    def task_status_keepalive(self) -> float:
+        return self._snapshot.task_status_keepalive
+
+    @property
+    def task_progress_interval(self) -> float:
+        return self._snapshot.task_progress_interval
+
+    @property
+    def task_registry_max_entries(self) -> int:
+        return self._snapshot.task_registry_max_entries
+
+    @property
+    def task_registry_ttl(self) -> float:
+        return self._snapshot.task_registry_ttl
+
+    @property
+    def runtime(self) -> str:
+        return self._snapshot.runtime
+
+    @property
+    def async_max_concurrency(self) -> int:
+        return self._snapshot.async_max_concurrency
+
+    @property
+    def async_executor_workers(self) -> int:
+        return self._snapshot.async_executor_workers
+
+    @property
+    def intake_max_size(self) -> int:
+        return self._snapshot.intake_max_size
+
+    @property
+    def intake_policy(self) -> str:
+        return self._snapshot.intake_policy
+
+    @property
+    def intake_read_quota(self) -> int:
+        return self._snapshot.intake_read_quota
+
+    @property
+    def intake_quotas(self) -> dict:
+        return dict(self._snapshot.intake_quotas)
+
     @property
     def mqtt_host(self) -> str:
-        return self._config.get("mqtt", "host")
-    
+        return self._snapshot.mqtt_host
+
     @property
     def mqtt_port(self) -> int:
-        return int(self._config.get("mqtt", "port"))
-    
+        return self._snapshot.mqtt_port
+
     @property
     def mqtt_protocol(self) -> str:
-        return self._config.get("mqtt", "protocol")
-    
+        return self._snapshot.mqtt_protocol
+
     @property
     def mqtt_user(self) -> str:
-        return self._config.get("mqtt", "user")
-    
+        return self._snapshot.mqtt_user
+
     @property
     def mqtt_pwd(self) -> str:
-        return self._config.get("mqtt", "password")
-    
+        return self._snapshot.mqtt_pwd
+
     @property
     def mqtt_device_key(self) -> str:
-        return self._config.get("mqtt", "device_key")
-    
+        return self._snapshot.mqtt_device_key
+
+    @property
+    def mqtt_max_message_size(self) -> int:
+        return self._snapshot.mqtt_max_message_size
+
+    @property
+    def mqtt_protocol_version(self) -> str:
+        return self._snapshot.mqtt_protocol_version
+
+    @property
+    def mqtt_receive_maximum(self) -> int:
+        return self._snapshot.mqtt_receive_maximum
+
+    @property
+    def mqtt_heartbeat_expiry(self) -> int:
+        return self._snapshot.mqtt_heartbeat_expiry
+
+    @property
+    def mqtt_progress_expiry(self) -> int:
+        return self._snapshot.mqtt_progress_expiry
+
+    @property
+    def mqtt_qos(self) -> dict:
+        return dict(self._snapshot.mqtt_qos)
+
+    @property
+    def mqtt_inflight_window(self) -> int:
+        return self._snapshot.mqtt_inflight_window
+
+    @property
+    def mqtt_encodings(self) -> List[str]:
+        return list(self._snapshot.mqtt_encodings)
+
+    @property
+    def mqtt_compress_threshold(self) -> int:
+        return self._snapshot.mqtt_compress_threshold
+
+    @property
+    def outbox_max_entries(self) -> int:
+        return self._snapshot.outbox_max_entries
+
+    @property
+    def outbox_max_bytes(self) -> int:
+        return self._snapshot.outbox_max_bytes
+
+    @property
+    def outbox_drain_rate(self) -> int:
+        return self._snapshot.outbox_drain_rate
+
+    @property
+    def snapshot_write_interval(self) -> float:
+        return self._snapshot.snapshot_write_interval
+
+    @property
+    def kube_config_file(self) -> str:
+        return self._snapshot.kube_config_file
+
+    @property
+    def metrics_source(self) -> str:
+        return self._snapshot.metrics_source
+
+    @property
+    def metrics_host(self) -> str:
+        return self._snapshot.metrics_host
+
+    @property
+    def metrics_port(self) -> int:
+        return self._snapshot.metrics_port
+
+    @property
+    def recorder_file(self) -> str:
+        return self._snapshot.recorder_file
+
+    @property
+    def recorder_max_bytes(self) -> int:
+        return self._snapshot.recorder_max_bytes
+
+    @property
+    def recorder_redact(self) -> bool:
+        return self._snapshot.recorder_redact
+
+    @property
+    def trace_file(self) -> str:
+        return self._snapshot.trace_file
+
+    @property
+    def trace_max_bytes(self) -> int:
+        return self._snapshot.trace_max_bytes
+
+    @property
+    def log_level(self) -> str:
+        return self._snapshot.log_level
+
+    @property
+    def log_sample_interval(self) -> float:
+        return self._snapshot.log_sample_interval
+
+    @property
+    def log_max_bytes(self) -> int:
+        return self._snapshot.log_max_bytes
+
+    @property
+    def log_backup_count(self) -> int:
+        return self._snapshot.log_backup_count
+
     @property
     def upstream_topic(self) -> str:
-        return f"/{self.mqtt_user}/{self.mqtt_device_key}/upstream_edge_k3s"
-    
+        return self._snapshot.upstream_topic
+
     @property
     def downstream_topic(self) -> str:
-        return f"/{self.mqtt_user}/{self.mqtt_device_key}/downstream_edge_k3s"
+        return self._snapshot.downstream_topic
 
 
 def get_app_config() -> AppConfig:
     """Get the singleton AppConfig instance"""
-    return AppConfig()
\ No newline at end of file
+    return AppConfig()
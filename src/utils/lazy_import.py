@@ -0,0 +1,76 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import importlib, threading
+from typing import Callable, Iterable
+
+# This class is a proxy of a module imported on its first attribute access, so the heavy modules (kubernetes,
+# jsonschema, requests...) are not imported before the service has connected to the broker. The attributes resolve to
+# the real objects, e.g. 'except kube_exceptions.ApiException' catches the real exception class.
+class LazyModule:
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            # importlib serializes the concurrent imports of the same module
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return module
+
+    @property
+    def loaded(self) -> bool:
+        return self.__dict__["_module"] is not None
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<lazy module '{self.__dict__['_name']}' ({state})>"
+
+# This function imports the lazy modules now
+def preload(*modules: LazyModule):
+    for module in modules:
+        module._load()
+
+# This function runs the warm-up tasks (imports, config loading...) one after another in a background thread, the
+# failures are passed to on_error, the tasks are retried on their first real use anyway
+def warm_up(tasks: Iterable[Callable[[], None]], on_error: Callable[[Exception], None] = None) -> threading.Thread:
+    def run():
+        for task in tasks:
+            try:
+                task()
+            except Exception as ex:
+                if on_error is not None:
+                    on_error(ex)
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
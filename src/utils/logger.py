@@ -1,24 +1,217 @@
 import logging
-from logging.handlers import RotatingFileHandler
-import os
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os, json, time, copy, queue, atexit, threading
+from datetime import datetime, timezone
 
 home_dir = os.getenv("K3S_THIN_CLIENT_HOME")
 log_file = os.path.join(home_dir, 'logs', 'qstream-k3s-client.log')
 
+# max number of the records waiting for the listener thread, the records beyond are dropped instead of blocking
+QUEUE_SIZE = 10000
+# the buffered records are written to the file when the queue has been idle for this long, in seconds
+FLUSH_INTERVAL = 2
+# the payload attached to a record is cut to this many characters in the log line
+MAX_PAYLOAD_CHARS = 2048
+# strings and lists inside the payload are cut to these sizes
+MAX_STRING_CHARS = 256
+MAX_LIST_ITEMS = 20
+# the values of the payload keys containing any of these are masked
+SECRET_KEYS = ("password", "secret", "token", "private_key", "authorization", "credential")
+REDACTED = "***"
+# default min interval between the logged records of the same sample key, in seconds
+DEFAULT_SAMPLE_INTERVAL = 60
+
+# This function masks the secrets and cuts the long strings and lists of a payload for the log
+def sanitize(value, depth: int = 0):
+    if isinstance(value, dict):
+        if depth > 8:
+            return "{...}"
+        return {key: REDACTED if isinstance(key, str) and any(secret in key.lower() for secret in SECRET_KEYS)
+                else sanitize(item, depth + 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [sanitize(item, depth + 1) for item in value[:MAX_LIST_ITEMS]]
+        if len(value) > MAX_LIST_ITEMS:
+            items.append(f"...(+{len(value) - MAX_LIST_ITEMS} items)")
+        return items
+    if isinstance(value, str) and len(value) > MAX_STRING_CHARS:
+        return f"{value[:MAX_STRING_CHARS]}...(+{len(value) - MAX_STRING_CHARS} chars)"
+    return value
+
+# This class formats the records as JSON lines: time, level, logger, message and the optional payload (sanitized),
+# number of the suppressed records of the sample and the exception
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            text = json.dumps(sanitize(payload), separators=(",", ":"), default=str)
+            if len(text) > MAX_PAYLOAD_CHARS:
+                entry["payload"] = f"{text[:MAX_PAYLOAD_CHARS]}...(+{len(text) - MAX_PAYLOAD_CHARS} chars)"
+            else:
+                entry["payload"] = json.loads(text)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+# This class passes one record per sample key (extra={"sample": key}) per sample interval, the number of the records
+# suppressed in between is added to the passed record. The records without a sample key and the warnings/errors are
+# always passed.
+class SamplingFilter(logging.Filter):
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        # sample key -> [time of the last passed record, number of the suppressed records]
+        self._samples = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None or record.levelno >= logging.WARNING or self.interval <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None or now - sample[0] >= self.interval:
+                record.suppressed = sample[1] if sample is not None else 0
+                self._samples[key] = [now, 0]
+                return True
+            sample[1] += 1
+            return False
+
+# This class puts the records to the queue of the listener thread without blocking the caller, a record is dropped
+# when the queue is full. The message and the exception are rendered in the caller (the arguments may change later),
+# the payload is copied shallowly, the sanitizing and the JSON formatting are done in the listener thread.
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        payload = getattr(record, "payload", None)
+        if isinstance(payload, dict):
+            record.payload = dict(payload)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# This class writes the records to the rotating log file with buffering, the buffer is flushed by the listener when
+# the queue is idle and right away for the warnings/errors. The file size is tracked instead of seeking the file
+# for every record.
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    def __init__(self, filename: str, maxBytes: int = 0, backupCount: int = 0):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        self._size = os.path.getsize(filename) if os.path.exists(filename) else 0
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            # the lines are ASCII (JSON), the number of the characters is the number of the bytes
+            line = self.format(record) + self.terminator
+            if self.maxBytes > 0 and self._size > 0 and self._size + len(line) > self.maxBytes:
+                self.doRollover()
+                self._size = 0
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(line)
+            self._size += len(line)
+            if record.levelno >= logging.WARNING:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+# This class is the listener thread writing the queued records, the file buffer is flushed when the queue has been
+# idle for the flush interval
+class FlushingQueueListener(QueueListener):
+    def dequeue(self, block: bool):
+        while True:
+            try:
+                return self.queue.get(block=block, timeout=FLUSH_INTERVAL if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    handler.flush()
+
+# This class is the logging pipeline of a log file, one queue handler shared by the loggers of the modules and one
+# listener thread writing to the file
+class LogPipeline:
+    def __init__(self, log_file: str):
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        # Rotating handler: 1MB per file, keep 3 backups
+        self.file_handler = BufferedRotatingFileHandler(log_file, maxBytes=1_000_000, backupCount=3)
+        self.file_handler.setFormatter(JsonLinesFormatter())
+        self.sampling_filter = SamplingFilter()
+        self.queue_handler = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+        self.queue_handler.addFilter(self.sampling_filter)
+        self.listener = FlushingQueueListener(self.queue_handler.queue, self.file_handler)
+        self.listener.start()
+
+    def stop(self):
+        # writes the queued records
+        self.listener.stop()
+        self.file_handler.flush()
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+_loggers = []
+# level set by configure_logging, applied also to the loggers created later
+_configured_level = None
+
+def _get_pipeline(log_file: str) -> LogPipeline:
+    with _pipelines_lock:
+        pipeline = _pipelines.get(log_file)
+        if pipeline is None:
+            pipeline = LogPipeline(log_file)
+            _pipelines[log_file] = pipeline
+        return pipeline
+
+@atexit.register
+def _stop_pipelines():
+    for pipeline in list(_pipelines.values()):
+        pipeline.stop()
+
 def get_logger(name: str, log_file: str = log_file, level: int = logging.INFO) -> logging.Logger:
     logger = logging.getLogger(name)
-    logger.setLevel(level)
+    logger.setLevel(level if _configured_level is None else _configured_level)
 
     if not logger.handlers:
-        # Ensure log directory exists
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        logger.addHandler(_get_pipeline(log_file).queue_handler)
+        # the records are written by the pipeline only, not again by the root logger's handlers
+        logger.propagate = False
+        _loggers.append(logger)
+
+    return logger
 
-        # Rotating handler: 1MB per file, keep 5 backups
-        handler = RotatingFileHandler(log_file, maxBytes=1_000_000, backupCount=3)
-        formatter = logging.Formatter(
-            "%(asctime)s | %(name)s | %(levelname)s | %(message)s"
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+# This function applies the logging settings of the configuration, can be called again when they change
+def configure_logging(level: str = "INFO", sample_interval: float = DEFAULT_SAMPLE_INTERVAL,
+                      max_bytes: int = 1_000_000, backup_count: int = 3, log_file: str = log_file):
+    global _configured_level
+    pipeline = _get_pipeline(log_file)
+    _configured_level = level.upper()
+    pipeline.sampling_filter.interval = sample_interval
+    pipeline.file_handler.maxBytes = max_bytes
+    pipeline.file_handler.backupCount = backup_count
+    for logger in _loggers:
+        logger.setLevel(_configured_level)
 
-    return logger
\ No newline at end of file
+# This function gets the number of the records dropped because the logging queue was full
+def get_dropped_records(log_file: str = log_file) -> int:
+    pipeline = _pipelines.get(log_file)
+    return pipeline.queue_handler.dropped if pipeline is not None else 0
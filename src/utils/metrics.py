@@ -0,0 +1,216 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, time, threading, subprocess
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from utils.stats import Histogram
+from utils.logger import get_logger
+from utils.tracing import span
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# prefix of the exported metric names
+METRIC_PREFIX = "k3s_client_"
+
+# bucket upper bounds of the size histograms, in bytes
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576]
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# This class is a family of the counters or the histograms of a metric, one per set of the label values
+class MetricFamily:
+    def __init__(self, name: str, kind: str, help_text: str, label_names: Tuple[str, ...],
+                 buckets: Optional[List[float]] = None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = label_names
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> counter value or Histogram
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._children[key] = self._children.get(key, 0) + value
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        histogram = self._children.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._children.setdefault(key, Histogram(self._buckets))
+        histogram.observe(value)
+
+    def children(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        with self._lock:
+            return list(self._children.items())
+
+# This class is the registry of the service metrics, the counters and histograms are created on their first use
+# and exported in the OpenMetrics text format and as a compact summary for the heartbeat
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families: Dict[str, MetricFamily] = {}
+
+    def _family(self, name: str, kind: str, help_text: str, label_names: Tuple[str, ...],
+                buckets: Optional[List[float]] = None) -> MetricFamily:
+        family = self._families.get(name)
+        if family is None:
+            with self._lock:
+                family = self._families.setdefault(name, MetricFamily(name, kind, help_text, label_names, buckets))
+        return family
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> MetricFamily:
+        return self._family(name, "counter", help_text, label_names)
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                  buckets: Optional[List[float]] = None) -> MetricFamily:
+        return self._family(name, "histogram", help_text, label_names, buckets)
+
+    def get(self, name: str) -> Optional[MetricFamily]:
+        return self._families.get(name)
+
+    # This function renders the metrics in the OpenMetrics text format
+    def render(self) -> str:
+        lines = []
+        for family in sorted(self._families.values(), key=lambda family: family.name):
+            name = METRIC_PREFIX + family.name
+            lines.append(f"# TYPE {name} {family.kind}")
+            lines.append(f"# HELP {name} {family.help_text}")
+            for key, child in sorted(family.children(), key=lambda item: item[0]):
+                labels = list(zip(family.label_names, key))
+                if family.kind == "counter":
+                    lines.append(f"{name}_total{_format_labels(labels)} {_format_value(child)}")
+                    continue
+                snapshot = child.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    lines.append(f"{name}_bucket{_format_labels(labels + [('le', bound)])} {count}")
+                lines.append(f"{name}_count{_format_labels(labels)} {snapshot['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(snapshot['sum'])}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    # This function summarizes the metrics for the heartbeat, {metric: {label values joined by '/': value}}, the
+    # histograms as {count, p50, p99}
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        summary = {}
+        for family in list(self._families.values()):
+            values = {}
+            for key, child in family.children():
+                label = "/".join(key) or "all"
+                if family.kind == "counter":
+                    values[label] = child
+                else:
+                    snapshot = child.snapshot()
+                    values[label] = {"count": snapshot["count"], "p50": snapshot["p50"], "p99": snapshot["p99"]}
+            summary[family.name] = values
+        return summary
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels) + "}"
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+# the registry of the service
+metrics = MetricsRegistry()
+
+# This function measures the duration of the block into the histogram (milliseconds)
+@contextmanager
+def timed(family: MetricFamily, **labels):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        family.observe((time.monotonic() - start) * 1000, **labels)
+
+SUBPROCESS_DURATION = metrics.histogram("subprocess_duration_ms", "Duration of the subprocess calls in milliseconds", ("command",))
+SUBPROCESS_FAILURES = metrics.counter("subprocess_failures", "Subprocess calls which failed or exited with an error", ("command",))
+
+# This function gets the label of a command line, the program and its sub commands, e.g. 'k3s ctr images'
+def command_label(args: List[str]) -> str:
+    args = list(args)
+    if args and args[0] == "sudo":
+        args = args[1:]
+    words = []
+    for arg in args[:3]:
+        if arg.startswith("-") or "/" in arg:
+            break
+        words.append(arg)
+    return " ".join(words)
+
+# This function runs the command with subprocess.run, its duration and failure are recorded per command label and
+# it is traced as a span of the request
+def run_subprocess(args: List[str], **kwargs) -> subprocess.CompletedProcess:
+    label = command_label(args)
+    start = time.monotonic()
+    try:
+        with span("subprocess", command=label):
+            result = subprocess.run(args, **kwargs)
+    except Exception:
+        SUBPROCESS_FAILURES.inc(command=label)
+        raise
+    finally:
+        SUBPROCESS_DURATION.observe((time.monotonic() - start) * 1000, command=label)
+    if result.returncode != 0:
+        SUBPROCESS_FAILURES.inc(command=label)
+    return result
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = metrics
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the scrapes are not logged
+        pass
+
+# This function serves the metrics at http://host:port/metrics in a background thread
+def start_metrics_server(host: str, port: int, registry: MetricsRegistry = metrics) -> ThreadingHTTPServer:
+    handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"serving the metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,191 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, sys, time, threading, tracemalloc
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+# limits of a profile, the requested values are clamped to them
+MAX_DURATION = 60
+DEFAULT_DURATION = 10
+MIN_INTERVAL = 0.005
+MAX_INTERVAL = 1.0
+DEFAULT_INTERVAL = 0.01
+MAX_TOP = 100
+DEFAULT_TOP = 20
+# max number of the innermost frames kept per stack
+MAX_STACK_DEPTH = 32
+# max share of the wall time spent by the sampler, the sampling interval is doubled beyond
+MAX_OVERHEAD = 0.02
+# frames kept per allocation by tracemalloc when it is started by the profile
+TRACEMALLOC_FRAMES = 1
+
+# the files of the profiler and tracemalloc are left out of the allocation sites
+_IGNORED_ALLOCATION_FILES = (tracemalloc.__file__, __file__)
+
+# only one profile runs at a time
+_profile_lock = threading.Lock()
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+# This function gets the CPU clock of the thread, None when the platform has no per thread CPU clocks
+def _thread_cpu_time(thread_id: int) -> Optional[float]:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError, OverflowError):
+        return None
+
+# This class samples the stacks of the threads of the process from a background thread (sys._current_frames), the
+# stacks are counted in the folded format 'thread;outer frame;...;inner frame'. With cpu_only the threads whose CPU
+# clock did not advance since the previous sample (waiting on a lock, a socket or a sleep) are not counted. The
+# time spent in the sampling is measured and the interval is doubled when it exceeds MAX_OVERHEAD of the wall time.
+class SamplingProfiler:
+    def __init__(self, interval: float = DEFAULT_INTERVAL, cpu_only: bool = True, max_depth: int = MAX_STACK_DEPTH):
+        self.interval = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+        self._cpu_only = cpu_only
+        self._max_depth = max_depth
+        self._stacks = Counter()
+        self._threads = Counter()
+        self._cpu_times = {}
+        # (code, line) -> formatted frame
+        self._frame_names = {}
+        self._samples = 0
+        self._sampling_time = 0.0
+        self._start = None
+        self._end = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._start = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._end = time.monotonic()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            start = time.perf_counter()
+            self._sample()
+            elapsed = time.perf_counter() - start
+            self._sampling_time += elapsed
+            if elapsed > self.interval * MAX_OVERHEAD and self.interval < MAX_INTERVAL:
+                self.interval = min(self.interval * 2, MAX_INTERVAL)
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        self._samples += 1
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if self._cpu_only:
+                cpu_time = _thread_cpu_time(thread_id)
+                previous = self._cpu_times.get(thread_id)
+                self._cpu_times[thread_id] = cpu_time
+                if cpu_time is not None and (previous is None or cpu_time <= previous):
+                    continue
+            frames = []
+            while frame is not None and len(frames) < self._max_depth:
+                key = (frame.f_code, frame.f_lineno)
+                name = self._frame_names.get(key)
+                if name is None:
+                    name = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+                    self._frame_names[key] = name
+                frames.append(name)
+                frame = frame.f_back
+            thread_name = names.get(thread_id, str(thread_id))
+            frames.append(thread_name)
+            self._stacks[";".join(reversed(frames))] += 1
+            self._threads[thread_name] += 1
+
+    # This function gets the top stacks by the number of the samples
+    def report(self, top: int = DEFAULT_TOP) -> Dict[str, Any]:
+        elapsed = (self._end or time.monotonic()) - self._start
+        counted = sum(self._stacks.values())
+        stacks = [{"stack": stack, "count": count, "percent": round(100 * count / counted, 2)}
+                  for stack, count in self._stacks.most_common(top)]
+        return {
+            "samples": self._samples,
+            "interval_ms": round(self.interval * 1000, 3),
+            "overhead_percent": round(100 * self._sampling_time / elapsed, 3) if elapsed > 0 else 0.0,
+            "cpu_only": self._cpu_only,
+            "threads": dict(self._threads.most_common()),
+            "stacks": stacks,
+            "other_stacks": max(len(self._stacks) - len(stacks), 0)
+        }
+
+# This function gets the top allocation sites which grew between the tracemalloc snapshots
+def allocation_diff(before: "tracemalloc.Snapshot", after: "tracemalloc.Snapshot", top: int = DEFAULT_TOP) -> List[Dict[str, Any]]:
+    filters = [tracemalloc.Filter(False, file_name) for file_name in _IGNORED_ALLOCATION_FILES]
+    diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    sites = []
+    for stat in diff[:top]:
+        frame = stat.traceback[0]
+        sites.append({
+            "site": f"{os.path.basename(frame.filename)}:{frame.lineno}",
+            "size_diff_kb": round(stat.size_diff / 1024, 3),
+            "size_kb": round(stat.size / 1024, 3),
+            "count_diff": stat.count_diff
+        })
+    return sites
+
+# This function profiles the process for the given seconds: the stacks are sampled and, with memory, the allocations
+# are traced by tracemalloc (started and stopped here unless it is already tracing). The request values are clamped to
+# the limits. wait(seconds) is the waiting of the duration, e.g. the request's cancellation token which raises on the
+# cancellation; the profiling is stopped in any case. Raises ProfilerBusyError when a profile is already running.
+def profile(duration: float = DEFAULT_DURATION, interval: float = DEFAULT_INTERVAL, top: int = DEFAULT_TOP,
+            memory: bool = False, cpu_only: bool = True, wait: Callable[[float], Any] = time.sleep) -> Dict[str, Any]:
+    duration = min(max(float(duration), 0.1), MAX_DURATION)
+    top = min(max(int(top), 1), MAX_TOP)
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusyError("a profile is already running")
+    try:
+        started_tracemalloc = False
+        memory_before = None
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                started_tracemalloc = True
+            memory_before = tracemalloc.take_snapshot()
+        sampler = SamplingProfiler(interval, cpu_only)
+        start = time.monotonic()
+        sampler.start()
+        try:
+            wait(duration)
+        finally:
+            sampler.stop()
+            memory_after = tracemalloc.take_snapshot() if memory_before is not None else None
+            if started_tracemalloc:
+                tracemalloc.stop()
+        report = {"duration": round(time.monotonic() - start, 3), "top": top}
+        report.update(sampler.report(top))
+        if memory_after is not None:
+            report["allocations"] = allocation_diff(memory_before, memory_after, top)
+        return report
+    finally:
+        _profile_lock.release()
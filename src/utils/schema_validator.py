@@ -0,0 +1,91 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, json, threading
+from typing import Any, Dict, List, Tuple
+from utils.lazy_import import LazyModule
+from utils.logger import get_logger
+
+jsonschema = LazyModule("jsonschema")
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# the schemas do not declare '$schema', they are checked and validated as draft 2020-12 (what jsonschema.validate
+# picks for them)
+VALIDATOR_CLASS = "Draft202012Validator"
+
+# max number of the errors reported for one instance
+MAX_VALIDATION_ERRORS = 10
+
+# This class keeps the compiled validators of the JSON schema files of a directory. A schema file is loaded,
+# checked and compiled once, then again only when its modification time changes.
+class SchemaValidatorCache:
+    def __init__(self, schema_dir: str, validator_class: str = VALIDATOR_CLASS):
+        self._schema_dir = schema_dir
+        self._validator_class = validator_class
+        self._lock = threading.Lock()
+        # file name -> (mtime in ns, validator)
+        self._validators: Dict[str, Tuple[int, Any]] = {}
+
+    # This function gets the compiled validator of the schema file, recompiled if the file has changed
+    def get(self, file_name: str):
+        path = os.path.join(self._schema_dir, file_name)
+        mtime = os.stat(path).st_mtime_ns
+        entry = self._validators.get(file_name)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        with self._lock:
+            entry = self._validators.get(file_name)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+            try:
+                validator = self._compile(path)
+                logger.info(f"compiled the schema '{file_name}'")
+            except Exception as ex:
+                if entry is None:
+                    raise
+                # a broken edit of the schema file, the previous validator is kept until the file changes again
+                logger.error(f"failed to compile the schema '{file_name}', keeping the previous one: {ex}")
+                validator = entry[1]
+            self._validators[file_name] = (mtime, validator)
+            return validator
+
+    def _compile(self, path: str):
+        with open(path, "r") as file:
+            schema = json.load(file)
+        validator_class = getattr(jsonschema, self._validator_class)
+        # raises jsonschema.SchemaError for an invalid schema
+        validator_class.check_schema(schema)
+        return validator_class(schema)
+
+    # This function validates the instance against the schema file, returns the errors (empty when valid) found in
+    # one pass, ordered by their location in the instance
+    def validate(self, file_name: str, instance: Any) -> List[str]:
+        validator = self.get(file_name)
+        errors = sorted(validator.iter_errors(instance), key=lambda error: list(map(str, error.absolute_path)))
+        return [format_validation_error(error) for error in errors[:MAX_VALIDATION_ERRORS]]
+
+# This function formats the validation error with the location in the instance, e.g. 'spec.replicas: ...'
+def format_validation_error(error) -> str:
+    location = ".".join(str(item) for item in error.absolute_path)
+    return f"{location}: {error.message}" if location else error.message
@@ -0,0 +1,87 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading, bisect
+from typing import Dict, List, Optional
+
+# default histogram bucket upper bounds, in milliseconds
+DEFAULT_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+# This class is a thread safe histogram with fixed buckets, keeps the count, sum, min/max and the counts of
+# the values per bucket (cumulative counts are computed at the snapshot)
+class Histogram:
+    def __init__(self, buckets: Optional[List[float]] = None):
+        self._buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    @property
+    def buckets(self) -> List[float]:
+        return self._buckets
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+            self._min = value if self._min is None else min(self._min, value)
+            self._max = value if self._max is None else max(self._max, value)
+
+    # This function estimates the percentile (0-100) from the buckets, the upper bound of the bucket is returned
+    def percentile(self, percent: float) -> Optional[float]:
+        with self._lock:
+            if self._count == 0:
+                return None
+            rank = self._count * percent / 100
+            cumulative = 0
+            for index, count in enumerate(self._counts):
+                cumulative += count
+                if cumulative >= rank and count > 0:
+                    return self._buckets[index] if index < len(self._buckets) else self._max
+            return self._max
+
+    def snapshot(self) -> Dict:
+        p50 = self.percentile(50)
+        p90 = self.percentile(90)
+        p99 = self.percentile(99)
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for index, bound in enumerate(self._buckets):
+                cumulative += self._counts[index]
+                buckets[str(bound)] = cumulative
+            buckets["+Inf"] = self._count
+            return {
+                "count": self._count,
+                "sum": round(self._sum, 3),
+                "min": self._min,
+                "max": self._max,
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+                "buckets": buckets
+            }
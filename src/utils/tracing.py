@@ -0,0 +1,169 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2024 Quarkifi Technologies Pvt Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os, json, time, threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from utils.logger import get_logger
+
+current_file = os.path.basename(__file__)
+logger = get_logger(current_file)
+
+# max number of the spans recorded per request, the spans beyond are counted only
+MAX_SPANS = 256
+# default max size of the trace file, it is rotated to <file>.1 beyond
+DEFAULT_TRACE_FILE_MAX_BYTES = 5 * 1024 * 1024
+
+# the trace of the request processed by the thread
+_local = threading.local()
+
+# This class is the trace of a request: the timed spans of its phases, nested by the order they are opened
+# in the thread processing the request
+class Trace:
+    def __init__(self, request_id: str, request: str, report: bool = False, queue_wait_ms: Optional[float] = None):
+        self.request_id = request_id
+        self.request = request
+        # the timings are attached to the terminal response of the request
+        self.report = report
+        self.queue_wait_ms = queue_wait_ms
+        self.start_time = time.time()
+        self._start = time.monotonic()
+        self._end = None
+        # [name, start, end, parent index, attributes]
+        self._spans = []
+        self._open = []
+        self.dropped_spans = 0
+
+    def start_span(self, name: str, attrs: Dict[str, Any]) -> Optional[int]:
+        if len(self._spans) >= MAX_SPANS:
+            self.dropped_spans += 1
+            return None
+        index = len(self._spans)
+        self._spans.append([name, time.monotonic(), None, self._open[-1] if self._open else None, attrs])
+        self._open.append(index)
+        return index
+
+    def end_span(self, index: Optional[int]):
+        if index is None:
+            return
+        self._spans[index][2] = time.monotonic()
+        # the spans left open inside (e.g. by a suspended generator) are closed with it
+        while self._open and self._open.pop() != index:
+            pass
+
+    def finish(self):
+        self._end = time.monotonic()
+
+    # This function gets the timings of the trace, in milliseconds from the start of the request processing; the spans
+    # still open are timed up to now and marked. The breakdown is the time per top level span name.
+    def to_dict(self) -> Dict[str, Any]:
+        now = self._end if self._end is not None else time.monotonic()
+        spans = []
+        breakdown = {}
+        for name, start, end, parent, attrs in self._spans:
+            duration = round(((end if end is not None else now) - start) * 1000, 3)
+            span = {"name": name, "start_ms": round((start - self._start) * 1000, 3), "duration_ms": duration, "parent": parent}
+            if end is None:
+                span["open"] = True
+            if attrs:
+                span["attrs"] = attrs
+            spans.append(span)
+            if parent is None:
+                breakdown[name] = round(breakdown.get(name, 0) + duration, 3)
+        timings = {"total_ms": round((now - self._start) * 1000, 3), "breakdown": breakdown, "spans": spans}
+        if self.queue_wait_ms is not None:
+            timings["queue_wait_ms"] = round(self.queue_wait_ms, 3)
+        if self.dropped_spans:
+            timings["dropped_spans"] = self.dropped_spans
+        return timings
+
+# This function starts the trace of the request processed by the calling thread
+def start_trace(request_id: str, request: str, report: bool = False, queue_wait_ms: Optional[float] = None) -> Trace:
+    trace = Trace(request_id, request, report, queue_wait_ms)
+    _local.trace = trace
+    return trace
+
+# This function ends the trace of the calling thread, returns it (None when there is none)
+def end_trace() -> Optional[Trace]:
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    if trace is not None:
+        trace.finish()
+    return trace
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_local, "trace", None)
+
+# This function times the block as a span of the calling thread's trace, nothing is recorded when the thread
+# has no trace
+@contextmanager
+def span(name: str, **attrs):
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        yield
+        return
+    index = trace.start_span(name, attrs)
+    try:
+        yield
+    finally:
+        trace.end_span(index)
+
+# This class appends the finished traces to a local file as JSON lines for the offline analysis, the file is
+# rotated to <file>.1 when it exceeds the max size. No file disables the export.
+class TraceExporter:
+    def __init__(self, file_path: Optional[str] = None, max_bytes: int = DEFAULT_TRACE_FILE_MAX_BYTES):
+        self._lock = threading.Lock()
+        self._file_path = None
+        self._max_bytes = max_bytes
+        self.configure(file_path, max_bytes)
+
+    @property
+    def enabled(self) -> bool:
+        return self._file_path is not None
+
+    def configure(self, file_path: Optional[str], max_bytes: int = DEFAULT_TRACE_FILE_MAX_BYTES):
+        with self._lock:
+            if file_path:
+                os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+            self._file_path = file_path or None
+            self._max_bytes = max_bytes
+
+    def export(self, trace: Trace):
+        entry = {
+            "request_id": trace.request_id,
+            "request": trace.request,
+            "start_time": datetime.fromtimestamp(trace.start_time, timezone.utc).isoformat(timespec="milliseconds")
+        }
+        entry.update(trace.to_dict())
+        line = json.dumps(entry, separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            if self._file_path is None:
+                return
+            try:
+                if (self._max_bytes > 0 and os.path.exists(self._file_path)
+                        and os.path.getsize(self._file_path) + len(line) > self._max_bytes):
+                    os.replace(self._file_path, f"{self._file_path}.1")
+                with open(self._file_path, "a") as f:
+                    f.write(line)
+            except OSError as ex:
+                logger.warning(f"failed to export the trace of the request {trace.request_id}: {ex}")
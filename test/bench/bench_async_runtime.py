@@ -0,0 +1,111 @@
+# Benchmark of the threaded runtime against the asyncio runtime: thread count, RSS and the latency of concurrent
+# requests. The requests are idempotent reads whose handler blocks for --io-ms (simulating the kube API calls),
+# the heartbeat and the task status ticks run as in the service. Each runtime is measured in its own process.
+#
+# usage: python bench_async_runtime.py [--requests 1,8,32] [--io-ms 50] [--concurrency 4]
+
+import os, sys, json, argparse, asyncio, subprocess, threading, time
+import psutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+class FakeProxy:
+    def notify_message(self, data):
+        pass
+
+    def is_backpressured(self):
+        return False
+
+def measure(mode: str, requests: int, io_ms: int, concurrency: int):
+    from messaging.message_processor import MessageProcessor, IntakeQueue
+    from messaging.task_status_reporter import TaskStatusReporter
+    from service.heart_beat import HeartBeat
+    from service.async_runtime import AsyncRequestRunner
+
+    latencies = []
+    done = threading.Event()
+    peak_threads = [threading.active_count()]
+
+    def on_message(payload):
+        time.sleep(io_ms / 1000)
+        latencies.append(time.perf_counter() - payload["_enqueued"])
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+        if len(latencies) == requests:
+            done.set()
+
+    reporter = TaskStatusReporter(FakeProxy(), tick_seconds=0.5)
+    # quotas large enough to queue all the requests of the run
+    processor = MessageProcessor(on_message, None, IntakeQueue(max(requests, 100), read_quota=requests))
+    payloads = [{"request_id": str(index), "request": "get_app_status"} for index in range(requests)]
+
+    def submit():
+        for payload in payloads:
+            payload["_enqueued"] = time.perf_counter()
+            processor.add_message(payload)
+
+    if mode == "threads":
+        heartbeat = HeartBeat(1, lambda: None)
+        heartbeat.start()
+        processor.start()
+        reporter.start_reporting("task", "import_image", "Downloading")
+        submit()
+        done.wait(60)
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+    else:
+        reporter.use_external_scheduler()
+        reporter.start_reporting("task", "import_image", "Downloading")
+
+        async def main():
+            from concurrent.futures import ThreadPoolExecutor
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+            runner = AsyncRequestRunner(processor.message_queue, on_message, concurrency)
+            processor.set_enqueue_listener(runner.notify)
+            runner_task = asyncio.create_task(runner.run())
+
+            async def timer(interval, callback):
+                while True:
+                    await asyncio.sleep(interval)
+                    callback()
+            timers = [asyncio.create_task(timer(1, lambda: None)), asyncio.create_task(timer(0.5, reporter.tick))]
+            await asyncio.sleep(0)
+            submit()
+            await loop.run_in_executor(None, done.wait, 60)
+            for task in timers + [runner_task]:
+                task.cancel()
+        asyncio.run(main())
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": requests,
+        "peak_threads": peak_threads[0],
+        "rss_bytes": psutil.Process().memory_info().rss,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", default="1,8,32")
+    parser.add_argument("--io-ms", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mode", choices=["threads", "asyncio"])
+    args = parser.parse_args()
+
+    if args.mode:
+        # child process, one measurement
+        print(json.dumps(measure(args.mode, int(args.requests), args.io_ms, args.concurrency)))
+        return
+
+    results = []
+    for requests in [int(count) for count in args.requests.split(",")]:
+        for mode in ["threads", "asyncio"]:
+            output = subprocess.run([sys.executable, __file__, "--mode", mode, "--requests", str(requests),
+                                     "--io-ms", str(args.io_ms), "--concurrency", str(args.concurrency)],
+                                    capture_output=True, text=True, check=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    print(json.dumps({"benchmark": "async_runtime", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
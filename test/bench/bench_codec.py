@@ -0,0 +1,72 @@
+# Benchmark of the wire codec encode/decode cost against the bytes saved, for heartbeat status snapshots of
+# different sizes. msgpack and cbor encodings are included when the optional packages are installed.
+#
+# usage: python bench_codec.py [--apps 1,10,100] [--repeat 5]
+
+import os, sys, json, argparse, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from messaging import codec
+
+def make_app(index: int):
+    return {
+        "app_name": f"app-{index}",
+        "namespace": "default",
+        "status": "Healthy",
+        "creation_time": "2024-01-01T00:00:00+00:00",
+        "last_update_time": "2024-01-01T00:00:10+00:00",
+        "pods": [{
+            "name": f"app-{index}-5d8f7c9b6-x2k4p",
+            "status": "Running",
+            "containers": [{"name": "main", "image": f"app-{index}:1.0.0"}]
+        }],
+        "replicas": {"desired": 1, "available": 1, "updated": 1, "unavailable": 0},
+        "cpu_usage": 1.25,
+        "mem_usage": 3.4,
+        "uptime": 86400 + index
+    }
+
+def make_snapshot(app_count: int):
+    return {
+        "status_update": "apps_and_resources_status",
+        "status": {
+            "username": "pi",
+            "apps": [make_app(index) for index in range(app_count)],
+            "resources": {
+                "cpu": {"count": 4, "usage_percent": 12.5},
+                "memory": {"total": 3884376, "used": 1022312, "free": 2512004, "usage_percent": 35.3},
+                "swap": {"total": 102396, "used": 0, "free": 102396, "usage_percent": 0.0},
+                "disk": {"total": 30358348, "used": 8351224, "free": 20700908, "usage_percent": 28.7}
+            },
+            "app_counts": {"total": app_count, "Healthy": app_count}
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", default="1,10,100")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for app_count in [int(count) for count in args.apps.split(",")]:
+        snapshot = make_snapshot(app_count)
+        baseline = len(json.dumps(snapshot).encode())
+        for encoding in codec.available_encodings():
+            payload = codec.encode(snapshot, encoding, compress_threshold=0)
+            number = max(1, 2000 // app_count)
+            encode_time = min(timeit.repeat(lambda: codec.encode(snapshot, encoding, compress_threshold=0), number=number, repeat=args.repeat)) / number
+            decode_time = min(timeit.repeat(lambda: codec.decode(payload), number=number, repeat=args.repeat)) / number
+            results.append({
+                "apps": app_count,
+                "encoding": encoding,
+                "bytes": len(payload),
+                "baseline_json_bytes": baseline,
+                "ratio": round(baseline / len(payload), 2),
+                "encode_us": round(encode_time * 1_000_000, 1),
+                "decode_us": round(decode_time * 1_000_000, 1)
+            })
+    print(json.dumps({"benchmark": "codec", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Memory and latency benchmark of the raw JSON data path (compact records) against the OpenAPI model
+# deserialization, for synthetic pod and deployment list responses.
+#
+# usage: python bench_raw_json.py [--items 10,100,500] [--repeat 5]
+
+import os, sys, json, argparse, timeit, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from kubernetes import client
+from service.kube_records import DeploymentRecord, PodRecord
+
+class FakeResponse:
+    def __init__(self, data: bytes):
+        self.data = data
+
+def make_pod(index: int):
+    return {
+        "metadata": {
+            "name": f"app-{index}-5d8f7c9b6-x2k4p",
+            "namespace": "default",
+            "uid": f"0b1c2d3e-0000-4000-8000-{index:012d}",
+            "labels": {"app": f"app-{index}", "pod-template-hash": "5d8f7c9b6"},
+            "creationTimestamp": "2024-01-01T00:00:00Z",
+            "managedFields": [
+                {"manager": "k3s", "operation": "Update", "apiVersion": "v1", "time": "2024-01-01T00:00:00Z", "fieldsType": "FieldsV1",
+                 "fieldsV1": {"f:metadata": {"f:labels": {".": {}, "f:app": {}}}, "f:spec": {"f:containers": {}}}},
+                {"manager": "k3s", "operation": "Update", "apiVersion": "v1", "time": "2024-01-01T00:00:05Z", "fieldsType": "FieldsV1",
+                 "subresource": "status", "fieldsV1": {"f:status": {"f:conditions": {}, "f:phase": {}}}}
+            ]
+        },
+        "spec": {
+            "containers": [{
+                "name": "main",
+                "image": f"registry.local/app-{index}:1.0.0",
+                "imagePullPolicy": "IfNotPresent",
+                "ports": [{"containerPort": 8080, "protocol": "TCP"}],
+                "env": [{"name": f"ENV_{n}", "value": f"value-{n}"} for n in range(8)],
+                "resources": {"requests": {"cpu": "100m", "memory": "64Mi"}, "limits": {"cpu": "500m", "memory": "256Mi"}},
+                "volumeMounts": [{"name": "kube-api-access", "mountPath": "/var/run/secrets/kubernetes.io/serviceaccount", "readOnly": True}]
+            }],
+            "restartPolicy": "Always",
+            "nodeName": "raspberrypi",
+            "tolerations": [{"key": "node.kubernetes.io/not-ready", "operator": "Exists", "effect": "NoExecute", "tolerationSeconds": 300}]
+        },
+        "status": {
+            "phase": "Running",
+            "qosClass": "Burstable",
+            "startTime": "2024-01-01T00:00:05Z",
+            "conditions": [{"type": t, "status": "True", "lastTransitionTime": "2024-01-01T00:00:10Z"} for t in ["Initialized", "Ready", "ContainersReady", "PodScheduled"]],
+            "containerStatuses": [{
+                "name": "main", "ready": True, "restartCount": 0, "image": f"registry.local/app-{index}:1.0.0",
+                "imageID": "sha256:" + "a" * 64, "containerID": "containerd://" + "b" * 64, "started": True,
+                "state": {"running": {"startedAt": "2024-01-01T00:00:08Z"}}
+            }]
+        }
+    }
+
+def make_deployment(index: int):
+    pod = make_pod(index)
+    return {
+        "metadata": {"name": f"app-{index}", "namespace": "default", "creationTimestamp": "2024-01-01T00:00:00Z",
+                     "managedFields": pod["metadata"]["managedFields"]},
+        "spec": {"replicas": 1, "selector": {"matchLabels": {"app": f"app-{index}"}},
+                 "template": {"metadata": {"labels": {"app": f"app-{index}"}}, "spec": pod["spec"]}},
+        "status": {"replicas": 1, "availableReplicas": 1, "updatedReplicas": 1, "readyReplicas": 1,
+                   "conditions": [{"type": "Available", "status": "True", "lastUpdateTime": "2024-01-01T00:00:10Z",
+                                   "lastTransitionTime": "2024-01-01T00:00:10Z", "reason": "MinimumReplicasAvailable"}]}
+    }
+
+def measure(function, repeat: int):
+    function()
+    latency = min(timeit.repeat(function, number=1, repeat=repeat))
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(latency * 1000, 3), peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", default="10,100,500")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    api_client = client.ApiClient()
+    results = []
+    for count in [int(item) for item in args.items.split(",")]:
+        pods = json.dumps({"apiVersion": "v1", "kind": "PodList", "metadata": {}, "items": [make_pod(i) for i in range(count)]}).encode()
+        deployments = json.dumps({"apiVersion": "apps/v1", "kind": "DeploymentList", "metadata": {}, "items": [make_deployment(i) for i in range(count)]}).encode()
+        for kind, data, model, record in [("pods", pods, "V1PodList", PodRecord), ("deployments", deployments, "V1DeploymentList", DeploymentRecord)]:
+            model_ms, model_peak = measure(lambda: api_client.deserialize(FakeResponse(data), model), args.repeat)
+            raw_ms, raw_peak = measure(lambda: [record.from_dict(item) for item in json.loads(data)["items"]], args.repeat)
+            results.append({
+                "kind": kind,
+                "items": count,
+                "response_bytes": len(data),
+                "model_ms": model_ms,
+                "raw_ms": raw_ms,
+                "model_peak_bytes": model_peak,
+                "raw_peak_bytes": raw_peak,
+                "speedup": round(model_ms / raw_ms, 2) if raw_ms > 0 else None
+            })
+    print(json.dumps({"benchmark": "raw_json", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
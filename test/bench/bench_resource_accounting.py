@@ -0,0 +1,108 @@
+# Microbenchmark of the quantity parsing and resource accounting used by the app status computation.
+# Compares the memoized parser + columnar aggregation against the former inline parsing code.
+#
+# usage: python bench_resource_accounting.py [--pods 10,100,1000,5000] [--repeat 5]
+
+import os, sys, json, random, argparse, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+from service.resource_accounting import ResourceAccounting, parse_quantity, sum_container_metrics
+
+CPU_QUANTITIES = ["100m", "250m", "500m", "1", "1.5", "2"]
+MEMORY_QUANTITIES = ["64Mi", "128Mi", "256Mi", "512Mi", "1Gi", "134217728"]
+CPU_USAGE = ["1250000n", "52340123n", "3m", "120m"]
+MEMORY_USAGE = ["10240Ki", "52340Ki", "128Mi", "3Mi"]
+
+def make_snapshot(pod_count: int, containers_per_pod: int = 2):
+    random.seed(pod_count)
+    pods = []
+    for _ in range(pod_count):
+        containers = []
+        metrics = []
+        for _ in range(containers_per_pod):
+            containers.append((
+                {"cpu": random.choice(CPU_QUANTITIES), "memory": random.choice(MEMORY_QUANTITIES)},
+                {"cpu": random.choice(CPU_QUANTITIES), "memory": random.choice(MEMORY_QUANTITIES)}
+            ))
+            metrics.append({"usage": {"cpu": random.choice(CPU_USAGE), "memory": random.choice(MEMORY_USAGE)}})
+        pods.append((containers, metrics))
+    return pods
+
+# the former inline parsing code of K3sHelper.get_app_status
+def legacy_accounting(pods, system_memory):
+    total_cpu_usage = total_memory_usage = pod_count = 0
+    total_cpu_requests = total_memory_requests = 0
+    for containers, metrics in pods:
+        pod_cpu_usage = pod_memory_usage = 0
+        for container_metric in metrics:
+            cpu_str = container_metric.get('usage', {}).get('cpu', '0')
+            if cpu_str.endswith('m'):
+                pod_cpu_usage += int(cpu_str[:-1]) / 1000
+            elif cpu_str.endswith('n'):
+                pod_cpu_usage += int(cpu_str[:-1]) / 1000000000
+            else:
+                pod_cpu_usage += float(cpu_str)
+            memory_str = container_metric.get('usage', {}).get('memory', '0')
+            if memory_str.endswith('Ki'):
+                pod_memory_usage += int(memory_str[:-2]) * 1024
+            elif memory_str.endswith('Mi'):
+                pod_memory_usage += int(memory_str[:-2]) * 1024 * 1024
+            elif memory_str.endswith('Gi'):
+                pod_memory_usage += int(memory_str[:-2]) * 1024 * 1024 * 1024
+            else:
+                pod_memory_usage += int(memory_str)
+        total_cpu_usage += pod_cpu_usage
+        total_memory_usage += pod_memory_usage
+        pod_count += 1
+        for requests, _ in containers:
+            cpu_request = requests.get('cpu', '0')
+            if cpu_request.endswith('m'):
+                total_cpu_requests += int(cpu_request[:-1]) / 1000
+            else:
+                total_cpu_requests += float(cpu_request)
+            memory_request = requests.get('memory', '0')
+            if memory_request.endswith('Ki'):
+                total_memory_requests += int(memory_request[:-2]) * 1024
+            elif memory_request.endswith('Mi'):
+                total_memory_requests += int(memory_request[:-2]) * 1024 * 1024
+            elif memory_request.endswith('Gi'):
+                total_memory_requests += int(memory_request[:-2]) * 1024 * 1024 * 1024
+            else:
+                total_memory_requests += int(memory_request)
+    cpu_baseline = total_cpu_requests if total_cpu_requests > 0 else pod_count
+    memory_baseline = total_memory_requests if total_memory_requests > 0 else system_memory
+    return round(total_cpu_usage / cpu_baseline * 100, 2), round(total_memory_usage / memory_baseline * 100, 2)
+
+def new_accounting(pods, system_memory):
+    accounting = ResourceAccounting()
+    for containers, metrics in pods:
+        accounting.add_pod(containers, sum_container_metrics(metrics))
+    return accounting.usage_percentages(system_memory)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pods", default="10,100,1000,5000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    system_memory = 4 * 1024 ** 3
+    results = []
+    for pod_count in [int(count) for count in args.pods.split(",")]:
+        pods = make_snapshot(pod_count)
+        number = max(1, 10000 // pod_count)
+        legacy = min(timeit.repeat(lambda: legacy_accounting(pods, system_memory), number=number, repeat=args.repeat)) / number
+        parse_quantity.cache_clear()
+        cold = timeit.timeit(lambda: new_accounting(pods, system_memory), number=1)
+        warm = min(timeit.repeat(lambda: new_accounting(pods, system_memory), number=number, repeat=args.repeat)) / number
+        results.append({
+            "pods": pod_count,
+            "legacy_ms": round(legacy * 1000, 4),
+            "accounting_cold_ms": round(cold * 1000, 4),
+            "accounting_warm_ms": round(warm * 1000, 4),
+            "speedup": round(legacy / warm, 2) if warm > 0 else None,
+            "cache": parse_quantity.cache_info()._asdict()
+        })
+    print(json.dumps({"benchmark": "resource_accounting", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
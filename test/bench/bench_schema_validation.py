@@ -0,0 +1,88 @@
+# Benchmark of the deployment definition validation, the per-request schema load with jsonschema.validate
+# (the previous code path) against the cached precompiled validator with iter_errors, for multi-container
+# deployment definitions, valid and with errors.
+#
+# usage: python bench_schema_validation.py [--containers 1,4,8] [--repeat 5]
+
+import os, sys, json, copy, argparse, timeit, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+# the service modules log under the home directory
+os.environ.setdefault("K3S_THIN_CLIENT_HOME", tempfile.mkdtemp())
+import jsonschema
+from utils.schema_validator import SchemaValidatorCache
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "deployment")
+SCHEMA_FILE = "create_deployment_schema.json"
+
+def make_container(index: int):
+    return {
+        "name": f"container-{index}",
+        "image": f"registry.local/app-{index}:1.0.0",
+        "imagePullPolicy": "IfNotPresent",
+        "ports": [{"containerPort": 8080 + index, "protocol": "TCP"}],
+        "env": [{"name": f"ENV_{n}", "value": f"value-{n}"} for n in range(10)],
+        "resources": {"requests": {"cpu": "100m", "memory": "64Mi"}, "limits": {"cpu": "500m", "memory": "256Mi"}},
+        "volumeMounts": [{"name": "data", "mountPath": f"/data/{index}"}]
+    }
+
+def make_deployment(containers: int):
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "Deployment",
+        "metadata": {"name": "bench-app", "namespace": "default", "labels": {"app": "bench-app"}},
+        "spec": {
+            "replicas": 2,
+            "selector": {"matchLabels": {"app": "bench-app"}},
+            "template": {
+                "metadata": {"labels": {"app": "bench-app"}},
+                "spec": {
+                    "containers": [make_container(index) for index in range(containers)],
+                    "volumes": [{"name": "data", "emptyDir": {}}]
+                }
+            }
+        }
+    }
+
+def make_invalid(deployment):
+    invalid = copy.deepcopy(deployment)
+    invalid["kind"] = "StatefulSet"
+    invalid["spec"]["replicas"] = "two"
+    return invalid
+
+def validate_uncached(instance):
+    with open(os.path.join(SCHEMA_DIR, SCHEMA_FILE), "r") as file:
+        schema = json.load(file)
+    try:
+        jsonschema.validate(instance=instance, schema=schema)
+        return []
+    except jsonschema.ValidationError as ex:
+        return [ex.message]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--containers", default="1,4,8")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cache = SchemaValidatorCache(SCHEMA_DIR)
+    results = []
+    for containers in [int(count) for count in args.containers.split(",")]:
+        valid = make_deployment(containers)
+        for kind, instance in [("valid", valid), ("invalid", make_invalid(valid))]:
+            number = 200
+            uncached = min(timeit.repeat(lambda: validate_uncached(instance), number=number, repeat=args.repeat)) / number
+            cached = min(timeit.repeat(lambda: cache.validate(SCHEMA_FILE, instance), number=number, repeat=args.repeat)) / number
+            results.append({
+                "containers": containers,
+                "instance": kind,
+                "uncached_us": round(uncached * 1_000_000, 1),
+                "cached_us": round(cached * 1_000_000, 1),
+                "speedup": round(uncached / cached, 2),
+                "uncached_errors": len(validate_uncached(instance)),
+                "cached_errors": len(cache.validate(SCHEMA_FILE, instance))
+            })
+    print(json.dumps({"benchmark": "schema_validation", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# Benchmark of the whole service (K3SContainerService in its own process) against a fake Kubernetes API server
+# (fake_kube_api.py) and an MQTT broker stand-in (fake_mqtt_broker.py), at several numbers of apps. Measured:
+#   - heartbeat: wall time and CPU time of the status report, message size and Kubernetes API calls per heartbeat
+#   - status queries: end to end latency percentiles of get_apps_and_resources_status and get_app_status
+#   - rollout: API calls and wait time of a deploy_app, from the request's trace ("trace": true)
+# The 'sudo' and 'k3s' commands are replaced by shims listing the synthetic images. The results are printed as JSON.
+#
+# usage: python bench_service.py [--apps 10,100,500] [--heartbeats 5] [--queries 20] [--rollouts 1]
+#                                [--runtime threads|asyncio] [--heartbeat-frequency 2] [--rollout-delay 3]
+
+import os, sys, json, time, argparse, tempfile, shutil, signal, subprocess, threading, random
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, "..", "..")
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+sys.path.insert(0, BENCH_DIR)
+# the logger of the service modules needs a home directory
+os.environ.setdefault("K3S_THIN_CLIENT_HOME", tempfile.mkdtemp())
+
+from messaging import codec
+from messaging.mqtt_proxy import TERMINAL_STATUSES
+from fake_kube_api import FakeCluster, FakeKubeAPIServer
+from fake_mqtt_broker import FakeMQTTBroker
+
+MQTT_USER = "bench"
+MQTT_DEVICE_KEY = "device"
+DOWNSTREAM_TOPIC = f"/{MQTT_USER}/{MQTT_DEVICE_KEY}/downstream_edge_k3s"
+UPSTREAM_TOPIC = f"/{MQTT_USER}/{MQTT_DEVICE_KEY}/upstream_edge_k3s"
+
+CONFIG_TEMPLATE = """[general]
+heartbeat_frequency = {heartbeat_frequency}
+runtime = {runtime}
+[mqtt]
+host = {mqtt_host}
+port = {mqtt_port}
+protocol = mqtt
+user = {user}
+password = bench
+device_key = {device_key}
+[metrics]
+source = metrics-server
+port = 0
+[k3s]
+kube_config = {kube_config}
+"""
+
+SUDO_SHIM = """#!/bin/sh
+exec "$@"
+"""
+
+# 'k3s ctr images list -q' lists the images of the synthetic apps, the other commands succeed
+K3S_SHIM = """#!/bin/sh
+if [ "$1 $2 $3" = "ctr images list" ]; then
+    i=0
+    while [ $i -lt {apps} ]; do echo "registry.local/app-$i:1.0.0"; i=$((i+1)); done
+fi
+exit 0
+"""
+
+# This function runs the service, the child process of a measurement; every heartbeat's wall and CPU time is
+# printed as a JSON line
+def run_service():
+    from run import K3SContainerService
+
+    class BenchService(K3SContainerService):
+        def _on_heartbeat(self):
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            super()._on_heartbeat()
+            print(json.dumps({"heartbeat_ms": (time.perf_counter() - start) * 1000,
+                              "heartbeat_cpu_ms": (time.thread_time() - cpu_start) * 1000}), flush=True)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+    service = BenchService()
+    if not service.initialize():
+        return 1
+    return service.start()
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def rank(percent):
+        return round(values[min(len(values) - 1, int(len(values) * percent / 100))], 3)
+    return {"count": len(values), "p50": rank(50), "p90": rank(90), "p99": rank(99), "max": round(values[-1], 3),
+            "mean": round(sum(values) / len(values), 3)}
+
+# This class collects the upstream messages of the service: the heartbeats (with the API calls made since the
+# previous heartbeat) and the terminal responses per request_id
+class UpstreamCollector:
+    def __init__(self, api: FakeKubeAPIServer):
+        self._api = api
+        self._condition = threading.Condition()
+        # (arrival time, message bytes, API calls)
+        self.heartbeats = []
+        self._responses = {}
+
+    def on_message(self, topic: str, payload: bytes):
+        if topic != UPSTREAM_TOPIC:
+            return
+        data = codec.decode(payload)
+        arrival = time.perf_counter()
+        with self._condition:
+            if data.get("status_update") == "apps_and_resources_status":
+                self.heartbeats.append((arrival, len(payload), sum(self._api.calls(reset=True).values())))
+            elif data.get("status") in TERMINAL_STATUSES and data.get("request_id") is not None:
+                self._responses[data["request_id"]] = (arrival, data)
+            else:
+                return
+            self._condition.notify_all()
+
+    def wait_heartbeats(self, count: int, timeout: float) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self.heartbeats) >= count, timeout)
+
+    def wait_response(self, request_id: str, timeout: float):
+        with self._condition:
+            if not self._condition.wait_for(lambda: request_id in self._responses, timeout):
+                raise TimeoutError(f"no response to the request {request_id} in {timeout}s")
+            return self._responses.pop(request_id)
+
+def prepare_home(home: str, api: FakeKubeAPIServer, broker: FakeMQTTBroker, apps: int, args) -> str:
+    os.makedirs(os.path.join(home, "config"))
+    kube_config = os.path.join(home, "k3s.yaml")
+    api.write_kubeconfig(kube_config)
+    with open(os.path.join(home, "config", "config.ini"), "w") as f:
+        f.write(CONFIG_TEMPLATE.format(heartbeat_frequency=args.heartbeat_frequency, runtime=args.runtime,
+                                       mqtt_host=broker.host, mqtt_port=broker.port, user=MQTT_USER,
+                                       device_key=MQTT_DEVICE_KEY, kube_config=kube_config))
+    shutil.copytree(os.path.join(ROOT_DIR, "deployment"), os.path.join(home, "deployment"))
+    bin_dir = os.path.join(home, "bin")
+    os.makedirs(bin_dir)
+    for name, script in [("sudo", SUDO_SHIM), ("k3s", K3S_SHIM.format(apps=apps))]:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    return bin_dir
+
+def measure(apps: int, args):
+    import psutil
+
+    home = tempfile.mkdtemp(prefix="bench-service-")
+    cluster = FakeCluster(apps, replicas=args.replicas, rollout_delay=args.rollout_delay)
+    api = FakeKubeAPIServer(cluster).start()
+    collector = UpstreamCollector(api)
+    broker = FakeMQTTBroker(on_message=collector.on_message).start()
+    bin_dir = prepare_home(home, api, broker, apps, args)
+    env = dict(os.environ, K3S_THIN_CLIENT_HOME=home, PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""))
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--service"], cwd=home, env=env,
+                             stdout=subprocess.PIPE, text=True)
+    heartbeat_times = []
+
+    def read_output():
+        for line in child.stdout:
+            try:
+                heartbeat_times.append(json.loads(line))
+            except ValueError:
+                pass
+    threading.Thread(target=read_output, daemon=True).start()
+
+    def request(payload, timeout):
+        start = time.perf_counter()
+        broker.publish(DOWNSTREAM_TOPIC, json.dumps(payload).encode())
+        arrival, response = collector.wait_response(payload["request_id"], timeout)
+        return (arrival - start) * 1000, response
+
+    try:
+        if not broker.subscribed.wait(60):
+            raise RuntimeError("the service did not subscribe to the downstream topic")
+
+        # heartbeat cost, the first heartbeat (cold caches and connections) is left out
+        timeout = (args.heartbeats + 2) * (args.heartbeat_frequency + apps / 10 + 5)
+        process = psutil.Process(child.pid)
+        collector.wait_heartbeats(1, timeout)
+        cpu_start = sum(process.cpu_times()[:2])
+        wall_start = time.perf_counter()
+        if not collector.wait_heartbeats(args.heartbeats + 1, timeout):
+            raise RuntimeError("the heartbeats did not arrive")
+        process_cpu = sum(process.cpu_times()[:2]) - cpu_start
+        wall = time.perf_counter() - wall_start
+        # the timings are printed by the service right after sending the heartbeat
+        deadline = time.monotonic() + 5
+        while len(heartbeat_times) < args.heartbeats + 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        heartbeats = collector.heartbeats[1:args.heartbeats + 1]
+        timings = heartbeat_times[1:args.heartbeats + 1]
+        heartbeat = {
+            "wall_ms": percentiles([timing["heartbeat_ms"] for timing in timings]),
+            "cpu_ms": percentiles([timing["heartbeat_cpu_ms"] for timing in timings]),
+            "message_bytes": percentiles([size for _, size, _ in heartbeats]),
+            "api_calls": percentiles([calls for _, _, calls in heartbeats]),
+            "process_cpu_percent": round(100 * process_cpu / wall, 2)
+        }
+
+        # status query latency, end to end through the broker
+        latencies = {"get_apps_and_resources_status": [], "get_app_status": []}
+        for index in range(args.queries):
+            for request_name, latency_list in latencies.items():
+                payload = {"request_id": f"{request_name}-{index}", "request": request_name}
+                if request_name == "get_app_status":
+                    payload.update({"app_name": f"app-{random.randrange(apps)}", "namespace": "default"})
+                latency, _ = request(payload, 120)
+                latency_list.append(latency)
+        status_queries = {request_name: percentiles(values) for request_name, values in latencies.items()}
+
+        # rollout wait, the API calls are counted from the trace of the request
+        rollouts = []
+        for index in range(args.rollouts):
+            name = f"bench-rollout-{index}"
+            latency, response = request({"request_id": name, "request": "deploy_app", "trace": True,
+                                         "deployment_definition": FakeCluster.make_deployment(name, replicas=args.replicas)}, 300)
+            spans = response.get("timings", {}).get("spans", [])
+            routes = Counter(f"{span['attrs']['verb']} {span['attrs']['path']}" for span in spans if span["name"] == "kube_api")
+            rollout_wait = [span["duration_ms"] for span in spans if span["name"] == "rollout_wait"]
+            rollouts.append({
+                "status": response.get("status"),
+                "duration_ms": round(latency, 3),
+                "rollout_wait_ms": rollout_wait[0] if rollout_wait else None,
+                "api_calls": sum(routes.values()),
+                "api_calls_by_route": dict(routes.most_common())
+            })
+
+        return {
+            "apps": apps,
+            "runtime": args.runtime,
+            "heartbeat": heartbeat,
+            "status_queries_ms": status_queries,
+            "rollouts": rollouts
+        }
+    finally:
+        child.send_signal(signal.SIGTERM)
+        try:
+            child.wait(15)
+        except subprocess.TimeoutExpired:
+            child.kill()
+        broker.stop()
+        api.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", default="10,100,500")
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--heartbeats", type=int, default=5)
+    parser.add_argument("--heartbeat-frequency", type=int, default=2)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--rollouts", type=int, default=1)
+    parser.add_argument("--rollout-delay", type=float, default=3.0)
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--service", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.service:
+        sys.exit(run_service())
+
+    results = [measure(int(count), args) for count in args.apps.split(",")]
+    print(json.dumps({"benchmark": "service", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Benchmark of the service start-up import cost, 'import run' is timed with 'python -X importtime' in a subprocess
+# with a temporary home directory. Reports the total import time, the heaviest modules and whether the heavy
+# modules (kubernetes, jsonschema, requests...) were imported before the MQTT connection.
+#
+# usage: python bench_startup.py [--top 15] [--repeat 3] [--budget-ms 0]
+
+import os, sys, json, argparse, subprocess, tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+# modules which are expected to be imported only after connecting to the broker
+DEFERRED_MODULES = ["kubernetes", "jsonschema", "requests", "yaml", "psutil"]
+
+CONFIG = """[mqtt]
+host = 127.0.0.1
+port = 1883
+user = bench
+password = bench
+device_key = bench
+"""
+
+CHECK = "import sys, run; print(','.join(sorted({m.split('.')[0] for m in sys.modules} & set(sys.argv[1].split(',')))))"
+
+def run_import(home_dir: str):
+    env = dict(os.environ, K3S_THIN_CLIENT_HOME=home_dir, PYTHONPATH=os.path.abspath(SRC_DIR))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHECK, ",".join(DEFERRED_MODULES)],
+                            capture_output=True, text=True, env=env, cwd=home_dir)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "import failed")
+    modules = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return modules, loaded
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--budget-ms", type=float, default=0, help="exit with 1 when the import time is above the budget")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home_dir:
+        os.makedirs(os.path.join(home_dir, "config"))
+        with open(os.path.join(home_dir, "config", "config.ini"), "w") as file:
+            file.write(CONFIG)
+        runs = [run_import(home_dir) for _ in range(max(1, args.repeat))]
+
+    # the fastest run is reported, the others are mostly disturbed by the disk cache
+    modules, loaded = min(runs, key=lambda run: run[0].get("run", (0, 0))[1])
+    total_ms = modules.get("run", (0, 0))[1] / 1000
+    heaviest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+    print(json.dumps({
+        "benchmark": "startup",
+        "import_run_ms": round(total_ms, 1),
+        "modules": len(modules),
+        "deferred_modules_loaded": loaded,
+        "heaviest": [{"module": name, "self_ms": round(times[0] / 1000, 2), "cumulative_ms": round(times[1] / 1000, 2)}
+                     for name, times in heaviest]
+    }, indent=2))
+    if args.budget_ms > 0 and (total_ms > args.budget_ms or loaded):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+# Fake Kubernetes API server for the benchmarks: synthetic deployments, their pods, the pod metrics
+# (metrics.k8s.io) and the events, served over HTTP on a local port. Only the routes used by K3sHelper are
+# implemented. A created or patched deployment rolls out after rollout_delay seconds: its pods are 'Pending'
+# until then and 'Running' afterwards. The calls are counted per route for the API call counts of the benchmarks.
+
+import json, re, sys, threading, time, uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit, parse_qs
+
+KUBECONFIG_TEMPLATE = """apiVersion: v1
+kind: Config
+clusters:
+- name: fake
+  cluster:
+    server: {url}
+contexts:
+- name: fake
+  context:
+    cluster: fake
+    user: fake
+current-context: fake
+users:
+- name: fake
+  user:
+    token: fake
+"""
+
+def _timestamp(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _merge(target: Dict[str, Any], patch: Dict[str, Any]):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif key == "containers" and isinstance(value, list) and isinstance(target.get(key), list):
+            # strategic merge of the containers by name
+            by_name = {container.get("name"): container for container in target[key]}
+            for container in value:
+                if container.get("name") in by_name:
+                    _merge(by_name[container["name"]], container)
+                else:
+                    target[key].append(container)
+        else:
+            target[key] = value
+
+# This class is the state of the fake cluster
+class FakeCluster:
+    def __init__(self, apps: int = 10, replicas: int = 1, events_per_app: int = 2, rollout_delay: float = 3.0,
+                 namespace: str = "default"):
+        self.rollout_delay = rollout_delay
+        self.events_per_app = events_per_app
+        self._lock = threading.Lock()
+        # (namespace, name) -> {"object": deployment, "ready_at": epoch}
+        self._deployments: Dict[tuple, Dict[str, Any]] = {}
+        self._namespaces = {"default", "kube-system", namespace}
+        started = time.time() - 3600
+        for index in range(apps):
+            self.create_deployment(namespace, self.make_deployment(f"app-{index}", namespace, replicas), ready_at=started)
+
+    @staticmethod
+    def make_deployment(name: str, namespace: str = "default", replicas: int = 1, image: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "metadata": {"name": name, "namespace": namespace},
+            "spec": {
+                "replicas": replicas,
+                "selector": {"matchLabels": {"app": name}},
+                "template": {
+                    "metadata": {"labels": {"app": name}},
+                    "spec": {"containers": [{
+                        "name": "main",
+                        "image": image or f"registry.local/{name}:1.0.0",
+                        "imagePullPolicy": "IfNotPresent",
+                        "resources": {"requests": {"cpu": "100m", "memory": "64Mi"}, "limits": {"cpu": "500m", "memory": "128Mi"}}
+                    }]}
+                }
+            }
+        }
+
+    def create_deployment(self, namespace: str, body: Dict[str, Any], ready_at: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        deployment = json.loads(json.dumps(body))
+        metadata = deployment.setdefault("metadata", {})
+        metadata["namespace"] = namespace
+        metadata.setdefault("uid", str(uuid.uuid4()))
+        metadata["creationTimestamp"] = _timestamp(ready_at if ready_at is not None else now)
+        with self._lock:
+            key = (namespace, metadata.get("name"))
+            if key in self._deployments:
+                return None
+            self._deployments[key] = {"object": deployment, "ready_at": ready_at if ready_at is not None else now + self.rollout_delay}
+        return self._with_status(self._deployments[key])
+
+    def patch_deployment(self, namespace: str, name: str, patch: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._deployments.get((namespace, name))
+            if entry is None:
+                return None
+            _merge(entry["object"], patch)
+            entry["ready_at"] = time.time() + self.rollout_delay
+        return self._with_status(entry)
+
+    def delete_deployment(self, namespace: str, name: str) -> bool:
+        with self._lock:
+            return self._deployments.pop((namespace, name), None) is not None
+
+    def get_deployment(self, namespace: str, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._deployments.get((namespace, name))
+        return self._with_status(entry) if entry is not None else None
+
+    def list_deployments(self, namespace: Optional[str] = None, exclude_namespace: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = [entry for (entry_namespace, _), entry in sorted(self._deployments.items())
+                       if (namespace is None or entry_namespace == namespace) and entry_namespace != exclude_namespace]
+        return [self._with_status(entry) for entry in entries]
+
+    def has_namespace(self, namespace: str) -> bool:
+        return namespace in self._namespaces
+
+    def add_namespace(self, namespace: str):
+        self._namespaces.add(namespace)
+
+    def _with_status(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        deployment = entry["object"]
+        replicas = deployment.get("spec", {}).get("replicas", 1)
+        ready = replicas if time.time() >= entry["ready_at"] else 0
+        deployment["status"] = {
+            "replicas": replicas,
+            "readyReplicas": ready,
+            "availableReplicas": ready,
+            "updatedReplicas": replicas,
+            "unavailableReplicas": replicas - ready,
+            "conditions": [{"type": "Available", "status": "True" if ready == replicas else "False",
+                            "lastUpdateTime": _timestamp(entry["ready_at"])}]
+        }
+        return deployment
+
+    def list_pods(self, namespace: str, label_selector: Optional[str] = None) -> List[Dict[str, Any]]:
+        labels = dict(item.split("=", 1) for item in label_selector.split(",") if "=" in item) if label_selector else {}
+        with self._lock:
+            entries = [entry for (entry_namespace, _), entry in sorted(self._deployments.items()) if entry_namespace == namespace]
+        pods = []
+        for entry in entries:
+            deployment = entry["object"]
+            match_labels = deployment["spec"]["selector"]["matchLabels"]
+            if any(match_labels.get(key) != value for key, value in labels.items()):
+                continue
+            pods.extend(self._make_pods(deployment, entry["ready_at"]))
+        return pods
+
+    def _make_pods(self, deployment: Dict[str, Any], ready_at: float) -> List[Dict[str, Any]]:
+        name = deployment["metadata"]["name"]
+        namespace = deployment["metadata"]["namespace"]
+        containers = deployment["spec"]["template"]["spec"]["containers"]
+        running = time.time() >= ready_at
+        pods = []
+        for index in range(deployment["spec"].get("replicas", 1)):
+            pod_name = f"{name}-5d8f7c9b6-{index:05d}"
+            pods.append({
+                "metadata": {
+                    "name": pod_name,
+                    "namespace": namespace,
+                    "uid": str(uuid.uuid5(uuid.NAMESPACE_URL, f"{namespace}/{pod_name}")),
+                    "labels": dict(deployment["spec"]["selector"]["matchLabels"]),
+                    "managedFields": [{"manager": "kubelet", "time": _timestamp(ready_at)}]
+                },
+                "spec": {"containers": containers},
+                "status": {
+                    "phase": "Running" if running else "Pending",
+                    "qosClass": "Burstable",
+                    "startTime": _timestamp(ready_at - 1),
+                    "containerStatuses": [{"name": container["name"], "containerID": f"containerd://{index:064x}"}
+                                          for container in containers]
+                }
+            })
+        return pods
+
+    def pod_metrics(self, namespace: str, pod_name: str) -> Dict[str, Any]:
+        return {
+            "metadata": {"name": pod_name, "namespace": namespace},
+            "containers": [{"name": "main", "usage": {"cpu": "12500000n", "memory": "32768Ki"}}]
+        }
+
+    def list_events(self, namespace: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            names = [name for (entry_namespace, name) in sorted(self._deployments) if entry_namespace == namespace]
+        now = _timestamp(time.time())
+        return [{
+            "metadata": {"name": f"{name}.{index}", "namespace": namespace},
+            "involvedObject": {"kind": "Pod", "name": f"{name}-5d8f7c9b6-00000"},
+            "reason": "BackOff" if index % 2 else "Pulled",
+            "message": "synthetic event",
+            "firstTimestamp": now
+        } for name in names for index in range(self.events_per_app)]
+
+# (method, route, pattern), the route is the label of the counted calls
+ROUTES = [
+    ("GET", "list_deployments", re.compile(r"^/apis/apps/v1/deployments$")),
+    ("GET", "list_namespaced_deployments", re.compile(r"^/apis/apps/v1/namespaces/(?P<namespace>[^/]+)/deployments$")),
+    ("POST", "create_deployment", re.compile(r"^/apis/apps/v1/namespaces/(?P<namespace>[^/]+)/deployments$")),
+    ("GET", "read_deployment", re.compile(r"^/apis/apps/v1/namespaces/(?P<namespace>[^/]+)/deployments/(?P<name>[^/]+)$")),
+    ("PATCH", "patch_deployment", re.compile(r"^/apis/apps/v1/namespaces/(?P<namespace>[^/]+)/deployments/(?P<name>[^/]+)$")),
+    ("DELETE", "delete_deployment", re.compile(r"^/apis/apps/v1/namespaces/(?P<namespace>[^/]+)/deployments/(?P<name>[^/]+)$")),
+    ("GET", "list_pods", re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/pods$")),
+    ("GET", "read_pod_log", re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/pods/(?P<name>[^/]+)/log$")),
+    ("GET", "list_events", re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/events$")),
+    ("GET", "read_namespace", re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)$")),
+    ("POST", "create_namespace", re.compile(r"^/api/v1/namespaces$")),
+    ("GET", "read_pod_metrics", re.compile(r"^/apis/metrics.k8s.io/v1beta1/namespaces/(?P<namespace>[^/]+)/pods/(?P<name>[^/]+)$")),
+]
+
+class _FakeKubeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are separate writes, without TCP_NODELAY the client's delayed ACK adds ~40ms per call
+    disable_nagle_algorithm = True
+    api: "FakeKubeAPIServer" = None
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method: str):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        for route_method, route, pattern in ROUTES:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                self.api.count(route)
+                status, response = getattr(self, f"_{route}")(query, body, **match.groupdict())
+                self._send(status, response)
+                return
+        self.api.count("unknown")
+        self._send(404, self._status(404, f"no route for {method} {url.path}"))
+
+    def _send(self, status: int, response: Any):
+        if isinstance(response, str):
+            data, content_type = response.encode(), "text/plain"
+        else:
+            data, content_type = json.dumps(response).encode(), "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def _status(code: int, message: str) -> Dict[str, Any]:
+        reason = {404: "NotFound", 409: "AlreadyExists"}.get(code, "")
+        return {"kind": "Status", "apiVersion": "v1", "status": "Failure", "message": message, "reason": reason, "code": code}
+
+    @staticmethod
+    def _page(kind: str, items: List[Dict[str, Any]], query: Dict[str, str]) -> Dict[str, Any]:
+        start = int(query.get("continue") or 0)
+        limit = int(query.get("limit") or 0)
+        end = start + limit if limit else len(items)
+        metadata = {"continue": str(end)} if end < len(items) else {}
+        return {"kind": kind, "apiVersion": "v1", "metadata": metadata, "items": items[start:end]}
+
+    def _list_deployments(self, query, body):
+        exclude = None
+        field_selector = query.get("fieldSelector") or ""
+        if field_selector.startswith("metadata.namespace!="):
+            exclude = field_selector.split("!=", 1)[1]
+        return 200, self._page("DeploymentList", self.api.cluster.list_deployments(exclude_namespace=exclude), query)
+
+    def _list_namespaced_deployments(self, query, body, namespace):
+        return 200, self._page("DeploymentList", self.api.cluster.list_deployments(namespace), query)
+
+    def _create_deployment(self, query, body, namespace):
+        deployment = self.api.cluster.create_deployment(namespace, body)
+        if deployment is None:
+            return 409, self._status(409, "deployment already exists")
+        return 201, deployment
+
+    def _read_deployment(self, query, body, namespace, name):
+        deployment = self.api.cluster.get_deployment(namespace, name)
+        return (200, deployment) if deployment is not None else (404, self._status(404, f"deployments \"{name}\" not found"))
+
+    def _patch_deployment(self, query, body, namespace, name):
+        deployment = self.api.cluster.patch_deployment(namespace, name, body or {})
+        return (200, deployment) if deployment is not None else (404, self._status(404, f"deployments \"{name}\" not found"))
+
+    def _delete_deployment(self, query, body, namespace, name):
+        if not self.api.cluster.delete_deployment(namespace, name):
+            return 404, self._status(404, f"deployments \"{name}\" not found")
+        return 200, {"kind": "Status", "apiVersion": "v1", "status": "Success"}
+
+    def _list_pods(self, query, body, namespace):
+        return 200, {"kind": "PodList", "apiVersion": "v1", "metadata": {},
+                     "items": self.api.cluster.list_pods(namespace, query.get("labelSelector"))}
+
+    def _read_pod_log(self, query, body, namespace, name):
+        lines = int(query.get("tailLines") or 100)
+        return 200, "\n".join(f"{name} synthetic log line {index}" for index in range(lines))
+
+    def _list_events(self, query, body, namespace):
+        return 200, {"kind": "EventList", "apiVersion": "v1", "metadata": {}, "items": self.api.cluster.list_events(namespace)}
+
+    def _read_namespace(self, query, body, namespace):
+        if not self.api.cluster.has_namespace(namespace):
+            return 404, self._status(404, f"namespaces \"{namespace}\" not found")
+        return 200, {"kind": "Namespace", "apiVersion": "v1", "metadata": {"name": namespace}}
+
+    def _create_namespace(self, query, body):
+        name = (body or {}).get("metadata", {}).get("name")
+        self.api.cluster.add_namespace(name)
+        return 201, {"kind": "Namespace", "apiVersion": "v1", "metadata": {"name": name}}
+
+    def _read_pod_metrics(self, query, body, namespace, name):
+        return 200, self.api.cluster.pod_metrics(namespace, name)
+
+class _FakeKubeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the pooled connections of the client are reset when the service stops
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+# This class serves the fake cluster in a background thread
+class FakeKubeAPIServer:
+    def __init__(self, cluster: FakeCluster, host: str = "127.0.0.1", port: int = 0):
+        self.cluster = cluster
+        self._calls = Counter()
+        self._lock = threading.Lock()
+        handler = type("FakeKubeHandler", (_FakeKubeHandler,), {"api": self})
+        self._server = _FakeKubeHTTPServer((host, port), handler)
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+
+    def start(self) -> "FakeKubeAPIServer":
+        threading.Thread(target=self._server.serve_forever, name="fake-kube-api", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, route: str):
+        with self._lock:
+            self._calls[route] += 1
+
+    # This function gets the call counts per route since the previous reset
+    def calls(self, reset: bool = False) -> Dict[str, int]:
+        with self._lock:
+            calls = dict(self._calls)
+            if reset:
+                self._calls.clear()
+        return calls
+
+    def write_kubeconfig(self, path: str):
+        with open(path, "w") as f:
+            f.write(KUBECONFIG_TEMPLATE.format(url=self.url))
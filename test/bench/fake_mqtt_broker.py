@@ -0,0 +1,192 @@
+# In-process MQTT broker stand-in for the benchmarks: MQTT 3.1.1 and 5 clients, QoS 0/1 publishes from the
+# clients (acknowledged), QoS 0 delivery to the subscribers, '+'/'#' topic filters. No retained messages, no
+# sessions and no authentication. The harness publishes with publish() and observes every message published by
+# the clients through the on_message callback.
+
+import socket, struct, threading
+from typing import Callable, List, Optional, Tuple
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        out.append(byte | (128 if value else 0))
+        if not value:
+            return bytes(out)
+
+def decode_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value, multiplier = 0, 1
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 127) * multiplier
+        multiplier *= 128
+        if not byte & 128:
+            return value, offset
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+class _Session:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.v5 = False
+        self.filters: List[str] = []
+        self.lock = threading.Lock()
+
+    def send(self, packet_type: int, body: bytes, flags: int = 0):
+        with self.lock:
+            self.sock.sendall(bytes([(packet_type << 4) | flags]) + encode_varint(len(body)) + body)
+
+class FakeMQTTBroker:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 on_message: Optional[Callable[[str, bytes], None]] = None):
+        self.on_message = on_message
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen()
+        self.host, self.port = self._server.getsockname()
+        self._sessions: List[_Session] = []
+        self._lock = threading.Lock()
+        # set when a client has subscribed
+        self.subscribed = threading.Event()
+        self.published_messages = 0
+        self.published_bytes = 0
+
+    def start(self) -> "FakeMQTTBroker":
+        threading.Thread(target=self._accept, name="fake-broker", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.close()
+        with self._lock:
+            for session in self._sessions:
+                session.sock.close()
+
+    # This function delivers the message to the subscribed clients at QoS 0
+    def publish(self, topic: str, payload: bytes):
+        topic_bytes = topic.encode()
+        with self._lock:
+            sessions = [session for session in self._sessions
+                        if any(topic_matches(topic_filter, topic) for topic_filter in session.filters)]
+        for session in sessions:
+            body = struct.pack("!H", len(topic_bytes)) + topic_bytes + (b"\x00" if session.v5 else b"") + payload
+            try:
+                session.send(PUBLISH, body)
+            except OSError:
+                pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = _Session(sock)
+            with self._lock:
+                self._sessions.append(session)
+            threading.Thread(target=self._serve, args=(session,), daemon=True).start()
+
+    def _read_packet(self, sock: socket.socket) -> Tuple[Optional[int], bytes]:
+        header = self._read_exactly(sock, 1)
+        if not header:
+            return None, b""
+        length, multiplier = 0, 1
+        while True:
+            byte = self._read_exactly(sock, 1)
+            if not byte:
+                return None, b""
+            length += (byte[0] & 127) * multiplier
+            multiplier *= 128
+            if not byte[0] & 128:
+                break
+        body = self._read_exactly(sock, length) if length else b""
+        if body is None:
+            return None, b""
+        return header[0], body
+
+    @staticmethod
+    def _read_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+        data = b""
+        while len(data) < size:
+            try:
+                chunk = sock.recv(size - len(data))
+            except OSError:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _serve(self, session: _Session):
+        try:
+            while True:
+                header, body = self._read_packet(session.sock)
+                if header is None:
+                    return
+                packet_type = header >> 4
+                if packet_type == CONNECT:
+                    # protocol name (2 + 4 bytes) followed by the protocol level
+                    session.v5 = body[6] == 5
+                    session.send(CONNACK, b"\x00\x00" + (b"\x00" if session.v5 else b""))
+                elif packet_type == PUBLISH:
+                    self._on_publish(session, header, body)
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset = body[:2], 2
+                    if session.v5:
+                        length, offset = decode_varint(body, offset)
+                        offset += length
+                    granted = bytearray()
+                    while offset < len(body):
+                        length = struct.unpack("!H", body[offset:offset + 2])[0]
+                        session.filters.append(body[offset + 2:offset + 2 + length].decode())
+                        granted.append(min(body[offset + 2 + length] & 3, 1))
+                        offset += 3 + length
+                    session.send(SUBACK, packet_id + (b"\x00" if session.v5 else b"") + bytes(granted), 0)
+                    self.subscribed.set()
+                elif packet_type == UNSUBSCRIBE:
+                    session.send(UNSUBACK, body[:2] + (b"\x00" if session.v5 else b""))
+                elif packet_type == PINGREQ:
+                    session.send(PINGRESP, b"")
+                elif packet_type == DISCONNECT:
+                    return
+        finally:
+            with self._lock:
+                if session in self._sessions:
+                    self._sessions.remove(session)
+            session.sock.close()
+
+    def _on_publish(self, session: _Session, header: int, body: bytes):
+        qos = (header >> 1) & 3
+        length = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + length].decode()
+        offset = 2 + length
+        packet_id = None
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+        if session.v5:
+            length, offset = decode_varint(body, offset)
+            offset += length
+        payload = body[offset:]
+        if packet_id is not None:
+            session.send(PUBACK, packet_id)
+        self.published_messages += 1
+        self.published_bytes += len(payload)
+        if self.on_message is not None:
+            self.on_message(topic, payload)
+        self.publish(topic, payload)
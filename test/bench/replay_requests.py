@@ -0,0 +1,166 @@
+# Replays a recording of the requests received by a device ([recorder] file of the configuration) through
+# MessageProcessor/AppManager in this process, in the recorded order, at the recorded pace, accelerated
+# (--speed 10) or as fast as possible (--speed 0). The requests run against the cluster of the configuration or,
+# with --fake-apps N, against the fake Kubernetes API of the benchmarks (the 'sudo' and 'k3s' commands are replaced
+# by the shims of bench_service.py). The service runs in a temporary home directory with a copy of the configuration
+# and the deployment schemas, its responses are not sent anywhere. The latency percentiles and the statuses per
+# request type and the pacing lag are printed as JSON.
+#
+# usage: python replay_requests.py RECORDING [--config config.ini] [--speed 1] [--fake-apps N] [--timeout 600]
+
+import os, sys, json, time, argparse, tempfile, shutil, threading, configparser
+from collections import Counter, defaultdict, deque
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, "..", "..")
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+sys.path.insert(0, BENCH_DIR)
+
+# This function creates the temporary home directory of the replay, returns the directory of the command shims
+# when the fake cluster is used
+def prepare_home(home: str, config_file: str, kube_config: str = None, apps: int = 0) -> str:
+    config = configparser.ConfigParser()
+    if not config.read(config_file):
+        raise FileNotFoundError(f"Configuration file not found: {config_file}")
+    for section in ["metrics", "recorder", "k3s"]:
+        if not config.has_section(section):
+            config.add_section(section)
+    # the replayed requests are not recorded again
+    config.set("recorder", "file", "")
+    if kube_config is not None:
+        config.set("k3s", "kube_config", kube_config)
+        config.set("metrics", "source", "metrics-server")
+    os.makedirs(os.path.join(home, "config"))
+    with open(os.path.join(home, "config", "config.ini"), "w") as f:
+        config.write(f)
+    schema_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(config_file))), "deployment")
+    if not os.path.isdir(schema_dir):
+        schema_dir = os.path.join(ROOT_DIR, "deployment")
+    shutil.copytree(schema_dir, os.path.join(home, "deployment"))
+    if kube_config is None:
+        return None
+    from bench_service import SUDO_SHIM, K3S_SHIM
+    bin_dir = os.path.join(home, "bin")
+    os.makedirs(bin_dir)
+    for name, script in [("sudo", SUDO_SHIM), ("k3s", K3S_SHIM.format(apps=apps))]:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    return bin_dir
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording")
+    parser.add_argument("--config", help="config.ini of the replay, default: the one of K3S_THIN_CLIENT_HOME")
+    parser.add_argument("--speed", type=float, default=1.0, help="pace multiplier, 0 replays as fast as possible")
+    parser.add_argument("--fake-apps", type=int, help="run against the fake Kubernetes API with this many apps")
+    parser.add_argument("--rollout-delay", type=float, default=3.0)
+    parser.add_argument("--timeout", type=float, default=600, help="max wait for the responses after the last request")
+    args = parser.parse_args()
+
+    config_file = args.config
+    if config_file is None:
+        if os.getenv("K3S_THIN_CLIENT_HOME") is None:
+            parser.error("--config is required when K3S_THIN_CLIENT_HOME is not set")
+        config_file = os.path.join(os.getenv("K3S_THIN_CLIENT_HOME"), "config", "config.ini")
+
+    home = tempfile.mkdtemp(prefix="replay-")
+    api = None
+    try:
+        kube_config = None
+        if args.fake_apps is not None:
+            from fake_kube_api import FakeCluster, FakeKubeAPIServer
+            api = FakeKubeAPIServer(FakeCluster(args.fake_apps, rollout_delay=args.rollout_delay)).start()
+            kube_config = os.path.join(home, "k3s.yaml")
+            api.write_kubeconfig(kube_config)
+        bin_dir = prepare_home(home, config_file, kube_config, args.fake_apps or 0)
+        if bin_dir is not None:
+            os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        # the service modules read the home directory on their import
+        os.environ["K3S_THIN_CLIENT_HOME"] = home
+        print(json.dumps(replay(args), indent=2))
+    finally:
+        if api is not None:
+            api.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+def replay(args):
+    from utils.config import AppConfig
+    from service.app_svc import AppManager
+    from messaging.message_processor import MessageProcessor, IntakeQueue
+    from messaging.mqtt_proxy import TERMINAL_STATUSES
+    from messaging.request_recorder import read_recording
+    from bench_service import percentiles
+
+    records = list(read_recording(args.recording))
+    config = AppConfig()
+    AppManager.init(config)
+
+    condition = threading.Condition()
+    # request_id -> send times of the replayed requests waiting for their terminal response
+    pending = defaultdict(deque)
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+
+    def on_message(data):
+        request_id = data.get("request_id")
+        if data.get("status") not in TERMINAL_STATUSES or request_id is None:
+            return
+        with condition:
+            if pending.get(request_id):
+                latencies[data.get("request")].append((time.perf_counter() - pending[request_id].popleft()) * 1000)
+                status = data["status"] if data.get("reason") is None else f"{data['status']} ({data['reason']})"
+                statuses[data.get("request")][status] += 1
+                if not pending[request_id]:
+                    del pending[request_id]
+                condition.notify_all()
+
+    AppManager.add_message_listener(on_message)
+    processor = MessageProcessor(AppManager.process_request, AppManager.reject_request,
+                                 IntakeQueue(config.intake_max_size, config.intake_policy,
+                                             config.intake_quotas, config.intake_read_quota))
+    AppManager.set_intake_stats(processor.get_stats)
+    processor.start()
+
+    lags = []
+    start = time.monotonic()
+    first_time = records[0]["time"] if records else 0
+    for record in records:
+        if args.speed > 0:
+            target = start + (record["time"] - first_time) / args.speed
+            delay = target - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            lags.append(max(0.0, time.monotonic() - target) * 1000)
+        payload = record["payload"]
+        if isinstance(payload, dict):
+            # an absolute deadline is moved by the time passed since the recording
+            if isinstance(payload.get("deadline"), (int, float)):
+                payload["deadline"] += time.time() - record["time"]
+            if payload.get("request_id") is not None:
+                with condition:
+                    pending[payload["request_id"]].append(time.perf_counter())
+        processor.add_message(payload)
+    feed_duration = time.monotonic() - start
+
+    with condition:
+        condition.wait_for(lambda: not pending, args.timeout)
+        unanswered = sum(len(send_times) for send_times in pending.values())
+    processor.stop()
+
+    return {
+        "benchmark": "replay",
+        "recording": args.recording,
+        "requests": len(records),
+        "speed": args.speed,
+        "feed_duration_s": round(feed_duration, 3),
+        "total_duration_s": round(time.monotonic() - start, 3),
+        "pacing_lag_ms": percentiles(lags),
+        "latency_ms": {request: percentiles(values) for request, values in latencies.items()},
+        "statuses": {request: dict(counts) for request, counts in statuses.items()},
+        "unanswered": unanswered
+    }
+
+if __name__ == "__main__":
+    main()